@@ -0,0 +1,59 @@
+# Measures how long a fresh interpreter needs to import the wallet and checks it against a budget.
+# The core wallet should only load nostr_sdk, cashu, httpx and nostr_dvm are imported when they are used.
+#
+#   python benchmarks/import_time.py [--budget 0.5] [--runs 5] [--module nut_wallet_utils]
+#
+# Exits with 1 if the median import time is over the budget or a lazy dependency was imported.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+lazy_modules = ["nostr_dvm", "cashu", "httpx", "websockets"]
+
+probe = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "modules": sorted(set(name.split(".")[0] for name in sys.modules))}}))
+"""
+
+
+def measure(module, runs):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    modules = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", probe.format(module=module)], cwd=root, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["seconds"])
+        modules.update(result["modules"])
+    return timings, modules
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time budget')
+    parser.add_argument("--module", type=str, default="nut_wallet_utils")
+    parser.add_argument("--budget", type=float, default=0.5)  # seconds
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    timings, modules = measure(args.module, args.runs)
+    median = statistics.median(timings)
+    print("import " + args.module + ": median " + str(round(median * 1000)) + " ms, min " +
+          str(round(min(timings) * 1000)) + " ms, max " + str(round(max(timings) * 1000)) + " ms (budget " +
+          str(round(args.budget * 1000)) + " ms)")
+
+    failed = False
+    loaded = [name for name in lazy_modules if name in modules]
+    if len(loaded) > 0:
+        print("imported at load time, should be lazy: " + ", ".join(loaded))
+        failed = True
+    if median > args.budget:
+        print("over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,242 @@
+# Benchmarks the main wallet code paths on synthetic wallets, without relays or mints: a signed wallet event (37375),
+# proof events (7375) holding the given number of proofs and transaction history events (7376) are served by an
+# in-memory client. Reports the median time and the peak memory (tracemalloc) of each path and wallet size.
+#
+#   python benchmarks/wallet_paths.py [--sizes 10,1000,100000] [--runs 5] [--paths get_nut_wallet,...]
+#                                     [--save baseline.json] [--compare baseline.json] [--tolerance 0.2]
+#
+# --save writes the results as json, --compare prints the change against a saved file and exits with 1 if a
+# path got slower or uses more memory than the tolerance allows.
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nostr_sdk import EventBuilder, Keys, Kind, Nip44Version, Tag, nip44_encrypt
+
+from nut_event_store import NutEventStore
+from nut_proof_store import NutProof
+from nut_wallet_utils import NutZapWallet
+
+relay_url = "wss://bench.relay"
+mint_url = "https://bench.mint"
+keyset_id = "00ad268c4d1f5826"
+paths = ["get_nut_wallet", "add_proofs_to_wallet", "update_spend_mint_proof_event", "print_transaction_history"]
+
+
+class MemoryEvents(list):
+    def to_vec(self):
+        return list(self)
+
+
+class MemoryOutput(object):
+    def __init__(self, success: list):
+        self.success: list = success
+        self.failed: dict = {}
+
+
+class MemorySendOutput(object):
+    def __init__(self, event_id):
+        self.id = event_id
+        self.output = MemoryOutput([relay_url])
+
+
+class MemoryClient(object):
+    # Stands in for nostr_sdk.Client, a single relay that keeps events in a list and replaces nothing
+    def __init__(self, events=None):
+        self.events: list = list(events) if events is not None else []
+
+    async def relays(self):
+        return {relay_url: None}
+
+    async def send_event(self, event):
+        self.events.append(event)
+        return MemorySendOutput(event.id())
+
+    async def send_event_to(self, urls, event):
+        return await self.send_event(event)
+
+    async def fetch_events(self, filters, timeout):
+        return MemoryEvents([event for event in self.events if any(f.match_event(event) for f in filters)])
+
+    async def fetch_events_from(self, urls, filters, timeout):
+        return await self.fetch_events(filters, timeout)
+
+
+def random_proof(rng: random.Random) -> NutProof:
+    return NutProof(keyset_id, 1 << rng.randrange(0, 12), "%064x" % rng.getrandbits(256),
+                    "02" + "%064x" % rng.getrandbits(256))
+
+
+def synthetic_events(keys, size: int, history: int, chunk_proofs: int, seed: int = 1):
+    # the events of a wallet with size proofs on one mint and history transaction events
+    rng = random.Random(seed)
+    wallet_a = "37375:" + keys.public_key().to_hex() + ":wallet"
+    proofs = [random_proof(rng) for _ in range(size)]
+
+    def encrypt(message):
+        return nip44_encrypt(keys.secret_key(), keys.public_key(), message, Nip44Version.V2)
+
+    inner_tags = [["balance", str(sum(proof.amount for proof in proofs)), "sats"],
+                  ["privkey", Keys.generate().secret_key().to_hex()]]
+    events = [EventBuilder(Kind(37375), encrypt(json.dumps(inner_tags)),
+                           [Tag.parse(["name", "bench"]), Tag.parse(["unit", "sats"]),
+                            Tag.parse(["description", ""]), Tag.parse(["d", "wallet"]),
+                            Tag.parse(["mint", mint_url]), Tag.parse(["relay", relay_url])]).sign_with_keys(keys)]
+
+    for start in range(0, size, chunk_proofs):
+        message = json.dumps({"mint": mint_url, "proofs": [proof.to_json()
+                                                            for proof in proofs[start:start + chunk_proofs]]})
+        events.append(EventBuilder(Kind(7375), encrypt(message), [Tag.parse(["a", wallet_a])]).sign_with_keys(keys))
+
+    for index in range(history):
+        direction = "in" if index % 2 == 0 else "out"
+        inner_tags = [["direction", direction], ["amount", str(1 << rng.randrange(0, 12)), "sats"],
+                      ["e", events[-1].id().to_hex(), relay_url, "created"]]
+        events.append(EventBuilder(Kind(7376), encrypt(json.dumps(inner_tags)),
+                                   [Tag.parse(["a", wallet_a])]).sign_with_keys(keys))
+    return events, proofs
+
+
+class Scenario(object):
+    # One wallet size, every run starts from a fresh client with the synthetic events and a fresh NutZapWallet
+    def __init__(self, size: int, history: int, event_store: bool):
+        self.size: int = size
+        self.keys = Keys.generate()
+        self.chunk_proofs: int = NutZapWallet().max_chunk_proofs
+        self.events, self.proofs = synthetic_events(self.keys, size, history, self.chunk_proofs)
+        self.event_store: bool = event_store
+        self.directory = None
+        self.nutzap_wallet = None
+        self.rng = random.Random(2)
+
+    def new_wallet(self):
+        store = None
+        if self.event_store:
+            import tempfile
+            self.directory = tempfile.TemporaryDirectory()
+            store = NutEventStore(os.path.join(self.directory.name, "events.sqlite3"))
+        self.nutzap_wallet = NutZapWallet(store)
+        return self.nutzap_wallet
+
+    async def cleanup(self):
+        # the outbox publishes to the in-memory client in the background, that's not part of the measurement
+        if self.nutzap_wallet is not None and self.nutzap_wallet.outbox is not None:
+            await self.nutzap_wallet.outbox.stop()
+
+    async def setup(self, path: str):
+        # returns the coroutine function of the timed part, everything before it is not measured
+        client = MemoryClient(self.events)
+        nutzap_wallet = self.new_wallet()
+        if path == "get_nut_wallet":
+            return lambda: nutzap_wallet.get_nut_wallet(client, self.keys)
+
+        if path == "print_transaction_history":
+            transactions = [event for event in self.events if event.kind().as_u16() == 7376]
+
+            async def print_history():
+                nutzap_wallet.print_transaction_history(transactions, self.keys)
+            return print_history
+
+        nut_wallet = await nutzap_wallet.get_nut_wallet(client, self.keys)
+        if path == "add_proofs_to_wallet":
+            new_proofs = [random_proof(self.rng) for _ in range(10)]
+            return lambda: nutzap_wallet.add_proofs_to_wallet(nut_wallet, mint_url, new_proofs, "created", None,
+                                                              None, client, self.keys)
+        if path == "update_spend_mint_proof_event":
+            # spend a few proofs from different proof events
+            step = max(1, self.size // 3)
+            spent = [self.proofs[index] for index in range(0, self.size, step)][:3]
+            return lambda: nutzap_wallet.update_spend_mint_proof_event(nut_wallet, spent, mint_url, "", None, None,
+                                                                       client, self.keys)
+        raise ValueError("unknown path " + path)
+
+    async def measure(self, path: str, runs: int):
+        timings = []
+        for _ in range(runs):
+            with contextlib.redirect_stdout(io.StringIO()):
+                timed = await self.setup(path)
+                started = time.perf_counter()
+                await timed()
+                timings.append(time.perf_counter() - started)
+                await self.cleanup()
+
+        # one more run for the memory, tracemalloc slows everything down so it's not part of the timings
+        with contextlib.redirect_stdout(io.StringIO()):
+            timed = await self.setup(path)
+            tracemalloc.start()
+            await timed()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            await self.cleanup()
+        return {"seconds": statistics.median(timings), "min": min(timings), "peak_bytes": peak}
+
+
+# differences below these are noise, whatever the relative change
+noise = {"seconds": 0.002, "peak_bytes": 16 * 1024}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    # prints the change of every path against the baseline, returns False on a regression
+    ok = True
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            before = baseline[key][metric]
+            change = (result[metric] - before) / before if before > 0 else 0.0
+            regressed = change > tolerance and result[metric] - before > noise[metric]
+            ok = ok and not regressed
+            print(key + " " + metric + ": " + format_change(change) + (" REGRESSION" if regressed else ""))
+    return ok
+
+
+def format_change(change: float) -> str:
+    return ("+" if change >= 0 else "") + str(round(change * 100, 1)) + "%"
+
+
+async def main(args):
+    results = {}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        history = args.history if args.history is not None else max(10, size // 100)
+        started = time.perf_counter()
+        scenario = Scenario(size, history, args.event_store)
+        print("generated " + str(len(scenario.events)) + " events for " + str(size) + " proofs and " +
+              str(history) + " transactions in " + str(round(time.perf_counter() - started, 2)) + " s")
+        for path in args.paths.split(","):
+            result = await scenario.measure(path, args.runs)
+            results[path + "/" + str(size)] = result
+            print(f"{path:32} {size:7} proofs  {result['seconds'] * 1000:10.2f} ms  "
+                  f"(min {result['min'] * 1000:.2f} ms)  peak {result['peak_bytes'] / 1024:10.1f} kB")
+
+    if args.save is not None:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Wallet code path benchmarks')
+    parser.add_argument("--sizes", type=str, default="10,1000,100000")  # number of proofs
+    parser.add_argument("--history", type=int, default=None)  # transaction events, default 1 per 100 proofs
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--paths", type=str, default=",".join(paths))
+    parser.add_argument("--event-store", action="store_true")  # load through a fresh sqlite event store
+    parser.add_argument("--save", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)  # allowed relative increase
+    sys.exit(asyncio.run(main(parser.parse_args())))
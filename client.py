@@ -1,14 +1,16 @@
 import asyncio
-from datetime import timedelta
+import logging
 from pathlib import Path
 
 import dotenv
-from nostr_dvm.utils.nostr_utils import check_and_set_private_key
-from nostr_sdk import HandleNotification, Event, Filter, SingleLetterTag, Alphabet, Kind, Timestamp, LogLevel, \
-    init_logger, EventSource, Keys
+from nostr_sdk import LogLevel, init_logger, Keys
 
+from nut_event_store import NutEventStore
+from nut_extras import check_and_set_private_key
+from nut_print_utils import bcolors
+from nut_receiver import NutzapReceiver
+from nut_redeemer import NutzapRedemptionQueue
 from nut_wallet_utils import NutZapWallet
-from nostr_dvm.utils.print_utils import bcolors
 
 use_logger = True
 log_level = LogLevel.INFO
@@ -16,36 +18,16 @@ if use_logger:
     init_logger(log_level)
 
 async def nostr_client(relays, mints, show_history):
-    nutzap_wallet_client = NutZapWallet()
+    # keep wallet events locally, so restarts only fetch events that are new since the last run
+    nutzap_wallet_client = NutZapWallet(NutEventStore("db/Nutsack/events.sqlite3"))
     keys = Keys.parse(check_and_set_private_key("receiver"))
     client = await nutzap_wallet_client.client_connect(relays, keys)
 
-    # per default, check events within the last 60 seconds
-    from_time = Timestamp.from_secs(Timestamp.now().as_secs() - 60)
-
-    # but eventually, we check all events since the last time a transaction was made
-    # therefore we fetch the transaction history (Maybe we limit this to 1 in the future)
-    transaction_history_filter = Filter().author(keys.public_key()).kinds([Kind(7376)])  # .limit(1)
-
-    transactions = await client.fetch_events([transaction_history_filter], timedelta(seconds=10))
-
-    # If we find transactions, we look for all events since right after the last one
-    print("\n" + bcolors.CYAN + "Transaction History:" + bcolors.ENDC)
-    if len(transactions.to_vec()) > 0:
-        from_time = Timestamp.from_secs(transactions.to_vec()[0].created_at().as_secs())
-
-        if show_history:
-            nutzap_wallet_client.print_transaction_history(transactions.to_vec(), keys)
-
-    nut_zap_history_filter = Filter().pubkey(keys.public_key()).kinds([Kind(9321)]).since(from_time).custom_tag(
-        SingleLetterTag.lowercase(Alphabet.U),
-        mints)
-
-    # hist_events = await client.get_events_of([nut_zap_history_filter], timedelta(10))
-
-    # nut_zap_filter = Filter().pubkey(keys.public_key()).kinds([Kind(9321)]).custom_tag(
-    #    SingleLetterTag.lowercase(Alphabet.U),
-    #    mints)
+    if show_history:
+        # page through the transaction history, newest first
+        print("\n" + bcolors.CYAN + "Transaction History:" + bcolors.ENDC)
+        async for transaction in nutzap_wallet_client.iter_transaction_history(client, keys, limit=20):
+            nutzap_wallet_client.print_transaction(transaction)
     set_profile = True
     if set_profile:
         lud16 = "hype@bitcoinfixesthis.org"  # overwrite with your ln address
@@ -64,36 +46,31 @@ async def nostr_client(relays, mints, show_history):
         else:
             print("Couldn't fetch wallet, please restart and see if it is there")
 
-    await client.subscribe([nut_zap_history_filter], None)
-
-
-
-    class NotificationHandler(HandleNotification):
-        async def handle(self, relay_url, subscription_id, event: Event):
-            # print(f"Received new event from {relay_url}: {event.as_json()}")
-
-            # If we receive a nutzap addressed to us, with our mints, we claim the proofs
-            if event.kind().as_u16() == 9321:
-                print(bcolors.YELLOW + "[Client] NutZap 🥜️⚡ received" + event.as_json() + bcolors.ENDC)
-
-                # if event.author().to_hex() == keys.public_key().to_hex():
-                #     #sleep to avoid event not being updated on self zap
-                #     await asyncio.sleep(5)
+    # finish liquidity transfers between our mints that a previous run left unfinished
+    if nut_wallet is not None:
+        await nutzap_wallet_client.liquidity_router.resume(nut_wallet, client, keys)
 
-                nut_wallet = await nutzap_wallet_client.get_nut_wallet(client, keys)
-                if nut_wallet is not None:
-                    await nutzap_wallet_client.reedeem_nutzap(event, nut_wallet, client, keys)
-                    # await get_nut_wallet(client, keys)
+    # nutzaps are collected per mint for a short window and redeemed in batches
+    redemption_queue = NutzapRedemptionQueue(nutzap_wallet_client, client, keys, window=2.0)
+    # keep a few proofs of each denomination ready, so sending doesn't need to split proofs first
+    nutzap_wallet_client.start_rebalancer(client, keys)
 
-        async def handle_msg(self, relay_url, msg):
-            return
+    # If we receive a nutzap addressed to us, with our mints, we claim the proofs. Nutzaps that arrived while
+    # we were offline are fetched first, from the checkpoint of the last run.
+    receiver = NutzapReceiver(nutzap_wallet_client, client, keys, mints, redemption_queue)
+    await receiver.start()
 
-    asyncio.create_task(client.handle_notifications(NotificationHandler()))
-    while True:
-        await asyncio.sleep(2.0)
+    try:
+        while True:
+            await asyncio.sleep(2.0)
+    finally:
+        await nutzap_wallet_client.stop_rebalancer()
+        await redemption_queue.close()
+        await nutzap_wallet_client.writer.close()
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     env_path = Path('.env')
     if env_path.is_file():
         print(f'loading environment from {env_path.resolve()}')
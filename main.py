@@ -1,14 +1,15 @@
+import logging
 import os
 from pathlib import Path
 
 import dotenv
-from nostr_dvm.utils.nostr_utils import check_and_set_private_key
 from nostr_sdk import PublicKey, Keys
 
 import asyncio
 import argparse
-from nostr_dvm.utils.print_utils import bcolors
 
+from nut_event_store import NutEventStore
+from nut_extras import check_and_set_private_key
 from nut_wallet_utils import NutZapWallet
 
 # Run with params for test functions or set the default here
@@ -21,7 +22,8 @@ args = parser.parse_args()
 
 async def test(relays, mints):
 
-    nutzap_wallet = NutZapWallet()
+    # keep wallet events locally, so restarts only fetch events that are new since the last run
+    nutzap_wallet = NutZapWallet(NutEventStore("db/Nutsack/events.sqlite3"))
     update_wallet_info = True  # leave this on false except when you manually changed relays/mints/keys
     keys = Keys.parse(check_and_set_private_key("sender"))
     client = await nutzap_wallet.client_connect(relays, keys)
@@ -66,6 +68,10 @@ async def test(relays, mints):
         else:
             print("Couldn't fetch wallet, please restart and see if it is there")
 
+    # finish liquidity transfers between our mints that a previous run left unfinished
+    if nut_wallet is not None:
+        await nutzap_wallet.liquidity_router.resume(nut_wallet, client, keys)
+
     # Test 1: We mint to our own wallet
     if mint_to_wallet:
         await nutzap_wallet.mint_cashu(nut_wallet, mints[mint_index], client, keys, mint_amount)
@@ -87,8 +93,12 @@ async def test(relays, mints):
         await nutzap_wallet.melt_cashu(nut_wallet, mints[mint_index], melt_amount, client, keys, lud16, npub)
         await nutzap_wallet.get_nut_wallet(client, keys)
 
+    # wait for the outbox to publish the events of this run
+    await nutzap_wallet.writer.close()
+
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     env_path = Path('.env')
     if env_path.is_file():
         print(f'loading environment from {env_path.resolve()}')
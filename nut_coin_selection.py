@@ -0,0 +1,139 @@
+import itertools
+
+
+def keyset_fees(cashu_wallet) -> dict:
+    # input fee per proof in parts per thousand, per keyset id
+    return {keyset_id: keyset.input_fee_ppk for keyset_id, keyset in cashu_wallet.keysets.items()}
+
+
+def is_power_of_two(amount: int) -> bool:
+    return amount > 0 and amount & (amount - 1) == 0
+
+
+class CoinSelector(object):
+    # Picks proofs from a mint's proofs without talking to the mint. Proofs are grouped in buckets per
+    # denomination. Cashu denominations are powers of two, each one divides the next, so taking the largest
+    # denominations first finds an exact subset whenever one exists and it uses the fewest proofs. For other
+    # denominations we fall back to a bounded knapsack over the sums up to max_knapsack_amount.
+    # Input fees are per proof, so the fewest proofs is also the cheapest selection within a keyset.
+    def __init__(self, max_knapsack_amount: int = 1 << 16, max_change_bits: int = 2):
+        self.max_knapsack_amount: int = max_knapsack_amount
+        self.max_change_bits: int = max_change_bits  # change amounts with more set bits are not searched
+
+    def input_fee(self, proofs, fees_ppk: dict = None) -> int:
+        if not fees_ppk:
+            return 0
+        return (sum(fees_ppk.get(proof.id, 0) for proof in proofs) + 999) // 1000
+
+    def buckets(self, proofs, fees_ppk: dict = None) -> dict:
+        # denomination -> proofs, cheapest keysets first
+        buckets = {}
+        for proof in proofs:
+            buckets.setdefault(proof.amount, []).append(proof)
+        if fees_ppk:
+            for bucket in buckets.values():
+                bucket.sort(key=lambda proof: fees_ppk.get(proof.id, 0))
+        return buckets
+
+    def select_exact(self, proofs, amount: int, fees_ppk: dict = None):
+        # Returns proofs that sum up to exactly amount plus their own input fees (so the receiver gets amount
+        # after swapping them), or None if there is no such subset.
+        proofs = list(proofs)
+        if amount <= 0:
+            return []
+        buckets = self.buckets(proofs, fees_ppk)
+        max_fee = self.input_fee(proofs, fees_ppk)
+        for fee in range(0, max_fee + 1):
+            selected = self.exact_subset(buckets, amount + fee)
+            if selected is not None and self.input_fee(selected, fees_ppk) == fee:
+                return selected
+        return None
+
+    def select_for_swap(self, proofs, amount: int, fees_ppk: dict = None):
+        # Returns inputs for a swap that sends amount. Every output of a swap is one proof per set bit of the
+        # send and the change amount, so we look for inputs that leave no change first, then change amounts with
+        # few set bits, smallest first. If no such subset exists we take the largest proofs until we have enough.
+        # Returns None if the proofs don't cover amount and fees.
+        proofs = list(proofs)
+        if amount <= 0:
+            return []
+        for change in self.change_candidates(sum(proof.amount for proof in proofs) - amount):
+            selected = self.select_exact(proofs, amount + change, fees_ppk)
+            if selected is not None:
+                return selected
+
+        selected = []
+        total = 0
+        for proof in sorted(proofs, key=lambda proof: proof.amount, reverse=True):
+            if total >= amount + self.input_fee(selected, fees_ppk):
+                break
+            selected.append(proof)
+            total += proof.amount
+        if total < amount + self.input_fee(selected, fees_ppk):
+            return None
+        return selected
+
+    def change_candidates(self, max_change: int) -> list:
+        candidates = {0}
+        bits = [1 << bit for bit in range(max(max_change, 0).bit_length())]
+        current = {0}
+        for _ in range(self.max_change_bits):
+            current = {change + bit for change in current for bit in bits if not change & bit}
+            candidates.update(change for change in current if change <= max_change)
+        return sorted(candidates, key=lambda change: (bin(change).count("1"), change))
+
+    def exact_subset(self, buckets: dict, target: int):
+        if target <= 0:
+            return [] if target == 0 else None
+        if all(is_power_of_two(denomination) for denomination in buckets):
+            return self.greedy_subset(buckets, target)
+        if target > self.max_knapsack_amount:
+            return self.greedy_subset(buckets, target)
+        return self.knapsack_subset(buckets, target)
+
+    def greedy_subset(self, buckets: dict, target: int):
+        selected = []
+        remaining = target
+        for denomination in sorted(buckets.keys(), reverse=True):
+            count = min(len(buckets[denomination]), remaining // denomination)
+            selected.extend(buckets[denomination][:count])
+            remaining -= count * denomination
+            if remaining == 0:
+                return selected
+        return None
+
+    def knapsack_subset(self, buckets: dict, target: int):
+        # bounded knapsack, minimal number of proofs per reachable sum. Each bucket is split into
+        # parts of 1, 2, 4, ... proofs so a bucket of n proofs costs log(n) passes instead of n.
+        unreachable = len(list(itertools.chain.from_iterable(buckets.values()))) + 1
+        best = [0] + [unreachable] * target
+        choice = [None] * (target + 1)
+        parts = []
+        for denomination, bucket in buckets.items():
+            count = len(bucket)
+            size = 1
+            while count > 0:
+                take = min(size, count)
+                parts.append((denomination, take))
+                count -= take
+                size *= 2
+
+        for index, (denomination, take) in enumerate(parts):
+            value = denomination * take
+            for total in range(target, value - 1, -1):
+                if best[total - value] + take < best[total]:
+                    best[total] = best[total - value] + take
+                    choice[total] = (index, choice[total - value])
+
+        if best[target] == unreachable:
+            return None
+        taken = {}
+        node = choice[target]
+        while node is not None:
+            denomination, take = parts[node[0]]
+            taken[denomination] = taken.get(denomination, 0) + take
+            node = node[1]
+        selected = []
+        for denomination, take in taken.items():
+            selected.extend(buckets[denomination][:take])
+        return selected
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from nostr_sdk import nip04_decrypt, nip44_decrypt
+
+from nut_print_utils import logger
+
+
+def is_nip04_payload(content: str) -> bool:
+    # NIP04 payloads look like "<base64 ciphertext>?iv=<base64 iv>", NIP44 payloads are a single base64 string
+    return "?iv=" in content
+
+
+def decrypt_content(keys, content: str) -> str:
+    if is_nip04_payload(content):
+        return nip04_decrypt(keys.secret_key(), keys.public_key(), content)
+    return nip44_decrypt(keys.secret_key(), keys.public_key(), content)
+
+
+class BatchDecryptor(object):
+    # Decrypts the content of many events on a thread pool. The nostr_sdk bindings release the GIL while
+    # the rust code runs, so the threads decrypt in parallel and the event loop stays free.
+    # Results are returned in the order of the events, None for events that could not be decrypted.
+    def __init__(self, max_workers: int = None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 4
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nut-decrypt")
+
+    def decrypt(self, events: list, keys) -> list:
+        futures = [self.executor.submit(decrypt_content, keys, event.content()) for event in events]
+        results = []
+        for event, future in zip(events, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.warning("Could not decrypt event " + event.id().to_hex() + ": " + str(e))
+                results.append(None)
+        return results
+
+    async def decrypt_async(self, events: list, keys) -> list:
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(self.executor, decrypt_content, keys, event.content()) for event in events]
+        results = []
+        for event, result in zip(events, await asyncio.gather(*futures, return_exceptions=True)):
+            if isinstance(result, Exception):
+                logger.warning("Could not decrypt event " + event.id().to_hex() + ": " + str(result))
+                result = None
+            results.append(result)
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class DecryptionCache(object):
+    # Parsed json content of decrypted events by event id. Event ids are hashes over the content, so an
+    # entry never gets stale. Keeps the maxsize most recently used entries in memory and, if an event store
+    # is given, persists the decrypted content there so it survives restarts.
+    def __init__(self, maxsize: int = 10000, event_store=None):
+        self.maxsize: int = maxsize
+        self.event_store = event_store
+        self.entries: OrderedDict = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def lookup(self, event_id: str, stored: str = None):
+        # returns the parsed content or None, stored is decrypted content the caller already has
+        if event_id in self.entries:
+            self.entries.move_to_end(event_id)
+            self.hits += 1
+            return self.entries[event_id]
+        if stored is None and self.event_store is not None:
+            stored = self.event_store.get_decrypted(event_id)
+        if stored is not None:
+            self.hits += 1
+            return self.remember(event_id, json.loads(stored))
+        self.misses += 1
+        return None
+
+    def put(self, event_id: str, content: str):
+        if self.event_store is not None:
+            self.event_store.save_decrypted(event_id, content)
+        return self.remember(event_id, json.loads(content))
+
+    def put_many(self, contents: list) -> dict:
+        # Takes (event id, decrypted content) pairs and persists them in one transaction. Returns the parsed
+        # content by event id, contents that are not valid json are left out.
+        values = {}
+        for event_id, content in contents:
+            try:
+                values[event_id] = json.loads(content)
+            except ValueError:
+                continue
+        if self.event_store is not None and len(values) > 0:
+            self.event_store.save_decrypted_many([(event_id, content) for event_id, content in contents
+                                                  if event_id in values])
+        for event_id, value in values.items():
+            self.remember(event_id, value)
+        return values
+
+    def remember(self, event_id: str, value):
+        self.entries[event_id] = value
+        self.entries.move_to_end(event_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0
+        }
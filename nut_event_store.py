@@ -0,0 +1,217 @@
+import json
+import os
+import sqlite3
+
+from nostr_sdk import Event
+
+
+class NutEventStore(object):
+    # Local copy of the wallet related events (37375, 7375, 7376 and deletions) of one or more keys.
+    # Raw events are stored as json next to their decrypted content, so a warm start neither downloads
+    # nor decrypts events we have seen before. Cursors are kept per pubkey, relay and stream, so only
+    # events newer than the last sync are requested from each relay.
+    def __init__(self, path: str = "db/Nutsack/events.sqlite3"):
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.cursor_overlap: int = 60  # seconds we re-fetch before a cursor, to tolerate clock skew between devices
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+
+    def migrate(self):
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                id TEXT PRIMARY KEY,
+                pubkey TEXT NOT NULL,
+                kind INTEGER NOT NULL,
+                created_at INTEGER NOT NULL,
+                raw TEXT NOT NULL,
+                decrypted TEXT
+            );
+            CREATE INDEX IF NOT EXISTS events_pubkey_kind ON events (pubkey, kind, created_at);
+            CREATE TABLE IF NOT EXISTS deleted (
+                id TEXT PRIMARY KEY,
+                pubkey TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cursors (
+                pubkey TEXT NOT NULL,
+                relay TEXT NOT NULL,
+                stream TEXT NOT NULL,
+                since INTEGER NOT NULL,
+                PRIMARY KEY (pubkey, relay, stream)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                pubkey TEXT NOT NULL,
+                stream TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                event_id TEXT NOT NULL,
+                PRIMARY KEY (pubkey, stream)
+            );
+            CREATE TABLE IF NOT EXISTS nutzaps (
+                id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS transfers (
+                id TEXT PRIMARY KEY,
+                pubkey TEXT NOT NULL,
+                state TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                raw TEXT NOT NULL,
+                relays TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                next_attempt REAL NOT NULL
+            );
+        """)
+        self.db.commit()
+
+    def get_cursor(self, pubkey: str, relay: str, stream: str):
+        row = self.db.execute("SELECT since FROM cursors WHERE pubkey = ? AND relay = ? AND stream = ?",
+                              (pubkey, relay, stream)).fetchone()
+        if row is None:
+            return None
+        return max(row[0] - self.cursor_overlap, 0)
+
+    def set_cursor(self, pubkey: str, relay: str, stream: str, since: int):
+        self.db.execute("INSERT INTO cursors (pubkey, relay, stream, since) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (pubkey, relay, stream) DO UPDATE SET since = MAX(since, excluded.since)",
+                        (pubkey, relay, stream, since))
+        self.db.commit()
+
+    def get_checkpoint(self, pubkey: str, stream: str):
+        # (created_at, event id) of the newest event up to which everything was processed, or None
+        return self.db.execute("SELECT created_at, event_id FROM checkpoints WHERE pubkey = ? AND stream = ?",
+                               (pubkey, stream)).fetchone()
+
+    def set_checkpoint(self, pubkey: str, stream: str, created_at: int, event_id: str):
+        self.db.execute("INSERT INTO checkpoints (pubkey, stream, created_at, event_id) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (pubkey, stream) DO UPDATE SET created_at = excluded.created_at, "
+                        "event_id = excluded.event_id WHERE excluded.created_at >= checkpoints.created_at",
+                        (pubkey, stream, created_at, event_id))
+        self.db.commit()
+
+    def save_events(self, events: list):
+        rows, deleted = self.event_rows(events)
+        self.db.executemany("INSERT OR IGNORE INTO events (id, pubkey, kind, created_at, raw) VALUES (?, ?, ?, ?, ?)",
+                            rows)
+        self.db.executemany("INSERT OR IGNORE INTO deleted (id, pubkey) VALUES (?, ?)", deleted)
+        self.db.commit()
+
+    def event_rows(self, events: list):
+        rows = []
+        deleted = []
+        for event in events:
+            event_id = event.id().to_hex()
+            pubkey = event.author().to_hex()
+            rows.append((event_id, pubkey, event.kind().as_u16(), event.created_at().as_secs(), event.as_json()))
+            # NIP-09: remember what the author deleted, even if the deleted event reaches us later
+            if event.kind().as_u16() == 5:
+                for tag in event.tags().to_vec():
+                    if tag.as_vec()[0] == "e":
+                        deleted.append((tag.as_vec()[1], pubkey))
+        return rows, deleted
+
+    def save_decrypted(self, event_id: str, content: str):
+        self.save_decrypted_many([(event_id, content)])
+
+    def save_decrypted_many(self, contents: list):
+        # (event id, decrypted content) pairs, written in one transaction
+        self.db.executemany("UPDATE events SET decrypted = ? WHERE id = ?",
+                            [(content, event_id) for event_id, content in contents])
+        self.db.commit()
+
+    def get_decrypted(self, event_id: str):
+        row = self.db.execute("SELECT decrypted FROM events WHERE id = ?", (event_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def mark_deleted(self, event_ids: list, pubkey: str):
+        self.db.executemany("INSERT OR IGNORE INTO deleted (id, pubkey) VALUES (?, ?)",
+                            [(event_id, pubkey) for event_id in event_ids])
+        self.db.commit()
+
+    def load_events(self, pubkey: str, kind: int):
+        # returns (event, decrypted content or None) for all events of a kind that were not deleted
+        rows = self.db.execute("SELECT raw, decrypted FROM events WHERE pubkey = ? AND kind = ? "
+                               "AND id NOT IN (SELECT id FROM deleted WHERE pubkey = ?) ORDER BY created_at DESC",
+                               (pubkey, kind, pubkey)).fetchall()
+        return [(Event.from_json(raw), decrypted) for raw, decrypted in rows]
+
+    def save_transfer(self, pubkey: str, transfer: dict):
+        # state of a liquidity transfer between mints, so an interrupted transfer can be resumed
+        self.db.execute("INSERT INTO transfers (id, pubkey, state, data, updated_at) VALUES (?, ?, ?, ?, "
+                        "strftime('%s', 'now')) ON CONFLICT (id) DO UPDATE SET state = excluded.state, "
+                        "data = excluded.data, updated_at = excluded.updated_at",
+                        (transfer["id"], pubkey, transfer["state"], json.dumps(transfer)))
+        self.db.commit()
+
+    def load_transfers(self, pubkey: str, states: list):
+        rows = self.db.execute("SELECT data FROM transfers WHERE pubkey = ? AND state IN (" +
+                               ", ".join("?" for _ in states) + ") ORDER BY updated_at",
+                               [pubkey] + list(states)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def mark_nutzaps(self, event_ids: list, state: str):
+        # nutzaps we are done with: redeemed by us, or already spent when we tried
+        self.db.executemany("INSERT INTO nutzaps (id, state, updated_at) VALUES (?, ?, strftime('%s', 'now')) "
+                            "ON CONFLICT (id) DO NOTHING", [(event_id, state) for event_id in event_ids])
+        self.db.commit()
+
+    def has_nutzap(self, event_id: str) -> bool:
+        return self.db.execute("SELECT 1 FROM nutzaps WHERE id = ?", (event_id,)).fetchone() is not None
+
+    def load_nutzaps(self) -> list:
+        return [event_id for event_id, in self.db.execute("SELECT id FROM nutzaps").fetchall()]
+
+    def journal_events(self, events: list, contents: dict, relays: list, next_attempt: float):
+        # Stores the events of one operation with their decrypted content (by event id) and queues them in the
+        # outbox for the given relays, all in one transaction: after a crash either the whole operation or
+        # nothing of it is in the store.
+        rows, deleted = self.event_rows(events)
+        try:
+            self.db.executemany("INSERT OR IGNORE INTO events (id, pubkey, kind, created_at, raw) "
+                                "VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.executemany("INSERT OR IGNORE INTO deleted (id, pubkey) VALUES (?, ?)", deleted)
+            self.db.executemany("UPDATE events SET decrypted = ? WHERE id = ?",
+                                [(content, event_id) for event_id, content in contents.items() if content is not None])
+            self.db.executemany("INSERT OR IGNORE INTO outbox (id, raw, relays, attempts, next_attempt) "
+                                "VALUES (?, ?, ?, 0, ?)",
+                                [(row[0], row[4], json.dumps(relays), next_attempt) for row in rows])
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def load_outbox(self, now: float, limit: int):
+        # (event id, raw event, relays that didn't acknowledge it yet, attempts) of the events due for publishing,
+        # in the order they were journaled
+        rows = self.db.execute("SELECT id, raw, relays, attempts FROM outbox WHERE next_attempt <= ? ORDER BY seq "
+                               "LIMIT ?", (now, limit)).fetchall()
+        return [(event_id, raw, json.loads(relays), attempts) for event_id, raw, relays, attempts in rows]
+
+    def update_outbox(self, event_id: str, relays: list, attempts: int, next_attempt: float):
+        # an event is done once every relay acknowledged it
+        if len(relays) == 0:
+            self.db.execute("DELETE FROM outbox WHERE id = ?", (event_id,))
+        else:
+            self.db.execute("UPDATE outbox SET relays = ?, attempts = ?, next_attempt = ? WHERE id = ?",
+                            (json.dumps(relays), attempts, next_attempt, event_id))
+        self.db.commit()
+
+    def next_outbox_attempt(self):
+        return self.db.execute("SELECT MIN(next_attempt) FROM outbox").fetchone()[0]
+
+    def count_outbox(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,171 @@
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+
+from nostr_sdk import EventBuilder, EventId
+
+from nut_print_utils import bcolors, logger
+
+
+class PendingEvents(object):
+    def __init__(self, client, keys):
+        self.client = client
+        self.keys = keys
+        self.depth: int = 0
+        self.deletions: list = []
+        self.events: list = []
+        self.contents: dict = {}  # event id -> decrypted content of events
+        self.wallet = None
+
+
+class NutEventWriter(object):
+    # Collects the events of one wallet operation and publishes them together when the operation ends:
+    # all deletions go into one NIP-09 event, events that are created and deleted within the same
+    # operation are never published, independent events are sent concurrently and the wallet event
+    # is written once with the final balance. With wallet_debounce > 0 the wallet event is additionally
+    # delayed, so a burst of operations updates it only once per window.
+    # If the wallet has an outbox (it has one with an event store) the events of an operation are journaled
+    # together instead, the outbox publishes them in the background.
+    # The open batch is kept in a context variable, so it belongs to the operation (the task and the tasks it
+    # starts) that opened it. Concurrent operations of the same wallet have their own batches and each one is
+    # published or journaled as soon as its operation ends.
+    def __init__(self, nutzap_wallet, wallet_debounce: float = 0.0):
+        self.nutzap_wallet = nutzap_wallet
+        self.wallet_debounce: float = wallet_debounce
+        self.current = contextvars.ContextVar("nutzap_pending_events", default=None)
+        self.wallet_tasks: dict = {}
+
+    @asynccontextmanager
+    async def batch(self, client, keys):
+        pending = self.get_pending(keys)
+        token = None
+        if pending is None:
+            pending = PendingEvents(client, keys)
+            token = self.current.set(pending)
+        pending.depth += 1
+        try:
+            yield pending
+        finally:
+            pending.depth -= 1
+            if token is not None:
+                self.current.reset(token)
+                await self.flush(pending)
+
+    def get_pending(self, keys):
+        # the open batch of the current operation for keys, None outside of a batch. Tasks started inside a
+        # batch that outlive it see it closed (depth 0) and publish directly.
+        pending = self.current.get()
+        if pending is None or pending.depth == 0 or \
+                pending.keys.public_key().to_hex() != keys.public_key().to_hex():
+            return None
+        return pending
+
+    async def publish(self, event, client, keys, content=None):
+        outbox = self.nutzap_wallet.outbox
+        pending = self.get_pending(keys)
+        if outbox is None:
+            self.nutzap_wallet.remember_event(event, content)
+        if pending is not None:
+            pending.events.append(event)
+            pending.contents[event.id().to_hex()] = content
+        elif outbox is not None:
+            await outbox.journal([event], {event.id().to_hex(): content}, client)
+        else:
+            await client.send_event(event)
+        return event.id()
+
+    async def delete(self, event_ids: list, client, keys):
+        pending = self.get_pending(keys)
+        event_ids = [event_id.to_hex() for event_id in event_ids]
+        if pending is not None:
+            # events that were never published don't need a deletion
+            unpublished = [event.id().to_hex() for event in pending.events]
+            dropped = [event_id for event_id in event_ids if event_id in unpublished]
+            pending.events = [event for event in pending.events if event.id().to_hex() not in dropped]
+            for event_id in dropped:
+                pending.contents.pop(event_id, None)
+            self.nutzap_wallet.forget_events(dropped, keys)
+            pending.deletions.extend([event_id for event_id in event_ids if event_id not in dropped])
+        else:
+            await self.send_deletion(event_ids, client, keys)
+
+    async def update_wallet(self, nut_wallet, client, keys):
+        pending = self.get_pending(keys)
+        if pending is not None:
+            pending.wallet = nut_wallet
+        else:
+            await self.write_wallet(nut_wallet, client, keys)
+
+    def deletion_event(self, event_ids: list, keys):
+        return EventBuilder.delete([EventId.parse(event_id) for event_id in event_ids],
+                                   reason="deleted").sign_with_keys(keys)
+
+    async def send_deletion(self, event_ids: list, client, keys):
+        if len(event_ids) == 0:
+            return
+        evt = self.deletion_event(event_ids, keys)
+        if self.nutzap_wallet.outbox is not None:
+            await self.nutzap_wallet.outbox.journal([evt], {}, client)
+            return
+        self.nutzap_wallet.remember_event(evt)
+        await client.send_event(evt)
+
+    async def flush(self, pending: PendingEvents):
+        with self.nutzap_wallet.metrics.span("publish"):
+            await self.send_pending(pending)
+
+    async def send_pending(self, pending: PendingEvents):
+        deletions, events, contents, nut_wallet = pending.deletions, pending.events, pending.contents, pending.wallet
+        pending.deletions, pending.events, pending.contents, pending.wallet = [], [], {}, None
+
+        if self.nutzap_wallet.outbox is not None:
+            await self.journal_pending(deletions, events, contents, nut_wallet, pending.client, pending.keys)
+            return
+
+        sends = [self.send_deletion(deletions, pending.client, pending.keys)]
+        sends += [pending.client.send_event(event) for event in events]
+        if nut_wallet is not None:
+            sends.append(self.write_wallet(nut_wallet, pending.client, pending.keys))
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(bcolors.RED + "Error publishing event: " + str(result) + bcolors.ENDC)
+
+    async def journal_pending(self, deletions, events, contents, nut_wallet, client, keys):
+        # the deletion, the new events and the wallet event of the operation go into the outbox at once
+        if len(deletions) > 0:
+            events = [self.deletion_event(deletions, keys)] + events
+        if nut_wallet is not None and self.wallet_debounce <= 0:
+            wallet_event, content = self.nutzap_wallet.nut_wallet_event(nut_wallet, keys)
+            events.append(wallet_event)
+            contents[wallet_event.id().to_hex()] = content
+            self.nutzap_wallet.log_nut_wallet_event(nut_wallet, wallet_event)
+        elif nut_wallet is not None:
+            await self.write_wallet(nut_wallet, client, keys)
+        await self.nutzap_wallet.outbox.journal(events, contents, client)
+
+    async def write_wallet(self, nut_wallet, client, keys):
+        if self.wallet_debounce <= 0:
+            await self.nutzap_wallet.create_or_update_nut_wallet_event(nut_wallet, client, keys)
+            return
+
+        pubkey = keys.public_key().to_hex()
+        if pubkey in self.wallet_tasks:
+            self.wallet_tasks[pubkey][0].cancel()
+        task = asyncio.create_task(self.write_wallet_later(nut_wallet, client, keys))
+        self.wallet_tasks[pubkey] = (task, nut_wallet, client, keys)
+
+    async def write_wallet_later(self, nut_wallet, client, keys):
+        await asyncio.sleep(self.wallet_debounce)
+        self.wallet_tasks.pop(keys.public_key().to_hex(), None)
+        await self.nutzap_wallet.create_or_update_nut_wallet_event(nut_wallet, client, keys)
+
+    async def close(self, timeout: float = 10.0):
+        # writes wallet events that are still waiting for their debounce window and gives the outbox up to
+        # timeout seconds to publish
+        for task, nut_wallet, client, keys in list(self.wallet_tasks.values()):
+            task.cancel()
+            await self.nutzap_wallet.create_or_update_nut_wallet_event(nut_wallet, client, keys)
+        self.wallet_tasks = {}
+        if self.nutzap_wallet.outbox is not None:
+            await self.nutzap_wallet.outbox.drain(timeout)
@@ -0,0 +1,40 @@
+# Optional integrations that live in nostr_dvm: paying invoices with LNbits, zap requests to lightning addresses,
+# profile lookups and key management for the example scripts. nostr_dvm pulls in a large dependency tree,
+# so it is only imported when one of these functions is called (pip install -r requirements-extras.txt).
+
+
+def require_nostr_dvm(feature: str):
+    try:
+        import nostr_dvm
+    except ImportError as e:
+        raise ImportError(feature + " needs nostr_dvm, install it with pip install -r requirements-extras.txt") from e
+
+
+def pay_bolt11_ln_bits(bolt11: str, lnbits_config):
+    require_nostr_dvm("Paying invoices with LNbits")
+    from nostr_dvm.utils.zap_utils import pay_bolt11_ln_bits
+    return pay_bolt11_ln_bits(bolt11, lnbits_config)
+
+
+def zaprequest(lud16, amount, content, zapped_event, zapped_user, keys, relay_list, zaptype="public"):
+    require_nostr_dvm("Zap requests")
+    from nostr_dvm.utils.zap_utils import zaprequest
+    return zaprequest(lud16, amount, content, zapped_event, zapped_user, keys, relay_list, zaptype=zaptype)
+
+
+def default_relay_list() -> list:
+    require_nostr_dvm("The default relay list")
+    from nostr_dvm.utils.dvmconfig import DVMConfig
+    return DVMConfig().RELAY_LIST
+
+
+async def fetch_user_metadata(npub, client):
+    require_nostr_dvm("Fetching user metadata")
+    from nostr_dvm.utils.database_utils import fetch_user_metadata
+    return await fetch_user_metadata(npub, client)
+
+
+def check_and_set_private_key(identifier: str):
+    require_nostr_dvm("Generating and storing keys")
+    from nostr_dvm.utils.nostr_utils import check_and_set_private_key
+    return check_and_set_private_key(identifier)
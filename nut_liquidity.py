@@ -0,0 +1,227 @@
+import asyncio
+import time
+
+from nut_print_utils import bcolors, logger
+
+from nut_coin_selection import keyset_fees
+from nut_mint_http import quote_is_paid
+
+
+class LiquidityTransfer(object):
+    # A move of balance from one of our mints to another: melt on the source mint pays the mint quote of
+    # the target mint. States: quoted -> melting -> melted -> done, or failed.
+    def __init__(self):
+        self.id: str = ""  # the mint quote id on the target mint
+        self.source_mint: str = ""
+        self.target_mint: str = ""
+        self.amount: int = 0
+        self.invoice: str = ""
+        self.melt_quote: str = ""
+        self.fee_reserve: int = 0
+        self.inputs: list = []  # secrets of the proofs we melt
+        self.blank_outputs: list = []  # NUT-08 outputs for the melt change, see NutZapWallet.blank_outputs
+        self.state: str = "quoted"
+
+    def to_json(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_json(cls, data: dict):
+        transfer = cls()
+        transfer.__dict__.update(data)
+        return transfer
+
+
+class MeltOffer(object):
+    def __init__(self, mint, quote, inputs, cost, latency):
+        self.mint = mint
+        self.quote = quote
+        self.inputs: list = inputs
+        self.cost: int = cost  # amount + fee reserve + input fees
+        self.latency: float = latency
+
+
+class LiquidityRouter(object):
+    # Tops up a mint from our other mints. We request one invoice on the target mint and ask every mint that
+    # holds enough balance for a melt quote on it at the same time, then melt on the cheapest (or, with
+    # policy "fastest", the quickest) one. We already watch the target quote while the melt runs, so the mint
+    # follows right after the payment. Every step is saved, resume() continues transfers that were interrupted.
+    def __init__(self, nutzap_wallet, policy: str = "cheapest", quote_timeout: float = 10.0):
+        self.nutzap_wallet = nutzap_wallet
+        self.policy: str = policy
+        self.quote_timeout: float = quote_timeout
+        self.transfers: dict = {}  # used instead of the event store if we don't have one
+
+    def save(self, transfer: LiquidityTransfer, keys):
+        if self.nutzap_wallet.event_store is not None:
+            self.nutzap_wallet.event_store.save_transfer(keys.public_key().to_hex(), transfer.to_json())
+        else:
+            self.transfers[transfer.id] = transfer
+
+    def unfinished(self, keys) -> list:
+        if self.nutzap_wallet.event_store is not None:
+            return [LiquidityTransfer.from_json(data) for data in self.nutzap_wallet.event_store.load_transfers(
+                keys.public_key().to_hex(), ["quoted", "melting", "melted"])]
+        return [transfer for transfer in self.transfers.values() if transfer.state in ("quoted", "melting", "melted")]
+
+    async def quote(self, mint, invoice):
+        cashu_wallet = await self.nutzap_wallet.mint_pool.get_wallet(
+            mint.mint_url, "outgoing", keyset_ids=list(mint.proofs.keyset_balances.keys()))
+        started = time.time()
+        quote = await asyncio.wait_for(cashu_wallet.melt_quote(invoice), self.quote_timeout)
+        latency = time.time() - started
+
+        # we melt exactly amount and fee reserve, without proofs for that the melt swaps for them first
+        fees_ppk = keyset_fees(cashu_wallet)
+        selector = self.nutzap_wallet.coin_selector
+        needed = quote.amount + quote.fee_reserve
+        inputs = selector.select_exact(mint.proofs, needed, fees_ppk)
+        if inputs is None:
+            needed = self.nutzap_wallet.melt_target(cashu_wallet, needed)
+            inputs = selector.select_for_swap(mint.proofs, needed, fees_ppk)
+        if inputs is None:
+            return None
+        cost = needed + selector.input_fee(inputs, fees_ppk)
+        return MeltOffer(mint, quote, inputs, cost, latency)
+
+    async def best_offer(self, nut_wallet, target_mint_url, invoice, amount):
+        candidates = [mint for mint in nut_wallet.nutmints
+                      if mint.mint_url != target_mint_url and mint.available_balance() > amount]
+        results = await asyncio.gather(*[self.quote(mint, invoice) for mint in candidates], return_exceptions=True)
+        offers = []
+        for mint, result in zip(candidates, results):
+            if isinstance(result, Exception):
+                logger.error(bcolors.RED + "[" + mint.mint_url + "] No melt quote: " + str(result) + bcolors.ENDC)
+            elif result is not None:
+                offers.append(result)
+        if len(offers) == 0:
+            return None
+        if self.policy == "fastest":
+            return min(offers, key=lambda offer: (offer.latency, offer.cost))
+        return min(offers, key=lambda offer: (offer.cost, offer.latency))
+
+    async def move(self, nut_wallet, target_mint_url, amount, client, keys) -> bool:
+        # moves amount to target_mint_url, returns True once the new proofs are in the wallet
+        mint_quote = await self.nutzap_wallet.mint_http.request_mint_quote(target_mint_url, amount)
+        offer = await self.best_offer(nut_wallet, target_mint_url, mint_quote["request"], amount)
+        if offer is None:
+            logger.error(bcolors.RED + "[" + nut_wallet.name + "] No mint can pay " + str(amount) + " " +
+                         nut_wallet.unit + " to " + target_mint_url + bcolors.ENDC)
+            return False
+
+        transfer = LiquidityTransfer()
+        transfer.id = mint_quote["quote"]
+        transfer.source_mint = offer.mint.mint_url
+        transfer.target_mint = target_mint_url
+        transfer.amount = amount
+        transfer.invoice = mint_quote["request"]
+        transfer.melt_quote = offer.quote.quote
+        transfer.fee_reserve = offer.quote.fee_reserve
+        self.save(transfer, keys)
+        logger.info(bcolors.CYAN + "[" + nut_wallet.name + "] Moving " + str(amount) + " " + nut_wallet.unit +
+                    " from " + transfer.source_mint + " to " + target_mint_url + " (cost " + str(offer.cost) + ")" +
+                    bcolors.ENDC)
+        return await self.run(transfer, nut_wallet, client, keys)
+
+    async def run(self, transfer: LiquidityTransfer, nut_wallet, client, keys) -> bool:
+        paid = asyncio.create_task(self.nutzap_wallet.mint_http.wait_for_mint_quote(
+            transfer.target_mint, transfer.id, self.nutzap_wallet.mint_quote_timeout))
+        try:
+            if transfer.state == "quoted":
+                await self.melt(transfer, nut_wallet, client, keys)
+            if transfer.state in ("melting", "melted") and await paid:
+                await self.mint(transfer, nut_wallet, client, keys)
+        except Exception as e:
+            logger.error(bcolors.RED + "[" + transfer.source_mint + "] Transfer " + transfer.id + " failed: " + str(e) +
+                         bcolors.ENDC)
+        finally:
+            paid.cancel()
+        return transfer.state == "done"
+
+    async def melt(self, transfer: LiquidityTransfer, nut_wallet, client, keys):
+        async with self.nutzap_wallet.wallet_state.lock(nut_wallet, [transfer.source_mint]):
+            await self.melt_locked(transfer, nut_wallet, client, keys)
+
+    async def melt_locked(self, transfer: LiquidityTransfer, nut_wallet, client, keys):
+        source = self.nutzap_wallet.get_mint(nut_wallet, transfer.source_mint)
+        cashu_wallet = await self.nutzap_wallet.mint_pool.get_wallet(
+            transfer.source_mint, "outgoing", nut_wallet.privkey, list(source.proofs.keyset_balances.keys()))
+        inputs = await self.nutzap_wallet.melt_inputs(nut_wallet, transfer.source_mint, cashu_wallet,
+                                                      transfer.amount + transfer.fee_reserve, client, keys)
+        if inputs is None:
+            transfer.state = "failed"
+            self.save(transfer, keys)
+            raise Exception("balance on " + transfer.source_mint + " is too low for the transfer")
+
+        transfer.inputs = [proof.secret for proof in inputs]
+        transfer.blank_outputs = await self.nutzap_wallet.blank_outputs(cashu_wallet, transfer.fee_reserve)
+        transfer.state = "melting"
+        self.save(transfer, keys)
+        try:
+            change = await self.nutzap_wallet.melt_with_change(cashu_wallet, [proof.to_cashu() for proof in inputs],
+                                                               transfer.melt_quote, transfer.blank_outputs)
+        except Exception:
+            transfer.state = "failed"
+            self.save(transfer, keys)
+            raise
+
+        await self.nutzap_wallet.update_spend_mint_proof_event(nut_wallet, inputs, transfer.source_mint, "", None,
+                                                               None, client, keys, change)
+        transfer.state = "melted"
+        self.save(transfer, keys)
+
+    async def mint(self, transfer: LiquidityTransfer, nut_wallet, client, keys):
+        cashu_wallet = await self.nutzap_wallet.mint_pool.get_wallet(transfer.target_mint, "minter")
+        proofs = await cashu_wallet.mint(transfer.amount, transfer.id, None)
+        await self.nutzap_wallet.add_proofs_to_wallet(nut_wallet, transfer.target_mint, proofs, "created", None,
+                                                      None, client, keys)
+        transfer.state = "done"
+        self.save(transfer, keys)
+
+    async def resume(self, nut_wallet, client, keys):
+        # continues transfers that were interrupted, e.g. by a restart between melting and minting
+        for transfer in self.unfinished(keys):
+            try:
+                await self.resume_transfer(transfer, nut_wallet, client, keys)
+            except Exception as e:
+                logger.error(bcolors.RED + "[" + transfer.source_mint + "] Could not resume transfer " + transfer.id +
+                             ": " + str(e) + bcolors.ENDC)
+
+    async def resume_transfer(self, transfer: LiquidityTransfer, nut_wallet, client, keys):
+        if transfer.state == "melting":
+            # we don't know if the melt went through, the target mint does
+            quote = await self.nutzap_wallet.mint_http.get_mint_quote(transfer.target_mint, transfer.id)
+            if quote.get("state") == "ISSUED":
+                transfer.state = "done"
+                self.save(transfer, keys)
+                return
+            if not quote_is_paid(quote):
+                logger.warning(bcolors.YELLOW + "[" + transfer.source_mint + "] Transfer " + transfer.id +
+                               " is not paid yet, will check again later" + bcolors.ENDC)
+                return
+            # the inputs are spent, the source mint still has the signatures of the change for our blank outputs
+            change = await self.melt_change(transfer, nut_wallet)
+            await self.nutzap_wallet.update_spend_mint_proof_event(nut_wallet, transfer.inputs,
+                                                                   transfer.source_mint, "", None, None, client,
+                                                                   keys, change)
+            transfer.state = "melted"
+            self.save(transfer, keys)
+        await self.run(transfer, nut_wallet, client, keys)
+
+    async def melt_change(self, transfer: LiquidityTransfer, nut_wallet) -> list:
+        if len(transfer.blank_outputs) == 0:
+            return []
+        try:
+            quote = await self.nutzap_wallet.mint_http.get_melt_quote(transfer.source_mint, transfer.melt_quote)
+            source = self.nutzap_wallet.get_mint(nut_wallet, transfer.source_mint)
+            cashu_wallet = await self.nutzap_wallet.mint_pool.get_wallet(
+                transfer.source_mint, "outgoing", nut_wallet.privkey, list(source.proofs.keyset_balances.keys()))
+            try:
+                return await self.nutzap_wallet.melt_change(cashu_wallet, quote.get("change"), transfer.blank_outputs)
+            finally:
+                cashu_wallet.proofs = []
+        except Exception as e:
+            # the transfer itself went through, we only lose the change
+            logger.warning(bcolors.YELLOW + "[" + transfer.source_mint + "] Could not restore the change of transfer " +
+                           transfer.id + ": " + str(e) + bcolors.ENDC)
+            return []
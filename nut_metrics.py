@@ -0,0 +1,189 @@
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from nut_print_utils import logger
+
+current_span: ContextVar = ContextVar("nutzap_span", default=None)
+
+
+class Span(object):
+    # One timed stage of a wallet operation. operation is the name of the outermost span, so the same stage
+    # (e.g. "publish") can be told apart between a zap and a redemption.
+    def __init__(self, name: str, parent=None, labels: dict = None):
+        self.name: str = name
+        self.parent = parent
+        self.operation: str = parent.operation if parent is not None else name
+        self.labels: dict = labels if labels is not None else {}
+        self.started: float = time.perf_counter()
+        self.duration: float = 0.0
+        self.error: str = ""
+
+    def path(self) -> str:
+        return (self.parent.path() + "/" if self.parent is not None else "") + self.name
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets: tuple = buckets
+        self.counts: list = [0] * len(buckets)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class Metrics(object):
+    # Counters and latency histograms of the wallet. span() times a stage and records it in the
+    # nutzap_span_seconds histogram, failed stages also count in nutzap_span_errors_total. Finished spans are
+    # handed to the exporters, e.g. a CallbackExporter. With enabled = False spans only run their body.
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets: tuple = default_buckets, enabled: bool = True):
+        self.buckets: tuple = buckets
+        self.enabled: bool = enabled
+        self.counters: dict = {}  # (name, labels) -> value
+        self.histograms: dict = {}  # (name, labels) -> Histogram
+        self.exporters: list = []
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+        return exporter
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(self.buckets)
+        self.histograms[key].observe(value)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        if not self.enabled:
+            yield None
+            return
+        span = Span(name, current_span.get(), labels)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            current_span.reset(token)
+            span.duration = time.perf_counter() - span.started
+            self.finish(span)
+
+    def finish(self, span: Span):
+        self.observe("nutzap_span_seconds", span.duration, operation=span.operation, span=span.name)
+        if span.error != "":
+            self.inc("nutzap_span_errors_total", operation=span.operation, span=span.name, error=span.error)
+        logger.debug("%s took %.1f ms%s", span.path(), span.duration * 1000,
+                     " (" + span.error + ")" if span.error != "" else "")
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                logger.warning("Metrics exporter failed: %s", e)
+
+
+def timed(name: str):
+    # Runs an async method in a span, for objects with a metrics attribute
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            with self.metrics.span(name):
+                return await function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CallbackExporter(object):
+    # Calls callback(span) for every finished span
+    def __init__(self, callback):
+        self.callback = callback
+
+    def export(self, span: Span):
+        self.callback(span)
+
+
+class PrometheusExporter(object):
+    # Renders the counters and histograms in the Prometheus text format. serve() starts a minimal http
+    # endpoint on the running event loop that answers every request with the current metrics.
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.server = None
+
+    def export(self, span: Span):
+        return  # prometheus pulls
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.metrics.counters.items()):
+            if name not in typed:
+                lines.append("# TYPE " + name + " counter")
+                typed.add(name)
+            lines.append(name + format_labels(labels) + " " + format_value(value))
+
+        for (name, labels), histogram in sorted(self.metrics.histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append("# TYPE " + name + " histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(name + "_bucket" + format_labels(labels + (("le", format_value(bound)),)) + " " +
+                             str(cumulative))
+            lines.append(name + "_bucket" + format_labels(labels + (("le", "+Inf"),)) + " " + str(histogram.count))
+            lines.append(name + "_sum" + format_labels(labels) + " " + format_value(histogram.sum))
+            lines.append(name + "_count" + format_labels(labels) + " " + str(histogram.count))
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9464):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def handle(self, reader, writer):
+        try:
+            # we don't route, the request line and headers are only read until the empty line
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = self.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " +
+                         str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+def format_labels(labels) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") +
+                          '"' for key, value in labels) + "}"
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
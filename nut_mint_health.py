@@ -0,0 +1,179 @@
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+
+class MintUnavailableError(Exception):
+    pass
+
+
+class MintHealth(object):
+    def __init__(self, mint_url: str, window: int):
+        self.mint_url: str = mint_url
+        self.latencies: deque = deque(maxlen=window)  # seconds, successful calls only
+        self.results: deque = deque(maxlen=window)  # True for success, False for failure
+        self.calls: int = 0
+        self.failures: int = 0
+        self.consecutive_failures: int = 0
+        self.last_failure: float = 0.0
+        self.last_error: str = ""
+        self.opened_at: float = 0.0  # 0 while the circuit is closed
+        self.trial: bool = False  # a half open circuit lets one request through
+
+    def percentile(self, q: float):
+        if len(self.latencies) == 0:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def error_rate(self) -> float:
+        if len(self.results) == 0:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def to_json(self):
+        return {
+            "mint": self.mint_url,
+            "calls": self.calls,
+            "failures": self.failures,
+            "error_rate": self.error_rate(),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "last_failure": self.last_failure,
+            "last_error": self.last_error,
+            "open": self.opened_at > 0,
+        }
+
+
+class MintHealthRegistry(object):
+    # Latency and errors of every http call we make to a mint, through the cashu wallets of the MintSessionPool
+    # and through the MintHttpClient. After failure_threshold failures in a row the circuit of the mint opens:
+    # calls fail immediately with MintUnavailableError instead of waiting for a timeout. After reset_timeout
+    # seconds one call is let through again, if it succeeds the circuit closes.
+    # score() ranks mints for selection, mints with an open circuit score 0.
+    def __init__(self, window: int = 100, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.window: int = window
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self.mints: dict = {}
+        self.wallet_classes: dict = {}
+
+    def get(self, mint_url: str) -> MintHealth:
+        mint_url = mint_url.rstrip("/")
+        if mint_url not in self.mints:
+            self.mints[mint_url] = MintHealth(mint_url, self.window)
+        return self.mints[mint_url]
+
+    def mint_of(self, url) -> str:
+        # the known mint url with the longest common prefix, mints may live under a path
+        url = str(url)
+        matches = [mint_url for mint_url in self.mints if url.startswith(mint_url + "/") or url == mint_url]
+        if len(matches) > 0:
+            return max(matches, key=len)
+        parts = urlsplit(url)
+        return parts.scheme + "://" + parts.netloc
+
+    def record(self, mint_url: str, latency: float, ok: bool, error: str = ""):
+        health = self.get(mint_url)
+        health.calls += 1
+        health.results.append(ok)
+        health.trial = False
+        if ok:
+            health.latencies.append(latency)
+            health.consecutive_failures = 0
+            health.opened_at = 0.0
+            return
+        health.failures += 1
+        health.consecutive_failures += 1
+        health.last_failure = time.time()
+        health.last_error = error
+        if health.consecutive_failures >= self.failure_threshold:
+            health.opened_at = time.time()
+
+    def is_available(self, mint_url: str) -> bool:
+        health = self.get(mint_url)
+        if health.opened_at == 0:
+            return True
+        return time.time() - health.opened_at >= self.reset_timeout
+
+    def allow_request(self, mint_url: str) -> bool:
+        health = self.get(mint_url)
+        if health.opened_at == 0:
+            return True
+        if time.time() - health.opened_at < self.reset_timeout or health.trial:
+            return False
+        health.trial = True
+        return True
+
+    def score(self, mint_url: str) -> float:
+        # between 0 and 1, higher is better: success rate, discounted by the median latency
+        if not self.is_available(mint_url):
+            return 0.0
+        health = self.get(mint_url)
+        median = health.percentile(0.5)
+        return (1.0 - health.error_rate()) / (1.0 + (median if median is not None else 0.0))
+
+    def rank(self, mint_urls: list) -> list:
+        # available mints, best first, mints with the same score keep their order
+        available = [mint_url for mint_url in mint_urls if self.is_available(mint_url)]
+        return sorted(available, key=lambda mint_url: -self.score(mint_url))
+
+    def stats(self) -> list:
+        return [health.to_json() for health in self.mints.values()]
+
+    def instrument(self, client, mint_url: str = None):
+        # Routes the requests of an httpx client through the registry. Without mint_url, the mint is
+        # taken from the request url.
+        if not isinstance(client._transport, HealthTransport):
+            client._transport = HealthTransport(client._transport, self, mint_url)
+        return client
+
+    def wallet_class(self, wallet_class):
+        # The cashu wallet creates a new httpx client for every call to the mint, this subclass instruments
+        # each of them when it is assigned.
+        if wallet_class not in self.wallet_classes:
+            registry = self
+
+            def get_httpx(wallet):
+                return wallet.__dict__.get("_tracked_httpx")
+
+            def set_httpx(wallet, client):
+                wallet.__dict__["_tracked_httpx"] = registry.instrument(client, wallet.url)
+
+            self.wallet_classes[wallet_class] = type("Tracked" + wallet_class.__name__, (wallet_class,),
+                                                     {"httpx": property(get_httpx, set_httpx)})
+        return self.wallet_classes[wallet_class]
+
+
+class HealthTransport(object):
+    # wraps the transport of an httpx.AsyncClient
+    def __init__(self, transport, registry: MintHealthRegistry, mint_url: str = None):
+        self.transport = transport
+        self.registry = registry
+        self.mint_url = mint_url
+
+    async def handle_async_request(self, request):
+        mint_url = self.mint_url if self.mint_url is not None else self.registry.mint_of(request.url)
+        if not self.registry.allow_request(mint_url):
+            raise MintUnavailableError(mint_url + " is unavailable, " + self.registry.get(mint_url).last_error)
+        started = time.monotonic()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception as e:
+            self.registry.record(mint_url, time.monotonic() - started, False, type(e).__name__ + ": " + str(e))
+            raise
+        ok = response.status_code < 500
+        self.registry.record(mint_url, time.monotonic() - started, ok,
+                             "" if ok else "HTTP " + str(response.status_code))
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    async def __aenter__(self):
+        await self.transport.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type=None, exc_value=None, traceback=None):
+        await self.transport.__aexit__(exc_type, exc_value, traceback)
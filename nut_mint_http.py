@@ -0,0 +1,131 @@
+import asyncio
+import json
+import time
+import uuid
+
+from nut_print_utils import logger
+
+
+def quote_is_paid(quote: dict) -> bool:
+    # older mints report a "paid" flag, newer ones a "state"
+    return quote.get("paid", False) or quote.get("state") in ("PAID", "ISSUED")
+
+
+class MintHttpClient(object):
+    # Shared async http client for the calls we make to mints ourselves (the cashu wallets use their own).
+    # Connections are kept alive between calls, so quote, status and mint requests to the same mint
+    # reuse one connection and never block the event loop.
+    def __init__(self, timeout: float = 10.0, max_connections: int = 20, health=None):
+        self.timeout: float = timeout
+        self.max_connections: int = max_connections
+        self.health = health
+        self.client = None  # created on first use, so importing the wallet doesn't import httpx
+        self.poll_interval: float = 0.25  # first delay between status checks, grows up to poll_interval_max
+        self.poll_interval_max: float = 5.0
+        self.mint_infos: dict = {}
+
+    @property
+    def http(self):
+        if self.client is None:
+            import httpx
+
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                headers={"Content-Type": "application/json; charset=utf-8"},
+            )
+            if self.health is not None:
+                self.health.instrument(self.client)
+        return self.client
+
+    async def get_mint_info(self, mint_url) -> dict:
+        if mint_url not in self.mint_infos:
+            response = await self.http.get(mint_url + "/v1/info")
+            response.raise_for_status()
+            self.mint_infos[mint_url] = response.json()
+        return self.mint_infos[mint_url]
+
+    async def request_mint_quote(self, mint_url, amount, unit="sat") -> dict:
+        response = await self.http.post(mint_url + "/v1/mint/quote/bolt11", json={"unit": unit, "amount": amount})
+        response.raise_for_status()
+        return response.json()
+
+    async def get_mint_quote(self, mint_url, quote_id) -> dict:
+        response = await self.http.get(mint_url + "/v1/mint/quote/bolt11/" + quote_id)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_melt_quote(self, mint_url, quote_id) -> dict:
+        # once the quote is paid it holds the signatures of the melt change (NUT-08)
+        response = await self.http.get(mint_url + "/v1/melt/quote/bolt11/" + quote_id)
+        response.raise_for_status()
+        return response.json()
+
+    async def check_proof_states(self, mint_url, ys: list) -> dict:
+        # NUT-07: the state (UNSPENT, PENDING or SPENT) of each Y = hash_to_curve(secret), by Y
+        response = await self.http.post(mint_url + "/v1/checkstate", json={"Ys": ys})
+        response.raise_for_status()
+        return {state["Y"]: state["state"] for state in response.json()["states"]}
+
+    async def supports_websockets(self, mint_url) -> bool:
+        try:
+            info = await self.get_mint_info(mint_url)
+        except Exception:
+            return False
+        nut17 = info.get("nuts", {}).get("17", {})
+        for method in nut17.get("supported", []):
+            if "bolt11_mint_quote" in method.get("commands", []):
+                return True
+        return False
+
+    async def wait_for_mint_quote(self, mint_url, quote_id, timeout: float = 60.0) -> bool:
+        # Waits until the invoice of a mint quote is paid. Uses NUT-17 websockets if the mint supports them,
+        # otherwise polls with a growing interval. Returns False if the quote wasn't paid within timeout.
+        deadline = time.monotonic() + timeout
+        if await self.supports_websockets(mint_url):
+            try:
+                return await asyncio.wait_for(self.wait_for_mint_quote_ws(mint_url, quote_id), timeout)
+            except asyncio.TimeoutError:
+                return False
+            except Exception as e:
+                logger.warning("[" + mint_url + "] Websocket subscription failed, polling instead: " + str(e))
+
+        delay = self.poll_interval
+        while True:
+            if quote_is_paid(await self.get_mint_quote(mint_url, quote_id)):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 1.5, self.poll_interval_max)
+
+    async def wait_for_mint_quote_ws(self, mint_url, quote_id) -> bool:
+        import websockets
+
+        ws_url = mint_url.replace("https://", "wss://", 1).replace("http://", "ws://", 1) + "/v1/ws"
+        sub_id = str(uuid.uuid4())
+        async with websockets.connect(ws_url) as websocket:
+            await websocket.send(json.dumps({
+                "jsonrpc": "2.0",
+                "id": 0,
+                "method": "subscribe",
+                "params": {"kind": "bolt11_mint_quote", "subId": sub_id, "filters": [quote_id]}
+            }))
+            # the quote might have been paid before the subscription was active
+            if quote_is_paid(await self.get_mint_quote(mint_url, quote_id)):
+                return True
+            async for message in websocket:
+                notification = json.loads(message)
+                if "error" in notification:
+                    raise Exception(notification["error"])
+                params = notification.get("params", {})
+                if params.get("subId") == sub_id and quote_is_paid(params.get("payload", {})):
+                    return True
+        return False
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
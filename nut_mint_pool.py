@@ -0,0 +1,107 @@
+import asyncio
+import copy
+import time
+from collections import OrderedDict
+
+from nut_metrics import Metrics, timed
+
+
+class MintSession(object):
+    def __init__(self, wallet, loaded_at: float):
+        self.wallet = wallet
+        self.loaded_at: float = loaded_at
+
+
+class MintSessionPool(object):
+    # Loaded cashu wallets per mint url and role. Opening the wallet database and loading the mint
+    # (/v1/info, /v1/keysets, /v1/keys) happens once per session, keysets are only reloaded when the
+    # ttl expired or when we see a keyset id the session doesn't know yet.
+    # Wallets that sign with a private key (receiving P2PK locked nutzaps) get a session per key, so wallets
+    # of different users never share a key. They are copied from the keyless session of the same mint and
+    # role, sharing its database and keysets instead of loading the mint again, and only the
+    # max_keyed_sessions most recently used ones are kept.
+    roles = {
+        # role: (database, wallet name)
+        "minter": ("db/Cashu", "no_name"),
+        "sender": ("db/Cashu", "wallet_mint_api"),
+        "receiver": ("db/Receiver", "receiver"),
+        "outgoing": ("db/Cashu", "outgoing"),
+        "incoming": ("db/Cashu", "incoming"),
+    }
+
+    def __init__(self, keyset_ttl: int = 600, health=None, metrics: Metrics = None, max_keyed_sessions: int = 1000):
+        self.keyset_ttl: int = keyset_ttl  # seconds
+        self.max_keyed_sessions: int = max_keyed_sessions
+        self.health = health  # optional MintHealthRegistry that tracks the calls of our cashu wallets
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.sessions: dict = {}  # (mint url, role, private key or None) -> MintSession
+        self.templates: dict = {}  # (mint url, role) -> the keyless MintSession, keyed sessions are copied from it
+        self.keyed: OrderedDict = OrderedDict()  # keys of sessions with a private key, least recently used first
+        self.locks: dict = {}
+
+    @timed("mint_session")
+    async def get_wallet(self, mint_url, role, privkey=None, keyset_ids=None):
+        from cashu.wallet.wallet import Wallet
+        from cashu.core.crypto.keys import PrivateKey
+
+        key = (mint_url, role, privkey)
+        lock = self.locks.setdefault((mint_url, role), asyncio.Lock())
+        async with lock:
+            session = self.sessions.get(key)
+            if session is None:
+                template = self.templates.get((mint_url, role))
+                if template is None:
+                    db, name = self.roles[role]
+                    wallet_class = Wallet if self.health is None else self.health.wallet_class(Wallet)
+                    cashu_wallet = await wallet_class.with_db(
+                        url=mint_url,
+                        db=db,
+                        name=name,
+                    )
+                    await cashu_wallet.load_mint()
+                    template = MintSession(cashu_wallet, time.monotonic())
+                    self.templates[(mint_url, role)] = template
+                if privkey is None:
+                    session = template
+                else:
+                    cashu_wallet = copy.copy(template.wallet)
+                    cashu_wallet.proofs = []
+                    cashu_wallet.keysets = dict(template.wallet.keysets)
+                    cashu_wallet.private_key = PrivateKey(bytes.fromhex(privkey), raw=True)
+                    session = MintSession(cashu_wallet, template.loaded_at)
+                self.sessions[key] = session
+            else:
+                expired = time.monotonic() - session.loaded_at > self.keyset_ttl
+                unknown_keyset = keyset_ids is not None and any(
+                    keyset_id not in session.wallet.keysets for keyset_id in keyset_ids)
+                if expired or unknown_keyset:
+                    await self.refresh_keysets(session)
+
+            # cashu adds every proof it mints, swaps or redeems to wallet.proofs, our proofs live in the
+            # NutWallet, so a long lived session must not collect them. Keyed sessions are emptied by the operations
+            # that use them instead, a melt reads the list while the same key may be checked out again.
+            if privkey is None:
+                session.wallet.proofs = []
+
+            if privkey is not None:
+                self.keyed[key] = True
+                self.keyed.move_to_end(key)
+                while len(self.keyed) > self.max_keyed_sessions:
+                    evicted, _ = self.keyed.popitem(last=False)
+                    self.sessions.pop(evicted, None)
+            return session.wallet
+
+    async def refresh_keysets(self, session: MintSession):
+        await session.wallet.load_mint_keysets()
+        await session.wallet.activate_keyset()
+        session.loaded_at = time.monotonic()
+
+    def invalidate(self, mint_url, role=None):
+        # drop sessions of a mint, e.g. after the mint rotated its keys or returned errors
+        for key in list(self.sessions.keys()):
+            if key[0] == mint_url and (role is None or key[1] == role):
+                del self.sessions[key]
+                self.keyed.pop(key, None)
+        for key in list(self.templates.keys()):
+            if key[0] == mint_url and (role is None or key[1] == role):
+                del self.templates[key]
@@ -0,0 +1,150 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from nostr_sdk import Filter, Kind, PublicKey, HandleNotification, Timestamp
+
+from nut_print_utils import bcolors, logger
+
+
+class MintPreference(object):
+    # The nutzap info (kind 10019) of a recipient: the key to lock proofs to, trusted mints and relays
+    def __init__(self, pubkey: str):
+        self.pubkey: str = pubkey
+        self.p2pk_pubkey: str = ""
+        self.mints: list = []
+        self.relays: list = []
+        self.created_at: int = 0  # created_at of the event, 0 if the user has no 10019 event
+        self.fetched_at: float = 0.0
+
+    @classmethod
+    def from_event(cls, event):
+        preference = cls(event.author().to_hex())
+        preference.created_at = event.created_at().as_secs()
+        for tag in event.tags().to_vec():
+            if tag.as_vec()[0] == "pubkey":
+                preference.p2pk_pubkey = tag.as_vec()[1]
+            elif tag.as_vec()[0] == "relay":
+                preference.relays.append(tag.as_vec()[1])
+            elif tag.as_vec()[0] == "mint":
+                preference.mints.append(tag.as_vec()[1])
+        return preference
+
+
+class MintPreferenceCache(object):
+    # Caches the 10019 events of nutzap recipients, so repeated zaps to the same users skip the relay query.
+    # Entries expire after ttl seconds. With subscribe() we additionally follow the 10019 events of all cached
+    # authors, so a changed preference replaces the cached one as soon as a relay delivers it.
+    def __init__(self, ttl: float = 3600, timeout: timedelta = timedelta(seconds=5), max_authors_per_filter: int = 500):
+        self.ttl: float = ttl
+        self.timeout: timedelta = timeout
+        self.max_authors_per_filter: int = max_authors_per_filter  # relays limit the size of a filter
+        self.entries: dict = {}
+        self.subscription_id: str = "nutzap-mint-preferences"  # prefix, every chunk of authors has its own
+        self.subscribed_authors: set = set()
+        self.subscribed_chunks: list = []  # the authors of each subscription, at most max_authors_per_filter
+        self.client = None
+        self.lock = asyncio.Lock()
+
+    def is_fresh(self, preference: MintPreference) -> bool:
+        return time.time() - preference.fetched_at < self.ttl
+
+    async def get(self, pubkey: str, client) -> MintPreference:
+        preference = self.entries.get(pubkey)
+        if preference is not None and self.is_fresh(preference):
+            return preference
+        await self.prefetch([pubkey], client)
+        return self.entries[pubkey]
+
+    async def prefetch(self, pubkeys: list, client):
+        # fetches the preferences of all pubkeys that are not cached, or expired, with one relay query
+        pubkeys = [pubkey for pubkey in set(pubkeys)
+                   if pubkey not in self.entries or not self.is_fresh(self.entries[pubkey])]
+        if len(pubkeys) == 0:
+            return
+
+        events = await client.fetch_events(self.mint_info_filters(pubkeys), self.timeout)
+        fetched_at = time.time()
+        for pubkey in pubkeys:
+            # users without a 10019 event are cached too, we learn about a new one from the subscription
+            if pubkey not in self.entries or self.entries[pubkey].created_at == 0:
+                self.entries[pubkey] = MintPreference(pubkey)
+            self.entries[pubkey].fetched_at = fetched_at
+        for event in events.to_vec():
+            self.update(event, fetched_at)
+
+        if self.client is not None:
+            await self.resubscribe()
+
+    def mint_info_filters(self, pubkeys) -> list:
+        pubkeys = [PublicKey.parse(pubkey) for pubkey in pubkeys]
+        return [Filter().kind(Kind(10019)).authors(pubkeys[start:start + self.max_authors_per_filter])
+                for start in range(0, len(pubkeys), self.max_authors_per_filter)]
+
+    def update(self, event, fetched_at: float = None) -> bool:
+        # Keeps the newest 10019 event per author, returns True if the cached preference changed
+        preference = MintPreference.from_event(event)
+        cached = self.entries.get(preference.pubkey)
+        if cached is not None and cached.created_at >= preference.created_at:
+            return False
+        preference.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self.entries[preference.pubkey] = preference
+        return True
+
+    def invalidate(self, pubkey: str = None):
+        if pubkey is None:
+            self.entries = {}
+        else:
+            self.entries.pop(pubkey, None)
+
+    async def subscribe(self, client):
+        # Starts following the 10019 events of cached authors, new authors are added on prefetch
+        self.client = client
+        await self.resubscribe()
+
+        cache = self
+
+        class MintPreferenceHandler(HandleNotification):
+            async def handle(self, relay_url, subscription_id, event):
+                if subscription_id.startswith(cache.subscription_id) and event.kind().as_u16() == 10019:
+                    if cache.update(event):
+                        logger.info(bcolors.CYAN + "[Nutzap] Updated mint preferences of " + event.author().to_hex() +
+                                    bcolors.ENDC)
+
+            async def handle_msg(self, relay_url, msg):
+                return
+
+        asyncio.create_task(client.handle_notifications(MintPreferenceHandler()))
+
+    async def resubscribe(self):
+        # New authors join the last chunk that has room (or a new one), so only the subscriptions of the chunks
+        # that changed are sent again, not every author we follow
+        async with self.lock:
+            new_authors = [author for author in self.entries.keys() if author not in self.subscribed_authors]
+            if len(new_authors) == 0:
+                return
+            chunks = [set(chunk) for chunk in self.subscribed_chunks]
+            changed = []
+            for author in new_authors:
+                if len(chunks) == 0 or len(chunks[-1]) >= self.max_authors_per_filter:
+                    chunks.append(set())
+                chunks[-1].add(author)
+                if len(changed) == 0 or changed[-1] != len(chunks) - 1:
+                    changed.append(len(chunks) - 1)
+
+            # subscribing with the same id replaces the previous filter of the chunk on the relays
+            since = Timestamp.now()
+            try:
+                for index in changed:
+                    mint_info_filter = self.mint_info_filters(chunks[index])[0].since(since)
+                    await self.client.subscribe_with_id(self.chunk_subscription_id(index), [mint_info_filter], None)
+                    if index < len(self.subscribed_chunks):
+                        self.subscribed_chunks[index] = chunks[index]
+                    else:
+                        self.subscribed_chunks.append(chunks[index])
+                    self.subscribed_authors |= chunks[index]
+            except Exception as e:
+                logger.error(bcolors.RED + "Could not subscribe to mint preferences: " + str(e) + bcolors.ENDC)
+
+    def chunk_subscription_id(self, index: int) -> str:
+        return self.subscription_id + "-" + str(index)
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from nostr_sdk import Event
+
+from nut_metrics import Metrics
+from nut_print_utils import bcolors, logger
+
+
+class NutEventOutbox(object):
+    # Write-ahead outbox for the signed wallet events. The events of an operation are journaled in the event
+    # store in one transaction together with their local copy, and the operation continues as soon as that
+    # is done. A background publisher sends them to the relays of the client and retries the relays that
+    # didn't acknowledge an event, waiting min_backoff seconds after the first failure and twice as long after
+    # each further one, up to max_backoff. Events left in the outbox by an earlier run are published on start().
+    # The events are signed already, so one client can publish the events of all keys.
+    def __init__(self, event_store, min_backoff: float = 1.0, max_backoff: float = 300.0, batch_size: int = 100,
+                 metrics: Metrics = None):
+        self.event_store = event_store
+        self.min_backoff: float = min_backoff
+        self.max_backoff: float = max_backoff
+        self.batch_size: int = batch_size
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.client = None
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+    def start(self, client):
+        # starts the publisher, which first publishes what earlier runs left in the outbox
+        self.client = client
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def journal(self, events: list, contents: dict, client):
+        # contents holds the decrypted content of events by event id
+        if len(events) == 0:
+            return
+        relays = list((await client.relays()).keys())
+        self.event_store.journal_events(events, contents, relays, time.time())
+        self.metrics.inc("nutzap_outbox_journaled_total", len(events))
+        if self.client is None:
+            self.start(client)
+        else:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.publish_due()
+            except Exception as e:
+                logger.error(bcolors.RED + "Outbox publisher failed: " + str(e) + bcolors.ENDC)
+            next_attempt = self.event_store.next_outbox_attempt()
+            timeout = None if next_attempt is None else max(0.0, next_attempt - time.time())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def publish_due(self):
+        async with self.lock:
+            while True:
+                rows = self.event_store.load_outbox(time.time(), self.batch_size)
+                if len(rows) == 0:
+                    return
+                # the relays in the client's pool, relays that were removed since the event was journaled are dropped
+                pool = list((await self.client.relays()).keys())
+                await asyncio.gather(*[self.publish(event_id, raw, relays, attempts, pool)
+                                       for event_id, raw, relays, attempts in rows])
+
+    async def publish(self, event_id: str, raw: str, relays: list, attempts: int, pool: list):
+        targets = [relay for relay in relays if relay in pool]
+        left = targets
+        if len(targets) > 0:
+            try:
+                output = await self.client.send_event_to(targets, Event.from_json(raw))
+                left = [relay for relay in targets if relay not in output.output.success]
+                for relay, error in output.output.failed.items():
+                    logger.debug("[%s] Could not publish %s: %s", relay, event_id, error)
+            except Exception as e:
+                logger.debug("Could not publish %s: %s", event_id, e)
+
+        if len(left) == 0:
+            self.metrics.inc("nutzap_outbox_published_total")
+            self.event_store.update_outbox(event_id, [], attempts, 0)
+            return
+        attempts += 1
+        backoff = min(self.max_backoff, self.min_backoff * 2 ** (attempts - 1))
+        self.metrics.inc("nutzap_outbox_retries_total")
+        if attempts == 1 or backoff == self.max_backoff:
+            logger.warning(bcolors.YELLOW + "Event " + event_id + " not acknowledged by " + ", ".join(left) +
+                           ", retrying in " + str(round(backoff, 1)) + "s" + bcolors.ENDC)
+        self.event_store.update_outbox(event_id, left, attempts, time.time() + backoff)
+
+    async def drain(self, timeout: float = 10.0) -> bool:
+        # Publishes the outbox and waits for the retries until it is empty or timeout seconds passed,
+        # for processes that exit after an operation. Returns True if everything was published.
+        if self.client is None:
+            return self.event_store.count_outbox() == 0
+        deadline = time.time() + timeout
+        while True:
+            await self.publish_due()
+            next_attempt = self.event_store.next_outbox_attempt()
+            if next_attempt is None:
+                return True
+            if next_attempt > deadline:
+                logger.warning(bcolors.YELLOW + str(self.event_store.count_outbox()) +
+                               " events are not published yet, they are retried on the next start" + bcolors.ENDC)
+                return False
+            await asyncio.sleep(max(0.0, next_attempt - time.time()))
@@ -0,0 +1,23 @@
+import logging
+
+
+class bcolors:
+    # same colors as nostr_dvm's print utils, so the wallet doesn't need to import nostr_dvm for them
+    HEADER = '\033[95m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+    RED = '\033[91m'
+    GREEN = '\033[92m'
+    BLUE = '\033[94m'
+    CYAN = '\033[96m'
+    WHITE = '\033[97m'
+    YELLOW = '\033[93m'
+    MAGENTA = '\033[95m'
+    GREY = '\033[90m'
+
+
+# Everything the wallet modules report goes through this logger, the scripts show it with
+# logging.basicConfig(level=logging.INFO, format="%(message)s"). Debug messages include proof dumps
+# and span timings.
+logger = logging.getLogger("nutzap")
@@ -0,0 +1,154 @@
+class NutProof(object):
+    # Compact proof record, we only keep what is stored in the 7375 events. Converted to a cashu Proof
+    # only when it is handed to the mint.
+    __slots__ = ("id", "amount", "secret", "C")
+
+    def __init__(self, id: str, amount: int, secret: str, C: str):
+        self.id = id
+        self.amount = amount
+        self.secret = secret
+        self.C = C
+
+    @classmethod
+    def from_json(cls, proof: dict):
+        return cls(proof['id'], int(proof['amount']), proof['secret'], proof['C'])
+
+    @classmethod
+    def from_proof(cls, proof):
+        # accepts a NutProof, a cashu Proof or a proof dict
+        if isinstance(proof, NutProof):
+            return proof
+        if isinstance(proof, dict):
+            return cls.from_json(proof)
+        return cls(proof.id, int(proof.amount), proof.secret, proof.C)
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "amount": self.amount,
+            "secret": self.secret,
+            "C": self.C
+        }
+
+    def to_cashu(self):
+        from cashu.core.base import Proof
+        return Proof(id=self.id, amount=self.amount, secret=self.secret, C=self.C)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "NutProof(id=" + self.id + ", amount=" + str(self.amount) + ")"
+
+
+class ProofStore(object):
+    # Proofs of one mint, indexed by secret. Balances per keyset and the number of proofs per
+    # denomination are updated on every change, so they never require a scan over all proofs.
+    # We also track which proof event (chunk) holds each proof, proofs that are not published yet have no chunk.
+    def __init__(self, proofs=None):
+        self.proofs: dict = {}
+        self.balance: int = 0
+        self.keyset_balances: dict = {}
+        self.denominations: dict = {}
+        self.chunks: dict = {}  # event id -> set of secrets
+        self.chunk_of: dict = {}  # secret -> event id
+        self.unsaved: set = set()  # secrets without a chunk
+        if proofs is not None:
+            self.add_all(proofs)
+
+    def add(self, proof, chunk_id: str = None) -> int:
+        # returns the amount that was added, 0 if we already know the secret
+        proof = NutProof.from_proof(proof)
+        if proof.secret in self.proofs:
+            return 0
+        self.proofs[proof.secret] = proof
+        if chunk_id is not None:
+            self.chunks.setdefault(chunk_id, set()).add(proof.secret)
+            self.chunk_of[proof.secret] = chunk_id
+        else:
+            self.unsaved.add(proof.secret)
+        self.balance += proof.amount
+        self.keyset_balances[proof.id] = self.keyset_balances.get(proof.id, 0) + proof.amount
+        self.denominations[proof.amount] = self.denominations.get(proof.amount, 0) + 1
+        return proof.amount
+
+    def add_all(self, proofs) -> int:
+        amount = 0
+        for proof in proofs:
+            amount += self.add(proof)
+        return amount
+
+    def remove(self, secret: str):
+        proof = self.proofs.pop(secret, None)
+        if proof is None:
+            return None
+        chunk_id = self.chunk_of.pop(secret, None)
+        if chunk_id is not None:
+            self.chunks[chunk_id].discard(secret)
+        self.unsaved.discard(secret)
+        self.balance -= proof.amount
+        self.keyset_balances[proof.id] -= proof.amount
+        if self.keyset_balances[proof.id] == 0:
+            del self.keyset_balances[proof.id]
+        self.denominations[proof.amount] -= 1
+        if self.denominations[proof.amount] == 0:
+            del self.denominations[proof.amount]
+        return proof
+
+    def remove_all(self, proofs) -> int:
+        # accepts proofs or secrets, returns the amount that was removed
+        amount = 0
+        for proof in proofs:
+            secret = proof if isinstance(proof, str) else proof.secret
+            removed = self.remove(secret)
+            if removed is not None:
+                amount += removed.amount
+        return amount
+
+    def get(self, secret: str):
+        return self.proofs.get(secret)
+
+    def chunks_of(self, proofs) -> set:
+        # the chunks that hold the given proofs or secrets
+        chunk_ids = set()
+        for proof in proofs:
+            secret = proof if isinstance(proof, str) else proof.secret
+            if secret in self.chunk_of:
+                chunk_ids.add(self.chunk_of[secret])
+        return chunk_ids
+
+    def assign_chunk(self, chunk_id: str, secrets):
+        self.chunks[chunk_id] = set(secrets)
+        for secret in secrets:
+            self.chunk_of[secret] = chunk_id
+            self.unsaved.discard(secret)
+
+    def drop_chunk(self, chunk_id: str) -> list:
+        # forgets a chunk and returns the secrets it held, the proofs themselves stay in the store unsaved
+        secrets = list(self.chunks.pop(chunk_id, set()))
+        for secret in secrets:
+            if self.chunk_of.get(secret) == chunk_id:
+                del self.chunk_of[secret]
+                self.unsaved.add(secret)
+        return secrets
+
+    def unassigned(self) -> list:
+        return list(self.unsaved)
+
+    def to_json(self):
+        return [proof.to_json() for proof in self.proofs.values()]
+
+    def to_cashu(self):
+        return [proof.to_cashu() for proof in self.proofs.values()]
+
+    def __contains__(self, secret):
+        return secret in self.proofs
+
+    def __iter__(self):
+        return iter(self.proofs.values())
+
+    def __len__(self):
+        return len(self.proofs)
+
+    def __repr__(self):
+        return "ProofStore(proofs=" + str(len(self.proofs)) + ", balance=" + str(self.balance) + ")"
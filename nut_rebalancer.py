@@ -0,0 +1,152 @@
+import asyncio
+import time
+
+from nut_print_utils import bcolors, logger
+
+from nut_coin_selection import keyset_fees
+
+
+class DenominationRebalancer(object):
+    # Keeps a pool of send ready proofs per mint: target_count proofs of each power of two up to max_denomination.
+    # Whenever the wallet has been idle for idle_time seconds we swap surplus proofs into the denominations we are
+    # short of, so sends find matching proofs and don't have to split them at the mint first.
+    # The new proofs are published through the normal proof event update.
+    def __init__(self, nutzap_wallet, client, keys, target_count: int = 3, max_denomination: int = 1024,
+                 idle_time: float = 30, interval: float = 60, max_inputs: int = 50):
+        self.nutzap_wallet = nutzap_wallet
+        self.client = client
+        self.keys = keys
+        self.target_count: int = target_count
+        self.max_denomination: int = max_denomination
+        self.idle_time: float = idle_time
+        self.interval: float = interval
+        self.max_inputs: int = max_inputs
+        self.task = None
+        self.rebalancing: bool = False
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Cancels the task while it waits for the next round. A running rebalance is awaited instead, cancelled
+        # between the swap and the proof event update it would lose the new proofs.
+        task = self.task
+        if task is None:
+            return
+        self.task = None
+        if not self.rebalancing:
+            task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def run(self):
+        while self.task is not None:
+            await asyncio.sleep(self.interval)
+            if time.time() - self.nutzap_wallet.last_activity < self.idle_time:
+                continue
+            self.rebalancing = True
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.error(bcolors.RED + "Could not rebalance proofs: " + str(e) + bcolors.ENDC)
+            finally:
+                self.rebalancing = False
+
+    async def rebalance(self):
+        nut_wallet = await self.nutzap_wallet.get_nut_wallet(self.client, self.keys)
+        if nut_wallet is None:
+            return
+        for mint in list(nut_wallet.nutmints):
+            # stop as soon as the wallet is used again or we shut down, the next idle period continues with the
+            # other mints
+            if self.task is None or time.time() - self.nutzap_wallet.last_activity < self.idle_time:
+                return
+            await self.rebalance_mint(nut_wallet, mint)
+
+    async def rebalance_mint(self, nut_wallet, mint):
+        async with self.nutzap_wallet.wallet_state.lock(nut_wallet, [mint.mint_url]):
+            await self.rebalance_mint_locked(nut_wallet, self.nutzap_wallet.get_mint(nut_wallet, mint.mint_url))
+
+    async def rebalance_mint_locked(self, nut_wallet, mint):
+        if len(mint.proofs) == 0:
+            return
+        cashu_wallet = await self.nutzap_wallet.mint_pool.get_wallet(
+            mint.mint_url, "sender", keyset_ids=list(mint.proofs.keyset_balances.keys()))
+        fees_ppk = keyset_fees(cashu_wallet)
+        plan = self.plan(mint.proofs, fees_ppk)
+        if plan is None:
+            return
+        inputs, amounts = plan
+
+        logger.info(bcolors.CYAN + "[" + nut_wallet.name + "] Rebalancing " + str(len(inputs)) + " proofs on " +
+                    mint.mint_url + " into " + str(sorted(amounts)) + bcolors.ENDC)
+        new_proofs = await self.nutzap_wallet.swap_to_amounts(cashu_wallet, [proof.to_cashu() for proof in inputs],
+                                                              amounts)
+        await self.nutzap_wallet.update_spend_mint_proof_event(nut_wallet, inputs, mint.mint_url, "", None, None,
+                                                               self.client, self.keys, new_proofs)
+
+    def wanted(self, denominations: dict) -> list:
+        # the denominations we are short of, smallest first
+        wanted = []
+        denomination = 1
+        while denomination <= self.max_denomination:
+            wanted += [denomination] * max(0, self.target_count - denominations.get(denomination, 0))
+            denomination *= 2
+        return wanted
+
+    def plan(self, proofs, fees_ppk: dict = None):
+        # Returns (input proofs, output amounts) for one swap or None if the mint's proofs are balanced
+        # or there is nothing to swap them from.
+        wanted = self.wanted(proofs.denominations)
+        if len(wanted) == 0:
+            return None
+
+        # Surplus are proofs above the target count of their denomination and proofs above max_denomination.
+        # If that's not enough we also break up other proofs that are larger than what we are short of.
+        seen = {}
+        surplus = []
+        others = []
+        for proof in sorted(proofs, key=lambda proof: proof.amount, reverse=True):
+            seen[proof.amount] = seen.get(proof.amount, 0) + 1
+            if proof.amount > self.max_denomination or seen[proof.amount] > self.target_count:
+                surplus.append(proof)
+            elif proof.amount > wanted[0]:
+                others.append(proof)
+
+        # the smallest proof that covers everything we want, otherwise the largest ones until it's covered
+        input_fee = self.nutzap_wallet.coin_selector.input_fee
+        needed = sum(wanted)
+        inputs = []
+        for candidates in (surplus, others):
+            covering = [proof for proof in candidates if proof.amount >= needed + input_fee([proof], fees_ppk)]
+            if len(covering) > 0:
+                inputs = [covering[-1]]
+                break
+        if len(inputs) == 0:
+            for proof in surplus + others:
+                if len(inputs) >= self.max_inputs or \
+                        sum(proof.amount for proof in inputs) >= needed + input_fee(inputs, fees_ppk):
+                    break
+                inputs.append(proof)
+
+        total = sum(proof.amount for proof in inputs) - input_fee(inputs, fees_ppk)
+        amounts = []
+        for denomination in wanted:
+            if sum(amounts) + denomination > total:
+                break
+            amounts.append(denomination)
+        # a swap that doesn't fill any gap would only cost fees
+        if len(amounts) == 0:
+            return None
+        remaining = total - sum(amounts)
+        bit = 1
+        while remaining > 0:
+            if remaining & bit:
+                amounts.append(bit)
+                remaining -= bit
+            bit *= 2
+
+        return inputs, amounts
@@ -0,0 +1,149 @@
+import asyncio
+from datetime import timedelta
+
+from nostr_sdk import Alphabet, Filter, HandleNotification, Kind, SingleLetterTag, Timestamp
+
+from nut_print_utils import bcolors, logger
+
+
+class NutzapReceiver(object):
+    # Receives the nutzaps (9321) sent to us on our mints without gaps between runs. We keep a checkpoint of the
+    # created_at (and event id) up to which every nutzap was processed. On start the live subscription begins
+    # at the current time, then each relay is backfilled from the checkpoint to that time, page by page with
+    # since/until. Nutzaps delivered twice, by several relays or by backfill and live subscription, are dropped
+    # by the redemption queue and the seen nutzap index. The checkpoint only moves once the backfill is done and
+    # never past a nutzap that is still waiting in the queue. Both the backfill and the live subscription reach
+    # clock_skew seconds further back, for nutzaps whose created_at is behind our clock.
+    def __init__(self, nutzap_wallet, client, keys, mints: list, redemption_queue, page_size: int = 100,
+                 initial_lookback: int = 60, clock_skew: int = 60, timeout: timedelta = timedelta(seconds=10)):
+        self.nutzap_wallet = nutzap_wallet
+        self.client = client
+        self.keys = keys
+        self.mints: list = mints
+        self.redemption_queue = redemption_queue
+        if redemption_queue is not None:
+            self.redemption_queue.on_flushed = self.processed
+        self.page_size: int = page_size
+        self.initial_lookback: int = initial_lookback  # seconds, without a checkpoint we start this far back
+        self.clock_skew: int = clock_skew
+        self.timeout: timedelta = timeout
+        self.stream: str = "nutzaps"
+        self.subscription_id: str = "nutzap-receiver"
+        self.pending: dict = {}  # event id -> created_at of nutzaps in the redemption queue
+        self.newest = None  # (created_at, event id) of the newest nutzap we received
+        self.checkpoint = None  # (created_at, event id)
+        self.backfilled: bool = False
+        self.live_since: int = 0
+
+    def checkpoint_owner(self) -> str:
+        return self.keys.public_key().to_hex()
+
+    def load_checkpoint(self):
+        if self.checkpoint is None and self.nutzap_wallet.event_store is not None:
+            self.checkpoint = self.nutzap_wallet.event_store.get_checkpoint(self.checkpoint_owner(), self.stream)
+        return self.checkpoint
+
+    def save_checkpoint(self, created_at: int, event_id: str):
+        if self.checkpoint is not None and created_at <= self.checkpoint[0]:
+            return
+        self.checkpoint = (created_at, event_id)
+        if self.nutzap_wallet.event_store is not None:
+            self.nutzap_wallet.event_store.set_checkpoint(self.checkpoint_owner(), self.stream, created_at,
+                                                          event_id)
+
+    def nutzap_filters(self) -> list:
+        return [Filter().pubkey(self.keys.public_key()).kinds([Kind(9321)]).custom_tag(
+            SingleLetterTag.lowercase(Alphabet.U), self.mints)]
+
+    def queue_for(self, event):
+        # the redemption queue of the wallet the nutzap is for, None to ignore it
+        return self.redemption_queue
+
+    async def start(self):
+        checkpoint = self.load_checkpoint()
+        if checkpoint is not None:
+            since = checkpoint[0] - self.clock_skew
+        else:
+            since = Timestamp.now().as_secs() - self.initial_lookback
+        started = Timestamp.now().as_secs()
+
+        receiver = self
+
+        class NutzapHandler(HandleNotification):
+            async def handle(self, relay_url, subscription_id, event):
+                if subscription_id == receiver.subscription_id and event.kind().as_u16() == 9321:
+                    receiver.receive(event)
+
+            async def handle_msg(self, relay_url, msg):
+                return
+
+        self.live_since = started - self.clock_skew
+        await self.subscribe()
+        asyncio.create_task(self.client.handle_notifications(NutzapHandler()))
+
+        count = await self.backfill(since, started)
+        logger.info(bcolors.CYAN + "[Nutzap] Backfilled " + str(count) + " nutzaps since " +
+                    Timestamp.from_secs(since).to_human_datetime() + bcolors.ENDC)
+        self.backfilled = True
+        self.advance()
+
+    async def subscribe(self):
+        # subscribing with the same id again replaces the filters on the relays
+        live_filters = [nutzap_filter.since(Timestamp.from_secs(self.live_since))
+                        for nutzap_filter in self.nutzap_filters()]
+        await self.client.subscribe_with_id(self.subscription_id, live_filters, None)
+
+    async def backfill(self, since: int, until: int) -> int:
+        relay_urls = list((await self.client.relays()).keys())
+        counts = await asyncio.gather(*[self.backfill_relay(relay_url, nutzap_filter, since, until)
+                                        for relay_url in relay_urls for nutzap_filter in self.nutzap_filters()])
+        return sum(counts)
+
+    async def backfill_relay(self, relay_url, nutzap_filter, since: int, until: int) -> int:
+        # newest first, each page ends where the previous one stopped
+        count = 0
+        boundary = set()  # ids of events at the until timestamp we already received
+        while True:
+            page_filter = nutzap_filter.since(Timestamp.from_secs(since)).until(
+                Timestamp.from_secs(until)).limit(self.page_size)
+            try:
+                page = (await self.client.fetch_events_from([relay_url], [page_filter], self.timeout)).to_vec()
+            except Exception as e:
+                logger.error(bcolors.RED + "[" + relay_url + "] Could not backfill nutzaps: " + str(e) + bcolors.ENDC)
+                return count
+            events = [event for event in page if event.id().to_hex() not in boundary]
+            for event in events:
+                self.receive(event)
+            count += len(events)
+            if len(page) < self.page_size or len(events) == 0:
+                return count
+            oldest = min(event.created_at().as_secs() for event in events)
+            if oldest != until:
+                boundary = set()
+            boundary.update(event.id().to_hex() for event in events if event.created_at().as_secs() == oldest)
+            until = oldest
+
+    def receive(self, event):
+        created_at = event.created_at().as_secs()
+        event_id = event.id().to_hex()
+        if self.newest is None or (created_at, event_id) > self.newest:
+            self.newest = (created_at, event_id)
+        queue = self.queue_for(event)
+        if queue is not None and queue.put(event):
+            logger.info(bcolors.YELLOW + "[Client] NutZap 🥜️⚡ received " + event_id + bcolors.ENDC)
+            self.pending[event_id] = created_at
+
+    def processed(self, events):
+        for event in events:
+            self.pending.pop(event.id().to_hex(), None)
+        self.advance()
+
+    def advance(self):
+        if not self.backfilled or self.newest is None:
+            return
+        if len(self.pending) == 0:
+            self.save_checkpoint(*self.newest)
+            return
+        # everything older than the oldest nutzap in the queue is processed
+        oldest_pending = min(self.pending.values())
+        self.save_checkpoint(oldest_pending - 1, "")
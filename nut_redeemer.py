@@ -0,0 +1,127 @@
+import asyncio
+
+from nut_print_utils import bcolors, logger
+
+
+class NutzapRedemptionQueue(object):
+    # Collects incoming nutzaps per mint for a short window and redeems each group with one swap,
+    # so a burst of zaps costs a few mint and relay round trips instead of a few per zap.
+    # Nutzaps that could not be redeemed (e.g. the mint is down) stay queued and are retried after min_backoff
+    # seconds, twice as long after each further failure, up to max_backoff.
+    def __init__(self, nutzap_wallet, client, keys, window: float = 2.0, max_batch: int = 100,
+                 min_backoff: float = 5.0, max_backoff: float = 600.0):
+        self.nutzap_wallet = nutzap_wallet
+        self.client = client
+        self.keys = keys
+        self.window: float = window  # seconds we wait for more nutzaps on the same mint
+        self.max_batch: int = max_batch
+        self.min_backoff: float = min_backoff
+        self.max_backoff: float = max_backoff
+        self.pending: dict = {}
+        self.flush_tasks: dict = {}
+        self.queued: set = set()  # ids of the nutzaps in pending, in flight or waiting for a retry
+        self.attempts: dict = {}  # event id -> failed attempts
+        self.retrying: dict = {}  # mint url -> nutzaps waiting for a retry
+        self.retry_tasks: dict = {}
+        self.batch_tasks: set = set()  # flushes of full batches, so close() can wait for them
+        self.lock = asyncio.Lock()
+        self.on_flushed = None  # optional callback, called with the nutzaps that are done after each batch
+
+    def put(self, event):
+        # returns False if we already queued the nutzap, e.g. because several relays delivered it
+        event_id = event.id().to_hex()
+        if event_id in self.queued or self.nutzap_wallet.seen_nutzaps.seen(event_id):
+            return False
+        self.queued.add(event_id)
+
+        mint_url = ""
+        for tag in event.tags().to_vec():
+            if tag.as_vec()[0] == "u":
+                mint_url = tag.as_vec()[1]
+        self.pending.setdefault(mint_url, []).append(event)
+
+        if len(self.pending[mint_url]) >= self.max_batch:
+            task = self.flush_tasks.pop(mint_url, None)
+            if task is not None:
+                task.cancel()
+            flush = asyncio.create_task(self.flush(mint_url))
+            self.batch_tasks.add(flush)
+            flush.add_done_callback(self.batch_tasks.discard)
+        elif mint_url not in self.flush_tasks:
+            self.flush_tasks[mint_url] = asyncio.create_task(self.flush_later(mint_url))
+        return True
+
+    async def flush_later(self, mint_url):
+        await asyncio.sleep(self.window)
+        self.flush_tasks.pop(mint_url, None)
+        await self.flush(mint_url)
+
+    async def flush(self, mint_url):
+        events = self.pending.pop(mint_url, [])
+        if len(events) == 0:
+            return
+        async with self.lock:
+            try:
+                # refresh once per batch, in case the wallet changed on another device
+                nut_wallet = await self.nutzap_wallet.get_nut_wallet(self.client, self.keys)
+                if nut_wallet is not None:
+                    await self.nutzap_wallet.reedeem_nutzaps(events, nut_wallet, self.client, self.keys)
+            except Exception as e:
+                logger.error(bcolors.RED + "[" + mint_url + "] Could not redeem nutzaps: " + str(e) + bcolors.ENDC)
+            finally:
+                self.settle(mint_url, events)
+
+    def settle(self, mint_url, events):
+        # Nutzaps that were redeemed or can never be are done and reported to on_flushed, the others are retried
+        # later and not reported, so a checkpoint stays before them.
+        seen_nutzaps = self.nutzap_wallet.seen_nutzaps
+        done = []
+        failed = []
+        for event in events:
+            event_id = event.id().to_hex()
+            if seen_nutzaps.seen(event_id):
+                self.queued.discard(event_id)
+                self.attempts.pop(event_id, None)
+                done.append(event)
+            else:
+                self.attempts[event_id] = self.attempts.get(event_id, 0) + 1
+                failed.append(event)
+        if self.on_flushed is not None and len(done) > 0:
+            try:
+                self.on_flushed(done)
+            except Exception as e:
+                logger.error(bcolors.RED + "[" + mint_url + "] Could not report redeemed nutzaps: " + str(e) +
+                             bcolors.ENDC)
+        if len(failed) == 0:
+            return
+        attempts = max(self.attempts[event.id().to_hex()] for event in failed)
+        backoff = min(self.max_backoff, self.min_backoff * 2 ** (attempts - 1))
+        logger.warning(bcolors.YELLOW + "[" + mint_url + "] " + str(len(failed)) + " nutzaps not redeemed, " +
+                       "retrying in " + str(round(backoff, 1)) + "s" + bcolors.ENDC)
+        self.retrying.setdefault(mint_url, []).extend(failed)
+        if mint_url not in self.retry_tasks:
+            self.retry_tasks[mint_url] = asyncio.create_task(self.retry_later(mint_url, backoff))
+
+    async def retry_later(self, mint_url, backoff: float):
+        await asyncio.sleep(backoff)
+        self.retry_tasks.pop(mint_url, None)
+        self.pending.setdefault(mint_url, []).extend(self.retrying.pop(mint_url, []))
+        await self.flush(mint_url)
+
+    async def flush_all(self):
+        # tries everything now, including the nutzaps waiting for a retry
+        for task in list(self.flush_tasks.values()) + list(self.retry_tasks.values()):
+            task.cancel()
+        self.flush_tasks = {}
+        self.retry_tasks = {}
+        for mint_url, events in self.retrying.items():
+            self.pending.setdefault(mint_url, []).extend(events)
+        self.retrying = {}
+        for mint_url in list(self.pending.keys()):
+            await self.flush(mint_url)
+
+    async def close(self):
+        # redeems what is still queued and waits for the batches that are already being redeemed
+        await self.flush_all()
+        if len(self.batch_tasks) > 0:
+            await asyncio.gather(*list(self.batch_tasks), return_exceptions=True)
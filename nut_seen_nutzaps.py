@@ -0,0 +1,108 @@
+import math
+
+
+def is_event_id(value: str) -> bool:
+    if len(value) != 64:
+        return False
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        return False
+    return True
+
+
+class BloomFilter(object):
+    # Bit array sized for capacity entries at the given false positive rate. Keys are event ids, which are
+    # sha256 hashes already, so the bit positions are taken from the id itself instead of hashing it again.
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001):
+        self.capacity: int = capacity
+        self.error_rate: float = error_rate
+        self.size: int = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes: int = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count: int = 0
+
+    def positions(self, event_id: str):
+        digest = bytes.fromhex(event_id)
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + index * h2) % self.size for index in range(self.hashes)]
+
+    def add(self, event_id: str):
+        for position in self.positions(event_id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, event_id: str) -> bool:
+        for position in self.positions(event_id):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SeenNutzapIndex(object):
+    # Ids of the nutzaps (9321) we already handled: redeemed, or found spent when we tried. Relays deliver
+    # the same nutzap several times and we re-read older ones after a restart, checking the index first
+    # skips them before any wallet load or mint call. A nutzap that is not in the Bloom filter is new for
+    # sure, only hits are confirmed in the event store (or the in-memory set if we don't have a store),
+    # so a false positive never drops a nutzap.
+    def __init__(self, event_store=None, capacity: int = 100000, error_rate: float = 0.001):
+        self.event_store = event_store
+        self.error_rate: float = error_rate
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.ids: set = set()  # only used without event store
+        self.loaded: bool = False
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.event_store is not None:
+            event_ids = self.event_store.load_nutzaps()
+            if len(event_ids) > self.bloom.capacity:
+                self.bloom = BloomFilter(len(event_ids) * 2, self.error_rate)
+            for event_id in event_ids:
+                self.bloom.add(event_id)
+
+    def seen(self, event_id: str) -> bool:
+        self.load()
+        if event_id not in self.bloom:
+            return False
+        if self.event_store is not None:
+            return self.event_store.has_nutzap(event_id)
+        return event_id in self.ids
+
+    def filter_new(self, events: list) -> list:
+        return [event for event in events if not self.seen(event.id().to_hex())]
+
+    def mark(self, event_ids: list, state: str = "redeemed"):
+        self.load()
+        event_ids = [event_id for event_id in dict.fromkeys(event_ids) if not self.seen(event_id)]
+        if len(event_ids) == 0:
+            return
+        if self.event_store is not None:
+            self.event_store.mark_nutzaps(event_ids, state)
+        else:
+            self.ids.update(event_ids)
+        for event_id in event_ids:
+            self.bloom.add(event_id)
+        if self.bloom.count > self.bloom.capacity:
+            self.rebuild()
+
+    def rebuild(self):
+        # the filter is full, more entries would raise the false positive rate
+        event_ids = self.event_store.load_nutzaps() if self.event_store is not None else list(self.ids)
+        self.bloom = BloomFilter(self.bloom.capacity * 2, self.error_rate)
+        for event_id in event_ids:
+            self.bloom.add(event_id)
+
+    def learn_history(self, events: list):
+        # Transaction history events (7376) of redemptions reference the nutzaps in "e" tags with the marker
+        # "redeemed", also the ones another device of ours redeemed
+        redeemed = []
+        for event in events:
+            for tag in event.tags().to_vec():
+                tag = tag.as_vec()
+                if tag[0] == "e" and len(tag) > 3 and tag[3] == "redeemed" and is_event_id(tag[1]):
+                    redeemed.append(tag[1])
+        self.mark(redeemed)
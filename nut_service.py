@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+from nostr_sdk import Client, Filter, Kind, PublicKey
+
+from nut_print_utils import bcolors, logger
+from nut_receiver import NutzapReceiver
+from nut_redeemer import NutzapRedemptionQueue
+from nut_wallet_utils import NutZapWallet
+
+
+class HostedWallet(object):
+    # A wallet hosted by the NutWalletService
+    def __init__(self, keys, mints: list, redemption_queue: NutzapRedemptionQueue):
+        self.keys = keys
+        self.pubkey: str = keys.public_key().to_hex()
+        self.mints: list = mints  # nutzaps on other mints are ignored, empty accepts all
+        self.redemption_queue: NutzapRedemptionQueue = redemption_queue
+        self.last_active: float = time.time()
+
+
+class ServiceReceiver(NutzapReceiver):
+    # One subscription for the nutzaps of all hosted wallets, routed to the wallet in the p tag
+    def __init__(self, service, max_pubkeys_per_filter: int = 500, **kwargs):
+        super().__init__(service.nutzap_wallet, service.client, None, [], None, **kwargs)
+        self.service = service
+        self.max_pubkeys_per_filter: int = max_pubkeys_per_filter  # relays limit the size of a filter
+        self.subscription_id = "nutzap-service"
+
+    def checkpoint_owner(self) -> str:
+        return self.service.name
+
+    def nutzap_filters(self) -> list:
+        pubkeys = [PublicKey.parse(pubkey) for pubkey in self.service.wallets]
+        return [Filter().kinds([Kind(9321)]).pubkeys(pubkeys[start:start + self.max_pubkeys_per_filter])
+                for start in range(0, len(pubkeys), self.max_pubkeys_per_filter)]
+
+    def queue_for(self, event):
+        mint_url = ""
+        recipient = None
+        for tag in event.tags().to_vec():
+            if tag.as_vec()[0] == "p" and tag.as_vec()[1] in self.service.wallets:
+                recipient = self.service.wallets[tag.as_vec()[1]]
+            elif tag.as_vec()[0] == "u":
+                mint_url = tag.as_vec()[1]
+        if recipient is None or (len(recipient.mints) > 0 and mint_url not in recipient.mints):
+            return None
+        recipient.last_active = time.time()
+        return recipient.redemption_queue
+
+
+class NutWalletService(object):
+    # Hosts the wallets of many users in one process. All wallets share one relay pool, one NutZapWallet (with its
+    # mint sessions, mint health, caches and event store) and one nutzap subscription over the pubkeys of all hosted
+    # wallets. Incoming nutzaps are routed to a redemption queue per wallet. Adding or removing wallets updates
+    # the subscription, changes within subscribe_delay seconds are combined into one update.
+    def __init__(self, relays: list, event_store=None, name: str = "service", window: float = 2.0,
+                 subscribe_delay: float = 1.0):
+        self.relays: list = relays
+        self.name: str = name  # owner of the service's nutzap checkpoint in the event store
+        self.window: float = window
+        self.subscribe_delay: float = subscribe_delay
+        self.nutzap_wallet = NutZapWallet(event_store)
+        self.client = None
+        self.wallets: dict = {}  # pubkey -> HostedWallet
+        self.receiver = None
+        self.subscribe_task = None
+
+    async def start(self):
+        # events are signed with the keys of each wallet, the shared client doesn't need a signer
+        self.client = Client()
+        for relay in self.relays:
+            await self.client.add_relay(relay)
+        await self.client.connect()
+        if self.nutzap_wallet.outbox is not None:
+            self.nutzap_wallet.outbox.start(self.client)
+        await self.nutzap_wallet.mint_preferences.subscribe(self.client)
+        self.receiver = ServiceReceiver(self)
+        for hosted in self.wallets.values():
+            hosted.redemption_queue.client = self.client
+            hosted.redemption_queue.on_flushed = self.receiver.processed
+        if len(self.wallets) > 0:
+            await self.receiver.start()
+
+    def add_wallet(self, keys, mints: list = None) -> HostedWallet:
+        pubkey = keys.public_key().to_hex()
+        if pubkey in self.wallets:
+            return self.wallets[pubkey]
+        queue = NutzapRedemptionQueue(self.nutzap_wallet, self.client, keys, window=self.window)
+        hosted = HostedWallet(keys, mints if mints is not None else [], queue)
+        if self.receiver is not None:
+            queue.on_flushed = self.receiver.processed
+        self.wallets[pubkey] = hosted
+        self.schedule_subscribe()
+        return hosted
+
+    async def remove_wallet(self, pubkey: str):
+        hosted = self.wallets.pop(pubkey, None)
+        if hosted is None:
+            return
+        await hosted.redemption_queue.close()
+        self.schedule_subscribe()
+
+    def schedule_subscribe(self):
+        if self.receiver is None or self.subscribe_task is not None:
+            return
+        self.subscribe_task = asyncio.create_task(self.subscribe_later())
+
+    async def subscribe_later(self):
+        await asyncio.sleep(self.subscribe_delay)
+        self.subscribe_task = None
+        try:
+            if not self.receiver.backfilled:
+                await self.receiver.start()
+            elif len(self.wallets) > 0:
+                await self.receiver.subscribe()
+        except Exception as e:
+            logger.error(bcolors.RED + "Could not update the nutzap subscription: " + str(e) + bcolors.ENDC)
+
+    async def get_nut_wallet(self, pubkey: str):
+        hosted = self.wallets[pubkey]
+        hosted.last_active = time.time()
+        return await self.nutzap_wallet.get_nut_wallet(self.client, hosted.keys)
+
+    async def send_nut_zap(self, pubkey: str, amount: int, comment: str, zapped_user: str, zapped_event=None):
+        hosted = self.wallets[pubkey]
+        nut_wallet = await self.get_nut_wallet(pubkey)
+        if nut_wallet is None:
+            logger.error(bcolors.RED + "No wallet for " + pubkey + bcolors.ENDC)
+            return
+        await self.nutzap_wallet.send_nut_zap(amount, comment, nut_wallet, zapped_event, zapped_user, self.client,
+                                              hosted.keys)
+
+    def stats(self):
+        return {
+            "wallets": len(self.wallets),
+            "active_wallets": len([hosted for hosted in self.wallets.values()
+                                   if time.time() - hosted.last_active < 3600]),
+            "relays": len(self.relays),
+            "mint_sessions": len(self.nutzap_wallet.mint_pool.sessions),
+            "pending_nutzaps": len(self.receiver.pending) if self.receiver is not None else 0,
+        }
+
+    async def close(self):
+        await self.nutzap_wallet.stop_rebalancer()
+        for hosted in self.wallets.values():
+            await hosted.redemption_queue.close()
+        await self.nutzap_wallet.writer.close()
+        if self.client is not None:
+            await self.client.disconnect()
@@ -0,0 +1,92 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class MintLock(object):
+    # asyncio.Lock that the task holding it can enter again, e.g. a send that mints missing balance first
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.owner = None
+        self.depth: int = 0
+
+    async def acquire(self):
+        task = asyncio.current_task()
+        if self.owner is task:
+            self.depth += 1
+            return
+        await self.lock.acquire()
+        self.owner = task
+        self.depth = 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.owner = None
+            self.lock.release()
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+
+class WalletState(object):
+    # Versioned proof state per wallet and mint. Every change of a mint's proofs (spend, receive, mint) runs under
+    # the lock of that mint, so operations on the same mint are serialized while different mints run in parallel.
+    # The NutMint of the last committed change is kept here with its version. All NutWallet objects of a wallet,
+    # e.g. the one of a sender and the one of the redemption queue, adopt it before they read or change that mint,
+    # so they never work on an outdated copy of the proofs. Reads don't lock: they see the last committed state.
+    # Wallets are identified by their a tag.
+    def __init__(self):
+        self.locks: dict = {}  # (wallet, mint url) -> MintLock
+        self.mints: dict = {}  # (wallet, mint url) -> NutMint of the last committed change
+
+    @asynccontextmanager
+    async def lock(self, nut_wallet, mint_urls: list):
+        # always in the same order, so two operations that need several mints can't deadlock
+        locks = [self.locks.setdefault((nut_wallet.a, mint_url), MintLock()) for mint_url in sorted(set(mint_urls))]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def locked(self, nut_wallet, mint_url: str) -> bool:
+        lock = self.locks.get((nut_wallet.a, mint_url))
+        return lock is not None and lock.locked()
+
+    def versions(self, nut_wallet) -> dict:
+        return {mint_url: mint.version for (a, mint_url), mint in self.mints.items() if a == nut_wallet.a}
+
+    def adopt(self, nut_wallet, mint_url: str = None):
+        # replaces outdated NutMints of nut_wallet with the committed ones
+        for (a, committed_url), committed in self.mints.items():
+            if a != nut_wallet.a or (mint_url is not None and committed_url != mint_url):
+                continue
+            for index, mint in enumerate(nut_wallet.nutmints):
+                if mint.mint_url == committed_url:
+                    if mint is not committed and mint.version <= committed.version:
+                        nut_wallet.nutmints[index] = committed
+                    break
+            else:
+                nut_wallet.nutmints.append(committed)
+
+    def commit(self, nut_wallet, mint):
+        key = (nut_wallet.a, mint.mint_url)
+        committed = self.mints.get(key)
+        mint.version = max(mint.version, committed.version if committed is not None else 0) + 1
+        self.mints[key] = mint
+        nut_wallet.version += 1
+
+    def reconcile(self, nut_wallet, versions: dict):
+        # after loading the proofs from the events: a mint that nobody changed while we loaded takes the loaded
+        # state (it includes changes of other devices), the others keep the state committed in the meantime
+        current = self.versions(nut_wallet)
+        for mint in nut_wallet.nutmints:
+            if current.get(mint.mint_url) == versions.get(mint.mint_url) and \
+                    not self.locked(nut_wallet, mint.mint_url):
+                if mint.mint_url in current:
+                    self.commit(nut_wallet, mint)
+        self.adopt(nut_wallet)
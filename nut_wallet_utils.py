@@ -1,19 +1,37 @@
 import asyncio
 import json
 import os
+import time
 from collections import namedtuple
 from datetime import timedelta
 
-import requests
-from nostr_sdk import Tag, Keys, nip44_encrypt, nip44_decrypt, Nip44Version, EventBuilder, Client, Filter, Kind, \
-    EventId, nip04_decrypt, nip04_encrypt, Options, NostrSigner, PublicKey, Metadata
-
-from nostr_dvm.utils.database_utils import fetch_user_metadata
-from nostr_dvm.utils.definitions import EventDefinitions, relay_timeout, relay_timeout_long
-from nostr_dvm.utils.dvmconfig import DVMConfig
-from nostr_dvm.utils.nostr_utils import check_and_set_private_key
-from nostr_dvm.utils.print_utils import bcolors
-from nostr_dvm.utils.zap_utils import pay_bolt11_ln_bits, zaprequest
+from nostr_sdk import Tag, Keys, nip44_encrypt, Nip44Version, EventBuilder, Client, Filter, Kind, EventId, \
+    nip04_encrypt, PublicKey, Metadata, Timestamp
+
+from nut_coin_selection import CoinSelector, keyset_fees
+from nut_decrypt import BatchDecryptor, DecryptionCache, is_nip04_payload
+from nut_event_store import NutEventStore
+from nut_event_writer import NutEventWriter
+from nut_extras import check_and_set_private_key, default_relay_list, fetch_user_metadata, \
+    pay_bolt11_ln_bits, zaprequest
+from nut_liquidity import LiquidityRouter
+from nut_metrics import Metrics, timed
+from nut_outbox import NutEventOutbox
+from nut_mint_health import MintHealthRegistry
+from nut_mint_http import MintHttpClient
+from nut_mint_pool import MintSessionPool
+from nut_mint_preferences import MintPreferenceCache
+from nut_print_utils import bcolors, logger
+from nut_proof_store import NutProof, ProofStore
+from nut_rebalancer import DenominationRebalancer
+from nut_seen_nutzaps import SeenNutzapIndex
+from nut_wallet_state import WalletState
+
+
+def is_spent_error(error) -> bool:
+    # the mint rejected the proofs because they are spent (NUT-00 error code 11001)
+    message = str(error).lower()
+    return "already spent" in message or "11001" in message
 
 
 class NutWallet(object):
@@ -30,25 +48,111 @@ class NutWallet(object):
         self.a: str = ""
         self.legacy_encryption: bool = False  # Use Nip04 instead of Nip44, for reasons, turn to False ASAP.
         self.trust_unknown_mints: bool = False
-        self.missing_balance_strategy: str = "mint"  # none to do nothing until manually minted, mint to mint from lightning or swap to use existing tokens from other mints (fees!) (not working yet!)
+        self.missing_balance_strategy: str = "mint"  # none to do nothing until manually minted, mint to mint from lightning or swap to use existing tokens from other mints (fees!)
+        self.version: int = 0  # number of proof changes committed through this object
 
 
 class NutMint(object):
     def __init__(self):
-        self.previous_event_id = None
-        self.proofs: list = []
+        self.proofs: ProofStore = ProofStore()  # also tracks which proof event (chunk) holds each proof
         self.mint_url: str = ""
-        self.previous_event_id: EventId
         self.a: str = ""
+        self.version: int = 0  # see WalletState
 
     def available_balance(self):
-        balance = 0
-        for proof in self.proofs:
-            balance += proof.amount
-        return balance
+        return self.proofs.balance
+
+
+class NutZap(object):
+    def __init__(self):
+        self.event = None
+        self.proofs: list = []
+        self.mint_url: str = ""
+        self.amount: int = 0
+        self.unit: str = "sat"
+        self.zapped_user: str = ""
+        self.zapped_event: str = ""
+        self.sender: str = ""
+        self.message: str = ""
+
+
+class NutZapPayout(object):
+    # One outgoing nutzap of a send_nut_zaps batch
+    def __init__(self, amount: int = 0, zapped_user: str = "", comment: str = "", zapped_event: str = None):
+        self.amount: int = amount
+        self.zapped_user: str = zapped_user
+        self.comment: str = comment
+        self.zapped_event: str = zapped_event
+        self.mint_url: str = ""
+        self.p2pk_pubkey: str = ""
+        self.proofs: list = []
+        self.event_id: str = ""  # set once the nutzap is published
+
+
+class NutTransaction(object):
+    def __init__(self):
+        self.event_id: str = ""
+        self.created_at: int = 0
+        self.direction: str = ""  # in or out
+        self.amount: int = 0
+        self.unit: str = "sats"
+        self.counterparty: str = ""  # hex pubkey of the nutzap sender or receiver, if any
+        self.marker: str = ""  # redeemed or zapped for nutzaps
+        self.e_tags: list = []  # nutzap events this transaction refers to
+        self.created: list = []  # proof events created by this transaction
+        self.destroyed: list = []  # proof events destroyed by this transaction
 
 
 class NutZapWallet:
+    def __init__(self, event_store: NutEventStore = None):
+        # Optional local event store, if set we only fetch events newer than the last sync from the relays
+        self.event_store = event_store
+        # Spans, counters and latency histograms of the wallet operations, add an exporter to read them
+        self.metrics = Metrics()
+        self.decryptor = BatchDecryptor()
+        # Parsed content of decrypted events by event id, persisted in the event store if we have one
+        self.decryption_cache = DecryptionCache(10000, event_store)
+        # Nutzaps we already redeemed, so duplicate deliveries are dropped before they reach the mint
+        self.seen_nutzaps = SeenNutzapIndex(event_store)
+        # Per mint locks and the last committed proofs of each mint, operations on different mints run in parallel
+        self.wallet_state = WalletState()
+        self.wallet_created_at: dict = {}  # a tag -> created_at of the last wallet event we published
+        # Latency and errors per mint, mints that keep failing are skipped until they recover
+        self.mint_health = MintHealthRegistry()
+        # Loaded cashu wallets per mint and role, so we don't load the mint on every operation
+        self.mint_pool = MintSessionPool(health=self.mint_health, metrics=self.metrics)
+        self.mint_http = MintHttpClient(health=self.mint_health)
+        self.mint_quote_timeout: float = 60.0  # seconds we wait for a mint quote to be paid
+        # Picks proofs locally: exact matches skip the swap of unlocked sends and melts, P2PK locked nutzaps always
+        # swap but with inputs that leave the least change
+        self.coin_selector = CoinSelector()
+        # Moves balance between our mints for the "swap" missing balance strategy
+        self.liquidity_router = LiquidityRouter(self)
+        # Nutzap info (10019) of recipients, call mint_preferences.subscribe(client) to follow changes live
+        self.mint_preferences = MintPreferenceCache(ttl=3600)
+        # Publishes the events of one operation together, set writer.wallet_debounce to also bundle wallet updates
+        self.writer = NutEventWriter(self)
+        # Journals the events of an operation locally and publishes them in the background, needs the event store
+        self.outbox = NutEventOutbox(event_store, metrics=self.metrics) if event_store is not None else None
+        # Limits for a single proof event, larger wallets are split into several events
+        self.max_chunk_proofs: int = 100
+        self.max_chunk_bytes: int = 48000
+        # time of the last proof update, background tasks wait until the wallet has been idle for a while
+        self.last_activity: float = 0.0
+        self.rebalancer = None
+
+    def start_rebalancer(self, client, keys, target_count=3, max_denomination=1024, idle_time=30, interval=60):
+        # Optional background task that splits proofs into send ready denominations while the wallet is idle
+        if self.rebalancer is None:
+            self.rebalancer = DenominationRebalancer(self, client, keys, target_count, max_denomination, idle_time,
+                                                     interval)
+            self.rebalancer.start()
+        return self.rebalancer
+
+    async def stop_rebalancer(self):
+        if self.rebalancer is not None:
+            await self.rebalancer.stop()
+            self.rebalancer = None
 
     async def client_connect(self, relay_list, keys):
 
@@ -56,6 +160,11 @@ class NutZapWallet:
         for relay in relay_list:
             await client.add_relay(relay)
         await client.connect()
+        if self.outbox is not None:
+            # publishes what a previous run journaled but couldn't publish
+            self.outbox.start(client)
+        # keep the cached mint preferences of the users we zap up to date
+        await self.mint_preferences.subscribe(client)
         return client
 
     async def create_new_nut_wallet(self, mint_urls, relays, client, keys, name, description):
@@ -69,16 +178,27 @@ class NutZapWallet:
         new_nut_wallet.relays = relays
         new_nut_wallet.d = "wallet"
         new_nut_wallet.a = str(Kind(7375).as_u16()) + ":" + keys.public_key().to_hex() + ":" + new_nut_wallet.d
-        print("Creating Wallet..")
+        logger.info("Creating Wallet..")
         send_response_id = await self.create_or_update_nut_wallet_event(new_nut_wallet, client, keys)
 
         if send_response_id is None:
-            print("Warning: Not published")
+            logger.warning("Warning: Not published")
 
-        print(new_nut_wallet.name + ": " + str(new_nut_wallet.balance) + " " + new_nut_wallet.unit + " Mints: " + str(
-            new_nut_wallet.mints) + " Key: " + new_nut_wallet.privkey)
+        logger.info(new_nut_wallet.name + ": " + str(new_nut_wallet.balance) + " " + new_nut_wallet.unit +
+                    " Mints: " + str(new_nut_wallet.mints) + " Key: " + new_nut_wallet.privkey)
 
     async def create_or_update_nut_wallet_event(self, nut_wallet: NutWallet, client, keys):
+        event, content = self.nut_wallet_event(nut_wallet, keys)
+        if self.outbox is not None:
+            await self.outbox.journal([event], {event.id().to_hex(): content}, client)
+        else:
+            await client.send_event(event)
+            self.remember_event(event, content)
+        self.log_nut_wallet_event(nut_wallet, event)
+        return event.id()
+
+    def nut_wallet_event(self, nut_wallet: NutWallet, keys):
+        # the signed wallet event (37375) and its decrypted content
         innertags = [Tag.parse(["balance", str(nut_wallet.balance), nut_wallet.unit]).as_vec(),
                      Tag.parse(["privkey", nut_wallet.privkey]).as_vec()]
 
@@ -103,51 +223,139 @@ class NutZapWallet:
             relay_tag = Tag.parse(["relay", relay])
             tags.append(relay_tag)
 
-        event = EventBuilder(EventDefinitions.KIND_NUT_WALLET, content, tags).sign_with_keys(keys)
-        send_response = await client.send_event(event)
-
-        print(
-            bcolors.BLUE + "[" + nut_wallet.name + "] announced nut wallet (" + send_response.id.to_hex() + ")" + bcolors.ENDC)
-        return send_response.id
+        # relays keep the first of two wallet events from the same second, every update has to be newer
+        created_at = max(Timestamp.now().as_secs(), self.wallet_created_at.get(nut_wallet.a, 0) + 1)
+        self.wallet_created_at[nut_wallet.a] = created_at
+        event = EventBuilder(Kind(37375), content, tags).custom_created_at(
+            Timestamp.from_secs(created_at)).sign_with_keys(keys)
+        return event, json.dumps(innertags)
+
+    def log_nut_wallet_event(self, nut_wallet: NutWallet, event):
+        logger.info(
+            bcolors.BLUE + "[" + nut_wallet.name + "] announced nut wallet (" + event.id().to_hex() + ")" + bcolors.ENDC)
+
+    @timed("relay_fetch")
+    async def sync_events(self, client, keys, stream, kinds, timeout):
+        # Fetch the events of the given kinds from each relay, starting at the cursor we stored for that relay
+        pubkey = keys.public_key().to_hex()
+        relay_urls = list((await client.relays()).keys())
+
+        async def sync_relay(relay_url):
+            event_filter = Filter().kinds(kinds).author(keys.public_key())
+            since = self.event_store.get_cursor(pubkey, relay_url, stream)
+            if since is not None:
+                event_filter = event_filter.since(Timestamp.from_secs(since))
+            try:
+                events = (await client.fetch_events_from([relay_url], [event_filter], timeout)).to_vec()
+            except Exception as e:
+                logger.error(bcolors.RED + "[" + relay_url + "] Could not sync events: " + str(e) + bcolors.ENDC)
+                return
+            self.event_store.save_events(events)
+            if len(events) > 0:
+                latest = max(event.created_at().as_secs() for event in events)
+                self.event_store.set_cursor(pubkey, relay_url, stream, latest)
+
+        await asyncio.gather(*[sync_relay(relay_url) for relay_url in relay_urls])
+
+    @timed("relay_fetch")
+    async def fetch_own_events(self, client, keys, kind, timeout):
+        # Returns a list of (event, decrypted content or None), from the local store if we have one.
+        # Without a store we fetch our NIP-09 deletions along with the events and drop the deleted ones,
+        # e.g. proof events that were replaced after a spend.
+        if self.event_store is None:
+            events = (await client.fetch_events([Filter().kind(kind).author(keys.public_key()),
+                                                 Filter().kind(Kind(5)).author(keys.public_key())],
+                                                timeout)).to_vec()
+            deleted = set()
+            for event in events:
+                if event.kind().as_u16() == 5:
+                    deleted.update(tag.as_vec()[1] for tag in event.tags().to_vec()
+                                   if tag.as_vec()[0] == "e" and len(tag.as_vec()) > 1)
+            return [(event, None) for event in events
+                    if event.kind().as_u16() == kind.as_u16() and event.id().to_hex() not in deleted]
+        return self.event_store.load_events(keys.public_key().to_hex(), kind.as_u16())
+
+    def remember_event(self, event, content=None):
+        # Keep events we published ourselves, so the next load doesn't depend on the relays returning them
+        if self.event_store is None:
+            return
+        self.event_store.save_events([event])
+        if content is not None:
+            self.event_store.save_decrypted(event.id().to_hex(), content)
 
+    def forget_events(self, event_ids, keys):
+        # events we remembered but never published, because they were replaced within the same operation
+        if self.event_store is None or len(event_ids) == 0:
+            return
+        self.event_store.mark_deleted(event_ids, keys.public_key().to_hex())
+
+    @timed("decrypt")
+    async def decrypt_events(self, events, keys):
+        # Takes a list of (event, decrypted content or None) and returns the parsed json contents in the same
+        # order, None if an event could not be decrypted. Only events that are not cached get decrypted, in one batch.
+        contents = [self.decryption_cache.lookup(event.id().to_hex(), decrypted) for event, decrypted in events]
+        missing = [index for index, content in enumerate(contents) if content is None]
+        if len(missing) > 0:
+            decrypted = await self.decryptor.decrypt_async([events[index][0] for index in missing], keys)
+            parsed = self.cache_decrypted([events[index][0] for index in missing], decrypted)
+            for index, content in zip(missing, parsed):
+                contents[index] = content
+        return contents
+
+    def cache_decrypted(self, events, contents):
+        # caches the decrypted contents of events in one store transaction, returns the parsed contents
+        decrypted = [(event.id().to_hex(), content) for event, content in zip(events, contents) if content is not None]
+        values = self.decryption_cache.put_many(decrypted)
+        for event_id, content in decrypted:
+            if event_id not in values:
+                logger.error(bcolors.RED + "Invalid content in event " + event_id + bcolors.ENDC)
+        return [values.get(event.id().to_hex()) for event in events]
+
+    @timed("get_nut_wallet")
     async def get_nut_wallet(self, client, keys) -> NutWallet:
-        from cashu.core.base import Proof
         nut_wallet = None
 
-        wallet_filter = Filter().kind(EventDefinitions.KIND_NUT_WALLET).author(keys.public_key())
-        # relay_timeout = EventSource.relays(timedelta(seconds=10))
-        wallets = await client.fetch_events([wallet_filter], timedelta(seconds=10))
+        if self.event_store is not None:
+            await self.sync_events(client, keys, "wallet",
+                                   [Kind(37375), Kind(7375), Kind(5)], timedelta(seconds=10))
 
-        if len(wallets.to_vec()) > 0:
+        # relay_timeout = EventSource.relays(timedelta(seconds=10))
+        wallets = await self.fetch_own_events(client, keys, Kind(37375), timedelta(seconds=10))
 
-            nut_wallet = NutWallet()
+        if len(wallets) > 0:
 
-            latest = 0
-            best_wallet = None
-            for wallet_event in wallets.to_vec():
+            candidates = []
+            for wallet_event, decrypted in wallets:
 
                 isdeleted = False
                 for tag in wallet_event.tags().to_vec():
                     if tag.as_vec()[0] == "deleted":
                         isdeleted = True
                         break
-                if isdeleted:
+                if not isdeleted:
+                    candidates.append((wallet_event, decrypted))
+
+            # the newest wallet event we can decrypt, events we can't decrypt are skipped
+            candidates.sort(key=lambda candidate: candidate[0].created_at().as_secs(), reverse=True)
+            best_wallet = None
+            inner_tags = None
+            for (wallet_event, _), content in zip(candidates, await self.decrypt_events(candidates, keys)):
+                if content is None:
+                    logger.error(bcolors.RED + "Could not decrypt wallet event " + wallet_event.id().to_hex() +
+                                 ", skipping it" + bcolors.ENDC)
                     continue
-                else:
-                    if wallet_event.created_at().as_secs() > latest:
-                        latest = wallet_event.created_at().as_secs()
-                        best_wallet = wallet_event
+                best_wallet = wallet_event
+                inner_tags = content
+                break
+            if best_wallet is None:
+                return None
 
-            try:
-                content = nip44_decrypt(keys.secret_key(), keys.public_key(), best_wallet.content())
-                print(content)
-            except:
-                content = nip04_decrypt(keys.secret_key(), keys.public_key(), best_wallet.content())
-                print(content)
-                print("Warning: This Wallet is using a NIP04 enconding.., it should use NIP44 encoding ")
+            nut_wallet = NutWallet()
+            logger.debug("Wallet tags: %s", inner_tags)
+            if is_nip04_payload(best_wallet.content()):
+                logger.warning("Warning: This Wallet is using a NIP04 enconding.., it should use NIP44 encoding ")
                 nut_wallet.legacy_encryption = True
 
-            inner_tags = json.loads(content)
             for tag in inner_tags:
                 # These tags must be encrypted instead of in the outer tags
                 if tag[0] == "balance":
@@ -187,68 +395,55 @@ class NutZapWallet:
                     if tag.as_vec()[1] not in nut_wallet.mints:
                         nut_wallet.mints.append(tag.as_vec()[1])
             nut_wallet.a = str("37375:" + best_wallet.author().to_hex() + ":" + nut_wallet.d)
+            versions = self.wallet_state.versions(nut_wallet)
 
             # Now all proof events
-            proof_filter = Filter().kind(Kind(7375)).author(keys.public_key())
-            proof_events = await client.fetch_events([proof_filter], timedelta(seconds=5))
+            proof_events = await self.fetch_own_events(client, keys, Kind(7375), timedelta(seconds=5))
 
-            latest_proof_sec = 0
-            latest_proof_event_id = EventId
-            for proof_event in proof_events.to_vec():
-                if proof_event.created_at().as_secs() > latest_proof_sec:
-                    latest_proof_sec = proof_event.created_at().as_secs()
-                    latest_proof_event_id = proof_event.id()
-
-            for proof_event in proof_events.to_vec():
-                try:
-                    content = nip44_decrypt(keys.secret_key(), keys.public_key(), proof_event.content())
-                except:
-                    content = nip04_decrypt(keys.secret_key(), keys.public_key(), proof_event.content())
-                    print("Warning: This Proofs event is using a NIP04 enconding.., it should use NIP44 encoding ")
+            proof_contents = await self.decrypt_events(proof_events, keys)
+            for (proof_event, _), proofs_json in zip(proof_events, proof_contents):
+                if proofs_json is None:
+                    logger.error(bcolors.RED + "Could not decrypt proof event " + proof_event.id().to_hex() +
+                                 ", skipping it" + bcolors.ENDC)
+                    continue
+                if is_nip04_payload(proof_event.content()):
+                    logger.warning("Warning: This Proofs event is using a NIP04 enconding.., "
+                                   "it should use NIP44 encoding ")
 
-                proofs_json = json.loads(content)
                 mint_url = ""
                 a = ""
-                print("")
-                print("AVAILABLE MINT:")
 
                 try:
                     mint_url = proofs_json['mint']
-                    print("mint: " + mint_url)
                     a = proofs_json['a']
-                    print("a: " + a)
                 except Exception as e:
                     pass
 
                 for tag in proof_event.tags().to_vec():
                     if tag.as_vec()[0] == "mint":
                         mint_url = tag.as_vec()[1]
-                        print("mint: " + mint_url)
                     elif tag.as_vec()[0] == "a":
                         a = tag.as_vec()[1]
-                        print("a: " + a)
-
-                nut_mint = NutMint()
-                nut_mint.mint_url = mint_url
-                nut_mint.a = a
-                nut_mint.previous_event_id = latest_proof_event_id
-                nut_mint.proofs = []
-
-                for proof in proofs_json['proofs']:
-                    proofs = [x for x in nut_mint.proofs if x.secret == proof['secret']]
-                    if len(proofs) == 0:
-                        nut_proof = Proof()
-                        nut_proof.id = proof['id']
-                        nut_proof.secret = proof['secret']
-                        nut_proof.amount = proof['amount']
-                        nut_proof.C = proof['C']
-                        nut_mint.proofs.append(nut_proof)
-                        # print(proof)
 
+                # every proof event is one chunk of the proofs of a mint
                 mints = [x for x in nut_wallet.nutmints if x.mint_url == mint_url]
                 if len(mints) == 0:
+                    nut_mint = NutMint()
+                    nut_mint.mint_url = mint_url
+                    nut_mint.a = a
                     nut_wallet.nutmints.append(nut_mint)
-                print("Mint Balance: " + str(nut_mint.available_balance()) + " Sats")
+                else:
+                    nut_mint = mints[0]
+
+                for proof in proofs_json['proofs']:
+                    nut_mint.proofs.add(NutProof.from_json(proof), proof_event.id().to_hex())
+
+            # mints changed by an operation while we loaded keep the newer state
+            self.wallet_state.reconcile(nut_wallet, versions)
+
+            for nut_mint in nut_wallet.nutmints:
+                logger.info("Mint Balance: " + nut_mint.mint_url + " " + str(nut_mint.available_balance()) + " Sats (" +
+                            str(len(nut_mint.proofs.chunks)) + " proof events)")
 
         return nut_wallet
 
@@ -257,29 +452,22 @@ class NutZapWallet:
             if mint not in nut_wallet.mints:
                 nut_wallet.mints.append(mint)
 
-        balance = 0
-        for mint in nut_wallet.nutmints:
-            for proof in mint.proofs:
-                balance += proof.amount
-
-        nut_wallet.balance = balance
+        self.wallet_state.adopt(nut_wallet)
+        nut_wallet.balance = sum(mint.available_balance() for mint in nut_wallet.nutmints)
 
-        id = await self.create_or_update_nut_wallet_event(nut_wallet, client, keys)
+        await self.writer.update_wallet(nut_wallet, client, keys)
 
-        if id is None:
-            print(bcolors.RED + str("Error publishing WalletEvent") + bcolors.ENDC)
-
-        print(nut_wallet.name + ": " + str(nut_wallet.balance) + " " + nut_wallet.unit + " Mints: " + str(
+        logger.info(nut_wallet.name + ": " + str(nut_wallet.balance) + " " + nut_wallet.unit + " Mints: " + str(
             nut_wallet.mints) + " Key: " + nut_wallet.privkey)
 
         return nut_wallet
 
     def get_mint(self, nut_wallet, mint_url) -> NutMint:
+        self.wallet_state.adopt(nut_wallet, mint_url)
         mints = [x for x in nut_wallet.nutmints if x.mint_url == mint_url]
         if len(mints) == 0:
             mint = NutMint()
-            mint.proofs = []
-            mint.previous_event_id = None
+            mint.proofs = ProofStore()
             mint.a = nut_wallet.a
             mint.mint_url = mint_url
 
@@ -289,8 +477,8 @@ class NutZapWallet:
         return mint
 
     async def create_transaction_history_event(self, nut_wallet: NutWallet, amount: int, unit: str,
-                                               event_old: EventId | None,
-                                               event_new: EventId, direction: str, marker, sender_hex, event_hex,
+                                               events_destroyed: list,
+                                               events_created: list, direction: str, marker, sender_hex, event_hex,
                                                client: Client, keys: Keys):
         # direction
         # in = received
@@ -309,10 +497,11 @@ class NutZapWallet:
         inner_tags.append(["direction", direction])
         inner_tags.append(["amount", str(amount), unit])
 
-        if event_old is not None:
+        for event_old in events_destroyed:
             inner_tags.append(["e", event_old.to_hex(), relay_hint, "destroyed"])
 
-        inner_tags.append(["e", event_new.to_hex(), relay_hint, "created"])
+        for event_new in events_created:
+            inner_tags.append(["e", event_new.to_hex(), relay_hint, "created"])
 
         message = json.dumps(inner_tags)
         if nut_wallet.legacy_encryption:
@@ -322,77 +511,215 @@ class NutZapWallet:
 
         tags = [Tag.parse(["a", nut_wallet.a])]
         if marker == "redeemed" or marker == "zapped":
-            e_tag = Tag.parse(["e", event_hex, relay_hint, marker])
-            tags.append(e_tag)
-            p_tag = Tag.parse(["p", sender_hex])
-            tags.append(p_tag)
+            # a batch of redeemed nutzaps is recorded in one history event, with an e and p tag per nutzap
+            event_hexes = event_hex if isinstance(event_hex, list) else [event_hex]
+            sender_hexes = sender_hex if isinstance(sender_hex, list) else [sender_hex]
+            for nutzap_event_hex, nutzap_sender_hex in zip(event_hexes, sender_hexes):
+                e_tag = Tag.parse(["e", nutzap_event_hex, relay_hint, marker])
+                tags.append(e_tag)
+                p_tag = Tag.parse(["p", nutzap_sender_hex])
+                tags.append(p_tag)
 
         event = EventBuilder(Kind(7376), content, tags).sign_with_keys(keys)
-        eventid = await client.send_event(event)
-
-    async def create_unspent_proof_event(self, nut_wallet: NutWallet, mint_proofs, mint_url, amount, direction, marker,
-                                         sender_hex, event_hex,
-                                         client, keys):
-        new_proofs = []
-        mint = self.get_mint(nut_wallet, mint_url)
-        mint.proofs = mint_proofs
-        for proof in mint_proofs:
-            proofjson = {
-                "id": proof['id'],
-                "amount": proof['amount'],
-                "secret": proof['secret'],
-                "C": proof['C']
+        await self.writer.publish(event, client, keys, message)
+
+    @timed("proof_events")
+    async def create_unspent_proof_event(self, nut_wallet: NutWallet, mint: NutMint, dirty_chunks, amount,
+                                         direction, marker, sender_hex, event_hex, client, keys):
+        # Proofs are stored in chunks of limited size, each chunk is its own 7375 event. We only delete and
+        # republish the chunks that changed (dirty_chunks) together with the proofs that aren't stored yet,
+        # so the cost of an update doesn't grow with the size of the wallet.
+        if mint not in nut_wallet.nutmints:
+            nut_wallet.nutmints.append(mint)
+        self.last_activity = time.time()
+
+        destroyed = []
+        for chunk_id in dirty_chunks:
+            if chunk_id in mint.proofs.chunks:
+                mint.proofs.drop_chunk(chunk_id)
+                destroyed.append(EventId.parse(chunk_id))
+
+        # top up the smallest chunk instead of starting a new one if it's almost empty
+        unsaved = mint.proofs.unassigned()
+        if len(unsaved) > 0 and len(mint.proofs.chunks) > 0:
+            smallest = min(mint.proofs.chunks, key=lambda chunk: len(mint.proofs.chunks[chunk]))
+            if len(mint.proofs.chunks[smallest]) < self.max_chunk_proofs / 4:
+                mint.proofs.drop_chunk(smallest)
+                destroyed.append(EventId.parse(smallest))
+
+        # chunks emptied by a spend are only deleted
+        for chunk_id in [chunk_id for chunk_id, secrets in mint.proofs.chunks.items() if len(secrets) == 0]:
+            mint.proofs.drop_chunk(chunk_id)
+            destroyed.append(EventId.parse(chunk_id))
+
+        if len(destroyed) > 0:
+            logger.info(bcolors.MAGENTA + "[" + nut_wallet.name + "] Deleted previous proofs events.. : (" +
+                        ", ".join(event_id.to_hex() for event_id in destroyed) + ")" + bcolors.ENDC)
+            await self.writer.delete(destroyed, client, keys)
+
+        created = []
+        for secrets in self.pack_chunks(mint, mint.proofs.unassigned()):
+            tags = []
+            # print(nut_wallet.a)
+            a_tag = Tag.parse(["a", nut_wallet.a])
+            tags.append(a_tag)
+
+            j = {
+                "mint": mint.mint_url,
+                "proofs": [mint.proofs.get(secret).to_json() for secret in secrets]
             }
-            # print("Mint proofs:")
-            # print(proof)
-            new_proofs.append(proofjson)
-        old_event_id = mint.previous_event_id
-
-        if mint.previous_event_id is not None:
-            print(
-                bcolors.MAGENTA + "[" + nut_wallet.name + "] Deleted previous proofs event.. : (" + mint.previous_event_id.to_hex() + ")" + bcolors.ENDC)
-            evt = EventBuilder.delete([mint.previous_event_id], reason="deleted").sign_with_keys(
-                keys)  # .to_pow_event(keys, 28)
-            response = await client.send_event(evt)
 
-        tags = []
-        # print(nut_wallet.a)
-        a_tag = Tag.parse(["a", nut_wallet.a])
-        tags.append(a_tag)
+            message = json.dumps(j)
 
-        j = {
-            "mint": mint_url,
-            "proofs": new_proofs
-        }
+            # print(message)
+            if nut_wallet.legacy_encryption:
+                content = nip04_encrypt(keys.secret_key(), keys.public_key(), message)
+            else:
+                content = nip44_encrypt(keys.secret_key(), keys.public_key(), message, Nip44Version.V2)
 
-        message = json.dumps(j)
+            event = EventBuilder(Kind(7375), content, tags).sign_with_keys(keys)
+            event_id = await self.writer.publish(event, client, keys, message)
+            mint.proofs.assign_chunk(event_id.to_hex(), secrets)
+            created.append(event_id)
 
-        # print(message)
-        if nut_wallet.legacy_encryption:
-            content = nip04_encrypt(keys.secret_key(), keys.public_key(), message)
-        else:
-            content = nip44_encrypt(keys.secret_key(), keys.public_key(), message, Nip44Version.V2)
+            logger.info(
+                bcolors.GREEN + "[" + nut_wallet.name + "] Published new proofs event.. : (" + event_id.to_hex() + ")" + bcolors.ENDC)
 
-        event = EventBuilder(Kind(7375), content, tags).sign_with_keys(keys)
-        eventid = await client.send_event(event)
-        await self.create_transaction_history_event(nut_wallet, amount, nut_wallet.unit, old_event_id, eventid.id,
+        await self.create_transaction_history_event(nut_wallet, amount, nut_wallet.unit, destroyed, created,
                                                     direction, marker, sender_hex, event_hex, client, keys)
+        return created
+
+    @timed("melt")
+    async def blank_outputs(self, cashu_wallet, fee_reserve) -> list:
+        # The NUT-08 blank outputs the mint signs the unused fee reserve of a melt to, as json. Saving them before
+        # we melt lets us restore the change from the melt quote if we are interrupted before we get the answer.
+        from cashu.core.helpers import calculate_number_of_blank_outputs
+
+        secrets, rs, paths = await cashu_wallet.generate_n_secrets(calculate_number_of_blank_outputs(fee_reserve))
+        return [{"secret": secret, "r": r.private_key.hex(), "path": path}
+                for secret, r, path in zip(secrets, rs, paths)]
+
+    async def melt_with_change(self, cashu_wallet, proofs, quote_id, blank_outputs):
+        # Melts the proofs and returns the change the mint gave back for the unused fee reserve
+        from cashu.core.crypto.secp import PrivateKey
+        from cashu.wallet.v1_api import LedgerAPI
+
+        rs = [PrivateKey(bytes.fromhex(output["r"]), raw=True) for output in blank_outputs]
+        outputs, rs = cashu_wallet._construct_outputs([1] * len(blank_outputs),
+                                                      [output["secret"] for output in blank_outputs], rs)
+        try:
+            status = await LedgerAPI.melt(cashu_wallet, quote_id, proofs, outputs)
+            if not (status.paid or status.state == "PAID"):
+                raise Exception("could not pay invoice.")
+            await cashu_wallet.invalidate(proofs)
+            return await self.melt_change(cashu_wallet, status.change, blank_outputs)
+        finally:
+            cashu_wallet.proofs = []
+
+    async def melt_change(self, cashu_wallet, promises, blank_outputs) -> list:
+        # turns the signatures the mint returned for our blank outputs into proofs, the mint signs as many of
+        # them as it needs for the change, in order
+        from cashu.core.crypto.secp import PrivateKey
+        from cashu.core.models import BlindedSignature
+
+        if not promises:
+            return []
+        promises = [BlindedSignature.parse_obj(promise) if isinstance(promise, dict) else promise
+                    for promise in promises]
+        used = blank_outputs[:len(promises)]
+        return await cashu_wallet._construct_proofs(promises, [output["secret"] for output in used],
+                                                    [PrivateKey(bytes.fromhex(output["r"]), raw=True)
+                                                     for output in used],
+                                                    [output["path"] for output in used])
+
+    def melt_target(self, cashu_wallet, amount: int) -> int:
+        # the value of swapped proofs (on the active keyset) that pays amount plus their own input fees
+        from cashu.core.split import amount_split
+
+        fee_ppk = keyset_fees(cashu_wallet).get(cashu_wallet.keyset_id, 0)
+        target = amount
+        while True:
+            fee = (len(amount_split(target)) * fee_ppk + 999) // 1000
+            if amount + fee <= target:
+                return target
+            target = amount + fee
+
+    async def melt_inputs(self, nut_wallet, mint_url, cashu_wallet, amount, client, keys):
+        # The mint only gives back the unused fee reserve as change (NUT-08 blank outputs), whatever the inputs of a
+        # melt are worth above amount (quote amount plus fee reserve) is lost. So we melt proofs worth exactly amount
+        # plus their input fees, if we don't hold such proofs we swap for them first. Call with the mint locked.
+        # Returns the proofs to melt, or None if the balance is too low.
+        from cashu.core.split import amount_split
 
-        print(
-            bcolors.GREEN + "[" + nut_wallet.name + "] Published new proofs event.. : (" + eventid.id.to_hex() + ")" + bcolors.ENDC)
-
-        return eventid.id
-
+        mint = self.get_mint(nut_wallet, mint_url)
+        fees_ppk = keyset_fees(cashu_wallet)
+        inputs = self.coin_selector.select_exact(mint.proofs, amount, fees_ppk)
+        if inputs is not None:
+            return inputs
+
+        target = self.melt_target(cashu_wallet, amount)
+        inputs = self.coin_selector.select_for_swap(mint.proofs, target, fees_ppk)
+        if inputs is None:
+            return None
+        change = sum(proof.amount for proof in inputs) - self.coin_selector.input_fee(inputs, fees_ppk) - target
+        amounts = amount_split(target)
+        new_proofs = await self.swap_to_amounts(cashu_wallet, [proof.to_cashu() for proof in inputs],
+                                                amounts + amount_split(change))
+        await self.update_spend_mint_proof_event(nut_wallet, inputs, mint_url, "", None, None, client, keys,
+                                                 new_proofs)
+        mint = self.get_mint(nut_wallet, mint_url)
+        return [mint.proofs.get(proof.secret) for proof in new_proofs[:len(amounts)]]
+
+    @timed("mint_swap")
+    async def swap_to_amounts(self, cashu_wallet, proofs, amounts, secret_locks=None):
+        # Swaps proofs for new proofs with exactly the given amounts, the amounts have to add up to the
+        # value of the proofs minus the input fees. secret_locks optionally holds a P2PK lock per output,
+        # None for outputs we keep. Returns the new proofs in the order of the amounts.
+        from cashu.wallet.v1_api import LedgerAPI
+
+        if secret_locks is None:
+            secret_locks = [None] * len(amounts)
+        own = [index for index, secret_lock in enumerate(secret_locks) if secret_lock is None]
+        secrets = [None] * len(amounts)
+        rs = [None] * len(amounts)
+        derivation_paths = ["custom"] * len(amounts)
+        if len(own) > 0:
+            own_secrets, own_rs, own_paths = await cashu_wallet.generate_n_secrets(len(own))
+            for index, secret, r, path in zip(own, own_secrets, own_rs, own_paths):
+                secrets[index], rs[index], derivation_paths[index] = secret, r, path
+        for index, secret_lock in enumerate(secret_locks):
+            if secret_lock is not None:
+                # every serialization gets a new nonce, so locked outputs never share a secret
+                secrets[index] = secret_lock.serialize()
+
+        outputs, rs = cashu_wallet._construct_outputs(amounts, secrets, rs)
+        promises = await LedgerAPI.split(cashu_wallet, proofs, outputs)
+        new_proofs = await cashu_wallet._construct_proofs(promises, secrets, rs, derivation_paths)
+        await cashu_wallet.invalidate(proofs)
+        return new_proofs
+
+    def pack_chunks(self, mint: NutMint, secrets):
+        # splits proofs into chunks of at most max_chunk_proofs proofs and max_chunk_bytes of json
+        # (NIP44 can't encrypt more than 64kB)
+        chunks = []
+        chunk = []
+        size = 0
+        for secret in secrets:
+            proof_size = len(json.dumps(mint.proofs.get(secret).to_json())) + 2
+            if len(chunk) > 0 and (len(chunk) >= self.max_chunk_proofs or size + proof_size > self.max_chunk_bytes):
+                chunks.append(chunk)
+                chunk = []
+                size = 0
+            chunk.append(secret)
+            size += proof_size
+        if len(chunk) > 0:
+            chunks.append(chunk)
+        return chunks
+
+    @timed("mint_token")
     async def mint_token(self, mint, amount):
-        from cashu.wallet.wallet import Wallet
-        # TODO probably there's a library function for this
-        url = mint + "/v1/mint/quote/bolt11"
-        json_object = {"unit": "sat", "amount": amount}
-
-        headers = {"Content-Type": "application/json; charset=utf-8"}
-        request_body = json.dumps(json_object).encode('utf-8')
-        request = requests.post(url, data=request_body, headers=headers)
-        tree = json.loads(request.text)
+        with self.metrics.span("mint_quote"):
+            quote = await self.mint_http.request_mint_quote(mint, amount)
 
         lnbits_config = {
             "LNBITS_ADMIN_KEY": os.getenv("LNBITS_ADMIN_KEY"),
@@ -400,32 +727,30 @@ class NutZapWallet:
         }
         lnbits_config_obj = namedtuple("LNBITSCONFIG", lnbits_config.keys())(*lnbits_config.values())
 
-        paymenthash = pay_bolt11_ln_bits(tree["request"], lnbits_config_obj)
-        print(paymenthash)
-        url = f"{mint}/v1/mint/quote/bolt11/{tree['quote']}"
-
-        response = requests.get(url, data=request_body, headers=headers)
-        tree2 = json.loads(response.text)
-        waitfor = 5
-        while not tree2["paid"]:
-            await asyncio.sleep(1)
-            response = requests.get(url, data=request_body, headers=headers)
-            tree2 = json.loads(response.text)
-            waitfor -= 1
-            if waitfor == 0:
-                break
-
-        if tree2["paid"]:
-            # print(response.text)
-            wallet = await Wallet.with_db(
-                url=mint,
-                db="db/Cashu",
-            )
-
-            await wallet.load_mint()
-            proofs = await wallet.mint(amount, tree['quote'], None)
+        # start watching the quote before paying, so we don't miss the state change
+        paid = asyncio.create_task(self.mint_http.wait_for_mint_quote(mint, quote['quote'], self.mint_quote_timeout))
+        try:
+            with self.metrics.span("lightning_payment"):
+                paymenthash = await asyncio.to_thread(pay_bolt11_ln_bits, quote["request"], lnbits_config_obj)
+            logger.debug("Payment hash: %s", paymenthash)
+            if paymenthash == "Error":
+                return None
+
+            with self.metrics.span("wait_for_payment"):
+                is_paid = await paid
+        finally:
+            # stops polling the quote if paying failed, does nothing once it finished
+            paid.cancel()
+        if is_paid:
+            wallet = await self.mint_pool.get_wallet(mint, "minter")
+            with self.metrics.span("mint"):
+                proofs = await wallet.mint(amount, quote['quote'], None)
             return proofs
 
+        logger.error(bcolors.RED + "[" + mint + "] Mint quote " + quote['quote'] + " was not paid in time" +
+                     bcolors.ENDC)
+        return None
+
     async def announce_nutzap_info_event(self, nut_wallet, client, keys):
         tags = []
         for relay in nut_wallet.relays:
@@ -438,80 +763,66 @@ class NutZapWallet:
 
         event = EventBuilder(Kind(10019), "", tags).sign_with_keys(keys)
         eventid = await client.send_event(event)
-        print(
+        logger.info(
             bcolors.CYAN + "[" + nut_wallet.name + "] Announced mint preferences info event (" + eventid.id.to_hex() + ")" + bcolors.ENDC)
 
+    @timed("mint_preferences")
     async def fetch_mint_info_event(self, pubkey, client):
-        mint_info_filter = Filter().kind(Kind(10019)).author(PublicKey.parse(pubkey))
-        preferences = await client.fetch_events([mint_info_filter], timedelta(seconds=5))
-        mints = []
-        relays = []
-        pubkey = ""
-
-        if len(preferences.to_vec()) > 0:
-            preference = preferences.to_vec()[0]
-
-            for tag in preference.tags().to_vec():
-                if tag.as_vec()[0] == "pubkey":
-                    pubkey = tag.as_vec()[1]
-                elif tag.as_vec()[0] == "relay":
-                    relays.append(tag.as_vec()[1])
-                elif tag.as_vec()[0] == "mint":
-                    mints.append(tag.as_vec()[1])
+        preference = await self.mint_preferences.get(pubkey, client)
+        return preference.p2pk_pubkey, list(preference.mints), list(preference.relays)
 
-        return pubkey, mints, relays
+    async def prefetch_mint_info_events(self, pubkeys, client):
+        # Loads the nutzap info of many recipients with one query, e.g. before zapping a list of users
+        await self.mint_preferences.prefetch(pubkeys, client)
 
+    @timed("update_proofs")
     async def update_spend_mint_proof_event(self, nut_wallet, send_proofs, mint_url, marker, sender_hex, event_hex,
-                                            client, keys):
-        mint = self.get_mint(nut_wallet, mint_url)
+                                            client, keys, change_proofs=None):
+        # change_proofs are proofs we got back from the mint for the spent ones, e.g. the keep proofs of a swap
+        async with self.wallet_state.lock(nut_wallet, [mint_url]):
+            mint = self.get_mint(nut_wallet, mint_url)
+
+            logger.debug("Spending on %s: %s", mint.mint_url, send_proofs)
+            dirty_chunks = mint.proofs.chunks_of(send_proofs)
+            amount = mint.proofs.remove_all(send_proofs)
+            if change_proofs is not None:
+                amount -= mint.proofs.add_all(change_proofs)
 
-        print(mint.mint_url)
-        print(send_proofs)
-        amount = 0
-        for send_proof in send_proofs:
-            entry = [x for x in mint.proofs if x.id == send_proof.id and x.secret == send_proof.secret]
-            if len(entry) > 0:
-                mint.proofs.remove(entry[0])
-                amount += send_proof.amount
-
-        # create new event
-        mint.previous_event_id = await self.create_unspent_proof_event(nut_wallet, mint.proofs, mint.mint_url, amount,
-                                                                       "out",
-                                                                       marker, sender_hex,
-                                                                       event_hex, client, keys)
-        nut_wallet.balance = nut_wallet.balance - amount
-        return await self.update_nut_wallet(nut_wallet, [mint.mint_url], client, keys)
+            async with self.writer.batch(client, keys):
+                # rewrite only the proof events that held the spent proofs
+                await self.create_unspent_proof_event(nut_wallet, mint, dirty_chunks, amount, "out",
+                                                      marker, sender_hex, event_hex, client, keys)
+                self.wallet_state.commit(nut_wallet, mint)
+                nut_wallet.balance = nut_wallet.balance - amount
+                return await self.update_nut_wallet(nut_wallet, [mint.mint_url], client, keys)
 
     async def mint_cashu(self, nut_wallet: NutWallet, mint_url, client, keys, amount):
-        print("Minting new tokens on: " + mint_url)
+        logger.info("Minting new tokens on: " + mint_url)
         # Mint the Token at the selected mint
         proofs = await self.mint_token(mint_url, amount)
-        print(proofs)
+        logger.debug("Minted: %s", proofs)
+        if proofs is None:
+            return nut_wallet
 
         return await self.add_proofs_to_wallet(nut_wallet, mint_url, proofs, "created", None, None, client, keys)
 
+    @timed("add_proofs")
     async def add_proofs_to_wallet(self, nut_wallet, mint_url, new_proofs, marker, sender, event, client: Client,
                                    keys: Keys):
-        mint = self.get_mint(nut_wallet, mint_url)
-        additional_amount = 0
-        # store the new proofs in proofs_temp
-        all_proofs = []
-        # check for other proofs from same mint, add them to the list of proofs
-        for nut_proof in mint.proofs:
-            all_proofs.append(nut_proof)
-        # add new proofs and calculate additional balance
-        for proof in new_proofs:
-            all_proofs.append(proof)
-            nut_wallet.balance += proof.amount
-            additional_amount += proof.amount
-
-        print("New amount: " + str(additional_amount))
-        mint.previous_event_id = await self.create_unspent_proof_event(nut_wallet, all_proofs, mint_url,
-                                                                       additional_amount, "in",
-                                                                       marker,
-                                                                       sender, event, client, keys)
-
-        return await self.update_nut_wallet(nut_wallet, [mint_url], client, keys)
+        async with self.wallet_state.lock(nut_wallet, [mint_url]):
+            mint = self.get_mint(nut_wallet, mint_url)
+            # add new proofs to the proofs we already have on this mint and calculate additional balance
+            additional_amount = mint.proofs.add_all(new_proofs)
+            nut_wallet.balance += additional_amount
+
+            logger.info("New amount: " + str(additional_amount))
+            async with self.writer.batch(client, keys):
+                # the new proofs go into new proof events, the existing ones stay untouched
+                await self.create_unspent_proof_event(nut_wallet, mint, set(), additional_amount, "in",
+                                                      marker, sender, event, client, keys)
+                self.wallet_state.commit(nut_wallet, mint)
+
+                return await self.update_nut_wallet(nut_wallet, [mint_url], client, keys)
 
     async def handle_low_balance_on_mint(self, nut_wallet, mint_to_send, mint, amount, client, keys):
 
@@ -521,71 +832,47 @@ class NutZapWallet:
             await self.mint_cashu(nut_wallet, mint_to_send, client, keys, required_amount)
 
         elif nut_wallet.missing_balance_strategy == "swap":
-            for nutmint in nut_wallet.nutmints:
-                estimated_fees = 3
-                if nutmint.available_balance() > required_amount + estimated_fees:
-                    print(nutmint.mint_url)
-                    await self.swap(required_amount, mint_to_send, nutmint.mint_url, nut_wallet)
-                    break
+            # all other mints quote the payment at once, the cheapest one pays
+            await self.liquidity_router.move(nut_wallet, mint_to_send, required_amount, client, keys)
         else:
-            print(bcolors.RED + "[" + nut_wallet.name + "] Not enough Balance on Mint, mint some tokens first. " + str(
-                amount) + " " + nut_wallet.unit + bcolors.ENDC)
+            logger.error(bcolors.RED + "[" + nut_wallet.name + "] Not enough Balance on Mint, mint some tokens first. "
+                         + str(amount) + " " + nut_wallet.unit + bcolors.ENDC)
 
+    @timed("send_nut_zap")
     async def send_nut_zap(self, amount, comment, nut_wallet: NutWallet, zapped_event, zapped_user, client: Client,
                            keys: Keys):
-        from cashu.wallet.wallet import Wallet
         unit = "sats"
 
         p2pk_pubkey, mints, relays = await self.fetch_mint_info_event(zapped_user, client)
         if len(mints) == 0:
-            print("No preferred mint set, returning")
+            logger.warning("No preferred mint set, returning")
             return
 
-        mint_success = False
-        index = 0
-        mint_url = ""
-        sufficent_budget = False
-
-        # Some logic.
+        # Some logic. Mints with an open circuit are skipped, the others are tried in order of their health score.
         # First look if we have balance on a mint the user has in their list of trusted mints and use it
-        for mint in nut_wallet.nutmints:
-            if mint.available_balance() >= amount and mint.mint_url in mints:
-                mint_url = mint.mint_url
-                sufficent_budget = True
-                break
-        # If that's not the case, lets look or mints we both trust, take the first one.
-        if not sufficent_budget:
-            try:
-                mint_url = next(i for i in nut_wallet.mints if i in mints)
-                if mint_url is not None:
-                    mint = self.get_mint(nut_wallet, mint_url)
-                    if mint.available_balance() < amount:
-                        await self.handle_low_balance_on_mint(nut_wallet, mint_url, mint, amount, client, keys)
-            except StopIteration:
-                mint = self.get_mint(nut_wallet, mints[0])
-                mint_url = mint.mint_url
-                await self.handle_low_balance_on_mint(nut_wallet, mint_url, mint, amount, client, keys)
-
-            # If that's not the case, iterate over the recipents mints and try to mint there. This might be a bit dangerous as not all mints might give cashu, so loss of ln is possible
-            if mint_url is None:
-                if nut_wallet.trust_unknown_mints:
-                    # maybe we don't do this for now..
-                    while not mint_success:
-                        try:
-                            mint_url = mints[index]  #
-                            # Maybe we introduce a list of known failing mints..
-                            if mint_url == "https://stablenut.umint.cash":
-                                raise Exception("stablemint bad")
-                            mint = self.get_mint(nut_wallet, mint_url)
-                            if mint.available_balance() < amount:
-                                await self.handle_low_balance_on_mint(nut_wallet, mint_url, mint, amount, client, keys)
-                            mint_success = True
-                        except:
-                            mint_success = False
-                            index += 1
-                else:
-                    print("No trusted mints founds, enable trust_unknown_mints if you still want to proceed...")
-                    return
+        self.wallet_state.adopt(nut_wallet)
+        funded = self.mint_health.rank([mint.mint_url for mint in nut_wallet.nutmints
+                                        if mint.available_balance() >= amount and mint.mint_url in mints])
+        if len(funded) > 0:
+            mint_url = funded[0]
+        else:
+            # If that's not the case, lets look for mints we both trust, otherwise we use one of the recipient's mints
+            # if the wallet opted in. Minting there might be a bit dangerous as not all mints might give cashu, so
+            # loss of ln is possible
+            candidates = self.mint_health.rank([i for i in nut_wallet.mints if i in mints])
+            if len(candidates) == 0 and not nut_wallet.trust_unknown_mints:
+                logger.error(bcolors.RED + "[" + nut_wallet.name + "] We don't trust any of the recipient's mints, "
+                             "set trust_unknown_mints to mint on them" + bcolors.ENDC)
+                return
+            if len(candidates) == 0:
+                candidates = self.mint_health.rank(mints)
+            if len(candidates) == 0:
+                logger.error(bcolors.RED + "[" + nut_wallet.name +
+                             "] None of the recipient's mints is reachable right now" + bcolors.ENDC)
+                return
+            mint_url = candidates[0]
+            mint = self.get_mint(nut_wallet, mint_url)
+            await self.handle_low_balance_on_mint(nut_wallet, mint_url, mint, amount, client, keys)
 
         tags = [Tag.parse(["amount", str(amount)]),
                 Tag.parse(["unit", unit]),
@@ -595,160 +882,414 @@ class NutZapWallet:
         if zapped_event != "" and zapped_event is not None:
             tags.append(Tag.parse(["e", zapped_event]))
 
-        mint = self.get_mint(nut_wallet, mint_url)
+        # from here until the proof events are updated nobody else may use the proofs of this mint
+        async with self.wallet_state.lock(nut_wallet, [mint_url]):
+            mint = self.get_mint(nut_wallet, mint_url)
 
-        cashu_wallet = await Wallet.with_db(
-            url=mint_url,
-            db="db/Cashu",
-            name="wallet_mint_api",
-        )
+            cashu_wallet = await self.mint_pool.get_wallet(mint_url, "sender",
+                                                           keyset_ids=list(mint.proofs.keyset_balances.keys()))
+            fees_ppk = keyset_fees(cashu_wallet)
 
-        await cashu_wallet.load_mint()
-        secret_lock = await cashu_wallet.create_p2pk_lock("02" + p2pk_pubkey)  # sender side
+            try:
+                proofs = None
+                keep_proofs = []
+                # A nutzap to a recipient with a P2PK key (NIP-61, the usual case) always needs a swap: the mint
+                # has to sign new proofs locked to that key. Only unlocked sends can skip the swap, if we hold
+                # proofs for the exact amount we send them as they are.
+                if p2pk_pubkey == "":
+                    proofs = self.coin_selector.select_exact(mint.proofs, amount, fees_ppk)
+                    send_proofs = proofs
+                if proofs is None:
+                    secret_lock = None
+                    if p2pk_pubkey != "":
+                        secret_lock = await cashu_wallet.create_p2pk_lock("02" + p2pk_pubkey)  # sender side
+                    # we pick the inputs that leave the least change, so the swap returns few change proofs
+                    proofs = self.coin_selector.select_for_swap(mint.proofs, amount, fees_ppk)
+                    if proofs is None:
+                        raise Exception("balance too low")
+                    with self.metrics.span("mint_swap"):
+                        keep_proofs, send_proofs = await cashu_wallet.split([proof.to_cashu() for proof in proofs],
+                                                                            amount, secret_lock)
+
+                logger.debug("Keeping: %s", keep_proofs)
+
+                for proof in send_proofs:
+                    nut_proof = {
+                        'id': proof.id,
+                        'C': proof.C,
+                        'amount': proof.amount,
+                        'secret': proof.secret,
+                    }
+                    tags.append(Tag.parse(["proof", json.dumps(nut_proof)]))
+
+                with self.metrics.span("sign"):
+                    event = EventBuilder(Kind(9321), comment, tags).sign_with_keys(keys)
+                # the nutzap and the proof, history and wallet updates are published together
+                async with self.writer.batch(client, keys):
+                    event_id = await self.writer.publish(event, client, keys)
+
+                    await self.update_spend_mint_proof_event(nut_wallet, proofs, mint_url, "zapped",
+                                                             keys.public_key().to_hex(), event_id.to_hex(), client,
+                                                             keys, keep_proofs)
+
+                self.metrics.inc("nutzap_sent_total", mint=mint_url)
+                self.metrics.inc("nutzap_sent_amount_total", amount, unit=nut_wallet.unit)
+                logger.info(bcolors.YELLOW + "[" + nut_wallet.name + "] Sent NutZap 🥜️⚡ with " + str(
+                    amount) + " " + nut_wallet.unit + " to "
+                            + PublicKey.parse(zapped_user).to_bech32() +
+                            "(" + event_id.to_hex() + ")" + bcolors.ENDC)
+
+            except Exception as e:
+                self.metrics.inc("nutzap_failures_total", operation="send_nut_zap")
+                logger.error(bcolors.RED + "Could not send NutZap: " + str(e) + bcolors.ENDC)
+
+    @timed("send_nut_zaps")
+    async def send_nut_zaps(self, payouts: list, nut_wallet: NutWallet, client: Client, keys: Keys):
+        # Sends many nutzaps (NutZapPayout) at once: the recipients' mint preferences are fetched with one query,
+        # every mint swaps once for all of its recipients, with outputs locked to each recipient, the mints run
+        # concurrently and each mint's nutzaps and proof events are published together once its swap is done.
+        # Returns the payouts, the ones that were sent have an event_id.
+        from cashu.core.split import amount_split
 
-        try:
-            proofs, fees = await cashu_wallet.select_to_send(mint.proofs, amount)
-            print(fees)
-            keep_proofs, send_proofs = await cashu_wallet.swap_to_send(
-                proofs, amount, secret_lock=secret_lock, set_reserved=True
-            )
-
-            print(keep_proofs)
-
-            for proof in send_proofs:
-                nut_proof = {
-                    'id': proof.id,
-                    'C': proof.C,
-                    'amount': proof.amount,
-                    'secret': proof.secret,
-                }
-                tags.append(Tag.parse(["proof", json.dumps(nut_proof)]))
-
-            event = EventBuilder(Kind(9321), comment, tags).sign_with_keys(keys)
-            response = await client.send_event(event)
-
-            await self.update_spend_mint_proof_event(nut_wallet, proofs, mint_url, "zapped", keys.public_key().to_hex(),
-                                                     response.id.to_hex(), client, keys)
-
-            print(bcolors.YELLOW + "[" + nut_wallet.name + "] Sent NutZap 🥜️⚡ with " + str(
-                amount) + " " + nut_wallet.unit + " to "
-                  + PublicKey.parse(zapped_user).to_bech32() +
-                  "(" + response.id.to_hex() + ")" + bcolors.ENDC)
+        unit = "sats"
+        await self.mint_preferences.prefetch([payout.zapped_user for payout in payouts], client)
+
+        # group the payouts by mint, prefer mints that hold enough balance
+        self.wallet_state.adopt(nut_wallet)
+        budgets = {mint.mint_url: mint.available_balance() for mint in nut_wallet.nutmints}
+        groups = {}
+        for payout in payouts:
+            preference = await self.mint_preferences.get(payout.zapped_user, client)
+            payout.p2pk_pubkey = preference.p2pk_pubkey
+            funded = self.mint_health.rank([mint_url for mint_url in preference.mints
+                                            if budgets.get(mint_url, 0) >= payout.amount])
+            trusted = self.mint_health.rank([mint_url for mint_url in nut_wallet.mints
+                                             if mint_url in preference.mints])
+            untrusted = self.mint_health.rank(preference.mints) if nut_wallet.trust_unknown_mints else []
+            if len(funded) > 0:
+                payout.mint_url = funded[0]
+            elif len(trusted) > 0:
+                payout.mint_url = trusted[0]
+            elif len(untrusted) > 0:
+                # only if the wallet opted in, minting on a mint we don't know may lose the lightning payment
+                payout.mint_url = untrusted[0]
+            else:
+                logger.error(bcolors.RED + "[" + nut_wallet.name + "] No common mint with " + payout.zapped_user +
+                             ", skipping" + bcolors.ENDC)
+                continue
+            budgets[payout.mint_url] = budgets.get(payout.mint_url, 0) - payout.amount
+            groups.setdefault(payout.mint_url, []).append(payout)
 
-        except Exception as e:
-            print(e)
+        async def fund_group(mint_url, group):
+            mint = self.get_mint(nut_wallet, mint_url)
+            total = sum(payout.amount for payout in group)
+            if mint.available_balance() < total:
+                await self.handle_low_balance_on_mint(nut_wallet, mint_url, mint, total, client, keys)
 
-    def print_transaction_history(self, transactions, keys):
-        for transaction in transactions:
-            try:
-                content = nip44_decrypt(keys.secret_key(), keys.public_key(), transaction.content())
-            except:
-                content = nip04_decrypt(keys.secret_key(), keys.public_key(), transaction.content())
-
-            innertags = json.loads(content)
-            direction = ""
-            amount = ""
-            unit = "sats"
-            for tag in innertags:
-                if tag[0] == "direction":
-                    direction = tag[1]
-                elif tag[0] == "amount":
-                    amount = tag[1]
-                    unit = tag[2]
-                    if amount == "1" and unit == "sats":
-                        unit = "sat"
-            sender = ""
-            event = ""
-            for tag in transaction.tags().to_vec():
-                if tag.as_vec()[0] == "p":
-                    sender = tag.as_vec()[1]
-                elif tag.as_vec()[0] == "e":
-                    event = tag.as_vec()[1]
-                    # marker = tag.as_vec()[2]
-
-            if direction == "in":
-                color = bcolors.GREEN
-                action = "minted"
-                dir = "from"
-            else:
-                color = bcolors.RED
-                action = "spent"
-                dir = "to"
-
-            if sender != "" and event != "":
-                print(
-                    color + f"{direction:3}" + " " + f"{amount:6}" + " " + unit + " at " + transaction.created_at().to_human_datetime().replace(
-                        "T", " ").replace("Z",
-                                          " ") + "GMT" + bcolors.ENDC + " " + bcolors.YELLOW + " (Nutzap 🥜⚡️ " + dir + ": " + PublicKey.parse(
-                        sender).to_bech32() + "(" + event + "))" + bcolors.ENDC)
-            else:
-                print(
-                    color + f"{direction:3}" + " " + f"{amount:6}" + " " + unit + " at " + transaction.created_at().to_human_datetime().replace(
-                        "T", " ").replace("Z", " ") + "GMT" + " " + " (" + action + ")" + bcolors.ENDC)
+        async def swap_group(mint_url, group):
+            mint = self.get_mint(nut_wallet, mint_url)
+            total = sum(payout.amount for payout in group)
+            cashu_wallet = await self.mint_pool.get_wallet(mint_url, "sender",
+                                                           keyset_ids=list(mint.proofs.keyset_balances.keys()))
+            fees_ppk = keyset_fees(cashu_wallet)
+            inputs = self.coin_selector.select_for_swap(mint.proofs, total, fees_ppk)
+            if inputs is None:
+                raise Exception("balance too low")
+
+            amounts = []
+            secret_locks = []
+            for payout in group:
+                secret_lock = None
+                if payout.p2pk_pubkey != "":
+                    secret_lock = await cashu_wallet.create_p2pk_lock("02" + payout.p2pk_pubkey)
+                for amount in amount_split(payout.amount):
+                    amounts.append(amount)
+                    secret_locks.append(secret_lock)
+            sent = len(amounts)
+            change = sum(proof.amount for proof in inputs) - self.coin_selector.input_fee(inputs, fees_ppk) - total
+            amounts += amount_split(change)
+            secret_locks += [None] * (len(amounts) - sent)
+
+            new_proofs = await self.swap_to_amounts(cashu_wallet, [proof.to_cashu() for proof in inputs], amounts,
+                                                    secret_locks)
+            position = 0
+            for payout in group:
+                count = len(amount_split(payout.amount))
+                payout.proofs = new_proofs[position:position + count]
+                position += count
+            return inputs, new_proofs[sent:]
+
+        async def send_group(mint_url, group):
+            # the mint stays locked from the swap until its proof events are updated, the events of each mint are
+            # published as one batch as soon as that mint is done
+            async with self.wallet_state.lock(nut_wallet, [mint_url]):
+                try:
+                    inputs, change_proofs = await swap_group(mint_url, group)
+                except Exception as e:
+                    logger.error(bcolors.RED + "[" + mint_url + "] Could not send nutzaps: " + str(e) + bcolors.ENDC)
+                    return
 
-    async def reedeem_nutzap(self, event, nut_wallet: NutWallet, client: Client, keys: Keys):
-        from cashu.wallet.wallet import Wallet
+                async with self.writer.batch(client, keys):
+                    for payout in group:
+                        tags = [Tag.parse(["amount", str(payout.amount)]),
+                                Tag.parse(["unit", unit]),
+                                Tag.parse(["u", mint_url]),
+                                Tag.parse(["p", payout.zapped_user])]
+                        if payout.zapped_event != "" and payout.zapped_event is not None:
+                            tags.append(Tag.parse(["e", payout.zapped_event]))
+                        for proof in payout.proofs:
+                            tags.append(Tag.parse(["proof", json.dumps(NutProof.from_proof(proof).to_json())]))
+                        event = EventBuilder(Kind(9321), payout.comment, tags).sign_with_keys(keys)
+                        payout.event_id = (await self.writer.publish(event, client, keys)).to_hex()
+
+                    sent = [payout.event_id for payout in group]
+                    self.metrics.inc("nutzap_sent_total", len(sent), mint=mint_url)
+                    self.metrics.inc("nutzap_sent_amount_total", sum(payout.amount for payout in group),
+                                     unit=nut_wallet.unit)
+                    await self.update_spend_mint_proof_event(nut_wallet, inputs, mint_url, "zapped",
+                                                             [keys.public_key().to_hex()] * len(sent), sent, client,
+                                                             keys, change_proofs)
+            logger.info(bcolors.YELLOW + "[" + nut_wallet.name + "] Sent " + str(len(sent)) +
+                        " NutZaps 🥜️⚡ with " + str(sum(payout.amount for payout in group)) +
+                        " " + nut_wallet.unit + " on " + mint_url + bcolors.ENDC)
+
+        mint_urls = list(groups.keys())
+        await asyncio.gather(*[fund_group(mint_url, groups[mint_url]) for mint_url in mint_urls],
+                             return_exceptions=True)
+        await asyncio.gather(*[send_group(mint_url, groups[mint_url]) for mint_url in mint_urls])
+
+        return payouts
+
+    def parse_transaction(self, event, innertags) -> NutTransaction:
+        transaction = NutTransaction()
+        transaction.event_id = event.id().to_hex()
+        transaction.created_at = event.created_at().as_secs()
+
+        for tag in innertags:
+            if tag[0] == "direction":
+                transaction.direction = tag[1]
+            elif tag[0] == "amount":
+                transaction.amount = int(tag[1])
+                if len(tag) > 2:
+                    transaction.unit = tag[2]
+            elif tag[0] == "e" and len(tag) > 3:
+                if tag[3] == "created":
+                    transaction.created.append(tag[1])
+                elif tag[3] == "destroyed":
+                    transaction.destroyed.append(tag[1])
+
+        for tag in event.tags().to_vec():
+            if tag.as_vec()[0] == "p":
+                transaction.counterparty = tag.as_vec()[1]
+            elif tag.as_vec()[0] == "e":
+                transaction.e_tags.append(tag.as_vec()[1])
+                if len(tag.as_vec()) > 3:
+                    transaction.marker = tag.as_vec()[3]
+        return transaction
+
+    async def iter_transaction_history(self, client, keys, page_size=50, until=None, limit=None,
+                                       timeout=timedelta(seconds=10)):
+        # Yields the transaction history from newest to oldest, fetching and decrypting one page at a time.
+        # until (unix timestamp) starts the history at an older point, limit stops after that many transactions.
+        count = 0
+        boundary = set()  # ids of events at the until timestamp we already yielded
+        while True:
+            history_filter = Filter().author(keys.public_key()).kinds([Kind(7376)]).limit(page_size)
+            if until is not None:
+                history_filter = history_filter.until(Timestamp.from_secs(until))
+            page = (await client.fetch_events([history_filter], timeout)).to_vec()
+            events = [event for event in page if event.id().to_hex() not in boundary]
+            if len(events) == 0:
+                return
+            events.sort(key=lambda event: event.created_at().as_secs(), reverse=True)
+            if self.event_store is not None:
+                self.event_store.save_events(events)
+            self.seen_nutzaps.learn_history(events)
+
+            contents = await self.decrypt_events([(event, None) for event in events], keys)
+            for event, content in zip(events, contents):
+                if content is None:
+                    continue
+                yield self.parse_transaction(event, content)
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+            if len(page) < page_size:
+                return
+            oldest = events[-1].created_at().as_secs()
+            if oldest != until:
+                boundary = set()
+            boundary.update(event.id().to_hex() for event in events if event.created_at().as_secs() == oldest)
+            until = oldest
+
+    def print_transaction(self, transaction: NutTransaction):
+        unit = transaction.unit
+        if transaction.amount == 1 and unit == "sats":
+            unit = "sat"
+
+        if transaction.direction == "in":
+            color = bcolors.GREEN
+            action = "minted"
+            dir = "from"
+        else:
+            color = bcolors.RED
+            action = "spent"
+            dir = "to"
+
+        created_at = Timestamp.from_secs(transaction.created_at).to_human_datetime().replace("T", " ").replace("Z", " ")
+        if transaction.counterparty != "" and len(transaction.e_tags) > 0:
+            print(
+                color + f"{transaction.direction:3}" + " " + f"{transaction.amount:6}" + " " + unit + " at " + created_at + "GMT" + bcolors.ENDC + " " + bcolors.YELLOW + " (Nutzap 🥜⚡️ " + dir + ": " + PublicKey.parse(
+                    transaction.counterparty).to_bech32() + "(" + ", ".join(transaction.e_tags) + "))" + bcolors.ENDC)
+        else:
+            print(
+                color + f"{transaction.direction:3}" + " " + f"{transaction.amount:6}" + " " + unit + " at " + created_at + "GMT" + " " + " (" + action + ")" + bcolors.ENDC)
+
+    def print_transaction_history(self, transactions, keys):
+        contents = [self.decryption_cache.lookup(transaction.id().to_hex()) for transaction in transactions]
+        missing = [index for index, content in enumerate(contents) if content is None]
+        decrypted = self.decryptor.decrypt([transactions[index] for index in missing], keys)
+        parsed = self.cache_decrypted([transactions[index] for index in missing], decrypted)
+        for index, content in zip(missing, parsed):
+            contents[index] = content
+
+        for transaction, innertags in zip(transactions, contents):
+            if innertags is None:
+                continue
+            self.print_transaction(self.parse_transaction(transaction, innertags))
+
+    def parse_nutzap(self, event) -> NutZap:
         from cashu.core.base import Proof
-        from cashu.core.crypto.keys import PrivateKey
+        nutzap = NutZap()
+        nutzap.event = event
+        nutzap.sender = event.author().to_hex()
+        nutzap.message = event.content()
+        for tag in event.tags().to_vec():
+            if tag.as_vec()[0] == "proof":
+                proof_json = json.loads(tag.as_vec()[1])
+                proof = Proof().from_dict(proof_json)
+                nutzap.proofs.append(proof)
+            elif tag.as_vec()[0] == "u":
+                nutzap.mint_url = tag.as_vec()[1]
+            elif tag.as_vec()[0] == "amount":
+                nutzap.amount = int(tag.as_vec()[1])
+            elif tag.as_vec()[0] == "unit":
+                nutzap.unit = tag.as_vec()[1]
+            elif tag.as_vec()[0] == "p":
+                nutzap.zapped_user = tag.as_vec()[1]
+            elif tag.as_vec()[0] == "e":
+                nutzap.zapped_event = tag.as_vec()[1]
+        return nutzap
+
+    @timed("reedeem_nutzap")
+    async def reedeem_nutzap(self, event, nut_wallet: NutWallet, client: Client, keys: Keys):
+        sender = event.author().to_hex()
+        message = event.content()
+        if self.seen_nutzaps.seen(event.id().to_hex()):
+            self.metrics.inc("nutzap_duplicates_total")
+            logger.info("NutZap " + event.id().to_hex() + " was already redeemed")
+            return None, message, sender
         try:
-            proofs = []
-            mint_url = ""
-            amount = 0
-            unit = "sat"
-            zapped_user = ""
-            zapped_event = ""
-            sender = event.author().to_hex()
-            message = event.content()
-            for tag in event.tags().to_vec():
-                if tag.as_vec()[0] == "proof":
-                    proof_json = json.loads(tag.as_vec()[1])
-                    proof = Proof().from_dict(proof_json)
-                    proofs.append(proof)
-                elif tag.as_vec()[0] == "u":
-                    mint_url = tag.as_vec()[1]
-                elif tag.as_vec()[0] == "amount":
-                    amount = int(tag.as_vec()[1])
-                elif tag.as_vec()[0] == "unit":
-                    unit = tag.as_vec()[1]
-                elif tag.as_vec()[0] == "p":
-                    zapped_user = tag.as_vec()[1]
-                elif tag.as_vec()[0] == "e":
-                    zapped_event = tag.as_vec()[1]
-
-            cashu_wallet = await Wallet.with_db(
-                url=mint_url,
-                db="db/Receiver",
-                name="receiver",
-            )
-            cashu_wallet.private_key = PrivateKey(bytes.fromhex(nut_wallet.privkey), raw=True)
-            await cashu_wallet.load_mint()
-
-            new_proofs, _ = await cashu_wallet.redeem(proofs)
-            mint = self.get_mint(nut_wallet, mint_url)
-            print(mint.proofs)
-            print(new_proofs)
+            nutzap = self.parse_nutzap(event)
+            mint_url = nutzap.mint_url
+            cashu_wallet = await self.mint_pool.get_wallet(mint_url, "receiver", nut_wallet.privkey,
+                                                           [proof.id for proof in nutzap.proofs])
+
+            with self.metrics.span("mint_swap"):
+                new_proofs, _ = await cashu_wallet.redeem(nutzap.proofs)
+            cashu_wallet.proofs = []
+            logger.debug("Redeemed on %s: %s", mint_url, new_proofs)
             count_amount = 0
             for proof in new_proofs:
                 count_amount += proof.amount
             await self.add_proofs_to_wallet(nut_wallet, mint_url, new_proofs, "redeemed", event.author().to_hex(),
                                             event.id().to_hex(), client, keys)
+            self.seen_nutzaps.mark([event.id().to_hex()])
 
+            self.metrics.inc("nutzap_redeemed_total", mint=mint_url)
+            self.metrics.inc("nutzap_redeemed_amount_total", count_amount, unit=nut_wallet.unit)
             return count_amount, message, sender
         except Exception as e:
-            print(bcolors.RED + str(e) + bcolors.ENDC)
+            self.metrics.inc("nutzap_failures_total", operation="reedeem_nutzap")
+            if is_spent_error(e):
+                # redeemed before, e.g. by another device, retrying would only fail again
+                self.seen_nutzaps.mark([event.id().to_hex()], "spent")
+            logger.error(bcolors.RED + str(e) + bcolors.ENDC)
             return None, message, sender
 
+    @timed("reedeem_nutzaps")
+    async def reedeem_nutzaps(self, events, nut_wallet: NutWallet, client: Client, keys: Keys):
+        # Redeems a batch of nutzaps with one swap, one proof event, one history event and one wallet event per mint.
+        # Returns the total amount that was redeemed. Afterwards every nutzap that was redeemed, or can never be
+        # (spent or invalid), is marked in seen_nutzaps, the others failed and can be retried.
+        new_events = self.seen_nutzaps.filter_new(events)
+        if len(new_events) < len(events):
+            self.metrics.inc("nutzap_duplicates_total", len(events) - len(new_events))
+        events = new_events
+        nutzaps_by_mint = {}
+        for event in events:
+            try:
+                nutzap = self.parse_nutzap(event)
+            except Exception as e:
+                logger.error(bcolors.RED + "Invalid nutzap " + event.id().to_hex() + ": " + str(e) + bcolors.ENDC)
+                # it will never be redeemable, so it isn't retried
+                self.seen_nutzaps.mark([event.id().to_hex()], "invalid")
+                continue
+            nutzaps_by_mint.setdefault(nutzap.mint_url, []).append(nutzap)
+
+        async def redeem_group(mint_url, nutzaps) -> int:
+            # the swap runs without holding the mint lock or an event batch, only storing and publishing the new
+            # proofs does
+            proofs = [proof for nutzap in nutzaps for proof in nutzap.proofs]
+            try:
+                cashu_wallet = await self.mint_pool.get_wallet(mint_url, "receiver", nut_wallet.privkey,
+                                                               [proof.id for proof in proofs])
+                # the swap signs the P2PK witnesses of all proofs at once
+                with self.metrics.span("mint_swap"):
+                    new_proofs, _ = await cashu_wallet.redeem(proofs)
+                cashu_wallet.proofs = []
+            except Exception as e:
+                logger.error(bcolors.RED + "[" + mint_url + "] Batch redeem failed: " + str(e) + bcolors.ENDC)
+                amount = 0
+                if len(nutzaps) > 1:
+                    # a single bad nutzap (e.g. already redeemed) fails the whole swap, so we redeem one by one
+                    for nutzap in nutzaps:
+                        redeemed_amount, _, _ = await self.reedeem_nutzap(nutzap.event, nut_wallet, client, keys)
+                        if redeemed_amount is not None:
+                            amount += redeemed_amount
+                elif is_spent_error(e):
+                    self.seen_nutzaps.mark([nutzaps[0].event.id().to_hex()], "spent")
+                # nutzaps that are not marked seen now failed, the redemption queue retries them
+                return amount
+
+            # one proof event, history event and wallet event per mint
+            await self.add_proofs_to_wallet(nut_wallet, mint_url, new_proofs, "redeemed",
+                                            [nutzap.sender for nutzap in nutzaps],
+                                            [nutzap.event.id().to_hex() for nutzap in nutzaps], client, keys)
+            self.seen_nutzaps.mark([nutzap.event.id().to_hex() for nutzap in nutzaps])
+            amount = sum(proof.amount for proof in new_proofs)
+            self.metrics.inc("nutzap_redeemed_total", len(nutzaps), mint=mint_url)
+            self.metrics.inc("nutzap_redeemed_amount_total", amount, unit=nut_wallet.unit)
+            logger.info(bcolors.GREEN + "[" + nut_wallet.name + "] Redeemed " + str(len(nutzaps)) +
+                        " NutZaps 🥜️⚡ with " + str(amount) + " " + nut_wallet.unit + " on " + mint_url +
+                        bcolors.ENDC)
+            return amount
+
+        # the mints are independent, their swaps and updates run concurrently
+        amounts = await asyncio.gather(*[redeem_group(mint_url, nutzaps)
+                                         for mint_url, nutzaps in nutzaps_by_mint.items()])
+        redeemed = sum(amounts)
+        return redeemed
+
+    @timed("melt_cashu")
     async def melt_cashu(self, nut_wallet, mint_url, total_amount, client, keys, lud16=None, npub=None):
-        from cashu.wallet.wallet import Wallet
         mint = self.get_mint(nut_wallet, mint_url)
 
-        cashu_wallet = await Wallet.with_db(
-            url=mint_url,
-            db="db/Cashu",
-            name="wallet_mint_api",
-        )
-        await cashu_wallet.load_mint()
-        cashu_wallet.proofs = mint.proofs
+        # the change is derived from the wallet's key, so the session must not be shared with other wallets on the
+        # same mint
+        cashu_wallet = await self.mint_pool.get_wallet(mint_url, "sender", nut_wallet.privkey,
+                                                       keyset_ids=list(mint.proofs.keyset_balances.keys()))
 
         estimated_fees = max(int(total_amount * 0.02), 3)
         estimated_redeem_invoice_amount = total_amount - estimated_fees
@@ -761,80 +1302,86 @@ class NutZapWallet:
             # if we don't pass a lud16, we try to fetch one from our profile (make sure it's set)
             name, nip05, lud16 = await fetch_user_metadata(npub, client)
 
-        invoice = zaprequest(lud16, estimated_redeem_invoice_amount, "Melting from your nutsack", None,
-                             PublicKey.parse(npub), keys, DVMConfig().RELAY_LIST, zaptype="private")
+        with self.metrics.span("invoice"):
+            invoice = zaprequest(lud16, estimated_redeem_invoice_amount, "Melting from your nutsack", None,
+                                 PublicKey.parse(npub), keys, default_relay_list(), zaptype="private")
         # else:
         #    invoice = create_bolt11_lud16(lud16, estimated_redeem_invoice_amount)
-        quote = await cashu_wallet.melt_quote(invoice)
-
-        send_proofs, _ = await cashu_wallet.select_to_send(cashu_wallet.proofs, total_amount)
-        await cashu_wallet.melt(send_proofs, invoice, estimated_fees, quote.quote)
-        await self.update_spend_mint_proof_event(nut_wallet, send_proofs, mint_url, "", None,
-                                                 None, client, keys)
-
-        print(bcolors.YELLOW + "[" + nut_wallet.name + "] Redeemed on Lightning ⚡ " + str(
+        with self.metrics.span("melt_quote"):
+            quote = await cashu_wallet.melt_quote(invoice)
+
+        async with self.wallet_state.lock(nut_wallet, [mint_url]):
+            send_proofs = await self.melt_inputs(nut_wallet, mint_url, cashu_wallet,
+                                                 quote.amount + quote.fee_reserve, client, keys)
+            if send_proofs is None:
+                logger.error(bcolors.RED + "[" + nut_wallet.name + "] Not enough Balance on Mint to melt " +
+                             str(total_amount) + " " + nut_wallet.unit + bcolors.ENDC)
+                return
+            blank_outputs = await self.blank_outputs(cashu_wallet, quote.fee_reserve)
+            change = await self.melt_with_change(cashu_wallet, [proof.to_cashu() for proof in send_proofs],
+                                                 quote.quote, blank_outputs)
+            await self.update_spend_mint_proof_event(nut_wallet, send_proofs, mint_url, "", None,
+                                                     None, client, keys, change)
+
+        logger.info(bcolors.YELLOW + "[" + nut_wallet.name + "] Redeemed on Lightning ⚡ " + str(
             total_amount - estimated_fees) + " (Fees: " + str(estimated_fees) + ") " + nut_wallet.unit
-              + bcolors.ENDC)
-
-    async def swap(self, amountinsats, incoming_mint_url, outgoing_mint_url, nut_wallet):
-        # TODO this doesn't seem to work yet.
-        from cashu.wallet.cli.cli_helpers import print_mint_balances
-        from cashu.wallet.wallet import Wallet
-        from cashu.core.crypto.keys import PrivateKey
-
-        outgoing_mint = self.get_mint(nut_wallet, outgoing_mint_url)
-
-        outgoing_wallet = await Wallet.with_db(
-            url=outgoing_mint_url,
-            db="db/Cashu",
-            name="outgoing",
-        )
-        outgoing_wallet.private_key = PrivateKey(bytes.fromhex(nut_wallet.privkey), raw=True)
-        await outgoing_wallet.load_mint()
-        outgoing_wallet.proofs = outgoing_mint.proofs
-
-        print(outgoing_wallet.available_balance)
-
-        incoming_mint = self.get_mint(nut_wallet, incoming_mint_url)
-        incoming_wallet = await Wallet.with_db(
-            url=incoming_mint_url,
-            db="db/Cashu",
-            name="incoming",
-        )
-        incoming_wallet.private_key = PrivateKey(bytes.fromhex(nut_wallet.privkey), raw=True)
-        await incoming_wallet.load_mint()
-        incoming_wallet.proofs = incoming_mint.proofs
-
-        if incoming_wallet.url == outgoing_wallet.url:
-            raise Exception("mints for swap have to be different")
-
-        print("Incoming Mint units: " + incoming_wallet.unit.name)
-        assert amountinsats > 0, "amount is not positive"
-
-        # request invoice from incoming mint
-        invoice = await incoming_wallet.request_mint(amountinsats)
-
-        # pay invoice from outgoing mint
-        quote = await outgoing_wallet.melt_quote(invoice.bolt11)
-        total_amount = quote.amount + quote.fee_reserve
-        if outgoing_wallet.available_balance < total_amount:
-            raise Exception("balance too low")
-        send_proofs, fees = await outgoing_wallet.select_to_send(
-            outgoing_wallet.proofs, total_amount, set_reserved=True
-        )
-
-        try:
-            await outgoing_wallet.melt(
-                proofs=send_proofs, invoice=invoice.bolt11, fee_reserve_sat=quote.fee_reserve, quote_id=quote.quote
-            )
-        except:
-            print("anyways..")
-
-        # mint token in incoming mint
-        await incoming_wallet.mint(amountinsats, id=invoice.id)
-
-        await incoming_wallet.load_proofs(reload=True)
-        await print_mint_balances(incoming_wallet, show_mints=True)
+                    + bcolors.ENDC)
+
+    @timed("sweep")
+    async def sweep_spent_proofs(self, nut_wallet: NutWallet, client, keys, batch_size: int = 1000,
+                                 prune_pending: bool = True) -> int:
+        # Checks every proof against the NUT-07 checkstate endpoint of its mint, batch_size proofs per request
+        # and all mints at once, and removes the spent proofs (and pending ones, with prune_pending) with one
+        # update of the proof events. Proofs spent by another device or an interrupted operation would
+        # otherwise count in the balance and fail the next swap. Returns the amount that was removed.
+        states = ("SPENT", "PENDING") if prune_pending else ("SPENT",)
+        self.wallet_state.adopt(nut_wallet)
+        mint_urls = [mint.mint_url for mint in nut_wallet.nutmints
+                     if len(mint.proofs) > 0 and self.mint_health.is_available(mint.mint_url)]
+
+        removed = 0
+        async with self.wallet_state.lock(nut_wallet, mint_urls):
+            results = await asyncio.gather(*[self.find_spent_proofs(self.get_mint(nut_wallet, mint_url), batch_size,
+                                                                    states) for mint_url in mint_urls],
+                                           return_exceptions=True)
+            async with self.writer.batch(client, keys):
+                for mint_url, spent in zip(mint_urls, results):
+                    if isinstance(spent, Exception):
+                        logger.error(bcolors.RED + "[" + mint_url + "] Could not check proof states: " + str(spent) +
+                                     bcolors.ENDC)
+                        continue
+                    if len(spent) == 0:
+                        continue
+                    mint = self.get_mint(nut_wallet, mint_url)
+                    dirty_chunks = mint.proofs.chunks_of(spent)
+                    amount = mint.proofs.remove_all(spent)
+                    await self.create_unspent_proof_event(nut_wallet, mint, dirty_chunks, amount, "out", "", None,
+                                                          None, client, keys)
+                    self.wallet_state.commit(nut_wallet, mint)
+                    removed += amount
+                    self.metrics.inc("nutzap_swept_proofs_total", len(spent), mint=mint_url)
+                    logger.info(bcolors.MAGENTA + "[" + nut_wallet.name + "] Removed " + str(len(spent)) +
+                                " spent proofs (" + str(amount) + " " + nut_wallet.unit + ") on " + mint_url +
+                                bcolors.ENDC)
+                if removed > 0:
+                    await self.update_nut_wallet(nut_wallet, [], client, keys)
+        return removed
+
+    async def find_spent_proofs(self, mint: NutMint, batch_size: int, states: tuple) -> list:
+        # the secrets of the proofs of a mint that are in one of the given states
+        from cashu.core.crypto.b_dhke import hash_to_curve
+
+        def hash_secrets(secrets):
+            return [hash_to_curve(secret.encode("utf-8")).serialize().hex() for secret in secrets]
+
+        secrets = list(mint.proofs.proofs.keys())
+        spent = []
+        for start in range(0, len(secrets), batch_size):
+            batch = secrets[start:start + batch_size]
+            ys = await asyncio.to_thread(hash_secrets, batch)
+            found = await self.mint_http.check_proof_states(mint.mint_url, ys)
+            spent += [secret for secret, y in zip(batch, ys) if found.get(y) in states]
+        return spent
 
     async def set_profile(self, name, about, lud16, image, client, keys):
         metadata = Metadata() \
@@ -844,6 +1391,6 @@ class NutZapWallet:
             .set_picture(image) \
             .set_lud16(lud16) \
             .set_nip05("")
-        print("[" + name + "] Setting profile metadata for " + keys.public_key().to_bech32() + "...")
-        print(metadata.as_json())
+        logger.info("[" + name + "] Setting profile metadata for " + keys.public_key().to_bech32() + "...")
+        logger.debug(metadata.as_json())
         await client.set_metadata(metadata)
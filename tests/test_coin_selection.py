@@ -0,0 +1,68 @@
+from nut_coin_selection import CoinSelector, is_power_of_two
+from nut_proof_store import NutProof
+
+
+def proofs(*amounts, keyset="00aa"):
+    return [NutProof(keyset, amount, "secret" + str(index), "C") for index, amount in enumerate(amounts)]
+
+
+def total(selected):
+    return sum(proof.amount for proof in selected)
+
+
+def test_is_power_of_two():
+    assert [amount for amount in range(0, 17) if is_power_of_two(amount)] == [1, 2, 4, 8, 16]
+
+
+def test_select_exact_takes_fewest_proofs():
+    selected = CoinSelector().select_exact(proofs(1, 1, 2, 4, 8, 8), 13)
+    assert sorted(proof.amount for proof in selected) == [1, 4, 8]
+
+
+def test_select_exact_returns_none_without_exact_subset():
+    assert CoinSelector().select_exact(proofs(4, 8), 5) is None
+    assert CoinSelector().select_exact(proofs(4, 8), 0) == []
+
+
+def test_select_exact_covers_input_fees():
+    # 1000 ppk: every proof costs one sat, so 7 takes the 8 and 10 takes 8 + 4 for 12 = 10 + 2 inputs
+    fees_ppk = {"00aa": 1000}
+    selector = CoinSelector()
+    assert [proof.amount for proof in selector.select_exact(proofs(1, 2, 4, 8), 7, fees_ppk)] == [8]
+    selected = selector.select_exact(proofs(1, 2, 4, 8), 10, fees_ppk)
+    assert total(selected) == 10 + selector.input_fee(selected, fees_ppk)
+
+
+def test_knapsack_for_other_denominations():
+    # greedy would take 5 and then fail, the knapsack finds 3 + 3
+    selector = CoinSelector()
+    assert sorted(proof.amount for proof in selector.select_exact(proofs(5, 3, 3), 6)) == [3, 3]
+
+
+def test_knapsack_limit_falls_back_to_greedy():
+    selector = CoinSelector(max_knapsack_amount=4)
+    assert selector.select_exact(proofs(5, 3, 3), 6) is None
+
+
+def test_select_for_swap_prefers_change_with_few_bits():
+    # no subset sums to 7, 7 + 1 = 8 leaves one change proof
+    selected = CoinSelector().select_for_swap(proofs(8, 16, 32), 7)
+    assert [proof.amount for proof in selected] == [8]
+
+
+def test_change_candidates_sorted_by_bits():
+    candidates = CoinSelector(max_change_bits=2).change_candidates(6)
+    assert candidates == [0, 1, 2, 4, 3, 5, 6]
+
+
+def test_select_for_swap_can_overshoot():
+    # with only large proofs and max_change_bits=1 the fallback takes the largest proofs, worth far more than the
+    # amount. Melting them directly loses the difference, so melts need select_exact or a swap first.
+    selector = CoinSelector(max_change_bits=1)
+    selected = selector.select_for_swap(proofs(64, 64), 70)
+    assert total(selected) == 128
+    assert selector.select_exact(proofs(64, 64), 70) is None
+
+
+def test_select_for_swap_balance_too_low():
+    assert CoinSelector().select_for_swap(proofs(1, 2), 4) is None
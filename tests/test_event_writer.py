@@ -0,0 +1,99 @@
+import asyncio
+
+from nostr_sdk import EventBuilder, Keys, Kind
+
+from nut_event_writer import NutEventWriter
+from nut_metrics import Metrics
+
+
+class Wallet(object):
+    # the parts of NutZapWallet the writer uses, without an outbox
+    def __init__(self):
+        self.outbox = None
+        self.metrics = Metrics(enabled=False)
+        self.forgotten: list = []
+
+    def remember_event(self, event, content=None):
+        return
+
+    def forget_events(self, event_ids, keys):
+        self.forgotten.extend(event_ids)
+
+
+class Client(object):
+    def __init__(self):
+        self.sent: list = []
+
+    async def send_event(self, event):
+        self.sent.append(event.id().to_hex())
+
+
+def event(keys, content):
+    return EventBuilder(Kind(7375), content, []).sign_with_keys(keys)
+
+
+def test_batch_is_sent_when_its_operation_ends():
+    # a long running operation of the same wallet must not hold back the events of a short one
+    async def run():
+        keys = Keys.generate()
+        client = Client()
+        writer = NutEventWriter(Wallet())
+        short, long = event(keys, "short"), event(keys, "long")
+        sent_after_short = []
+
+        async def short_operation():
+            async with writer.batch(client, keys):
+                await writer.publish(short, client, keys)
+            sent_after_short.extend(client.sent)
+
+        async def long_operation():
+            async with writer.batch(client, keys):
+                await writer.publish(long, client, keys)
+                await asyncio.sleep(0.05)
+
+        await asyncio.gather(long_operation(), short_operation())
+        assert sent_after_short == [short.id().to_hex()]
+        assert sorted(client.sent) == sorted([short.id().to_hex(), long.id().to_hex()])
+
+    asyncio.run(run())
+
+
+def test_nested_batches_are_sent_once_at_the_end():
+    async def run():
+        keys = Keys.generate()
+        client = Client()
+        wallet = Wallet()
+        writer = NutEventWriter(wallet)
+        first, second = event(keys, "first"), event(keys, "second")
+        async with writer.batch(client, keys):
+            async with writer.batch(client, keys):
+                await writer.publish(first, client, keys)
+            await asyncio.gather(writer.publish(second, client, keys))
+            # deleting an event of the same batch drops it instead of publishing a deletion
+            await writer.delete([first.id()], client, keys)
+            assert client.sent == []
+        assert client.sent == [second.id().to_hex()]
+        assert wallet.forgotten == [first.id().to_hex()]
+
+    asyncio.run(run())
+
+
+def test_tasks_outliving_a_batch_publish_directly():
+    async def run():
+        keys = Keys.generate()
+        client = Client()
+        writer = NutEventWriter(Wallet())
+        late = event(keys, "late")
+        release = asyncio.Event()
+
+        async def background():
+            await release.wait()
+            await writer.publish(late, client, keys)
+
+        async with writer.batch(client, keys):
+            task = asyncio.create_task(background())
+        release.set()
+        await task
+        assert client.sent == [late.id().to_hex()]
+
+    asyncio.run(run())
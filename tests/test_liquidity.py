@@ -0,0 +1,60 @@
+import asyncio
+
+from nut_liquidity import LiquidityRouter, LiquidityTransfer
+from nut_wallet_utils import NutMint, NutWallet, NutZapWallet
+
+
+class MintHttp(object):
+    def __init__(self, change):
+        self.change = change
+
+    async def get_mint_quote(self, mint_url, quote_id):
+        return {"quote": quote_id, "state": "PAID"}
+
+    async def get_melt_quote(self, mint_url, quote_id):
+        return {"quote": quote_id, "state": "PAID", "change": self.change}
+
+
+class MintPool(object):
+    async def get_wallet(self, mint_url, role, privkey=None, keyset_ids=None):
+        return CashuWallet()
+
+
+class CashuWallet(object):
+    def __init__(self):
+        self.proofs: list = []
+
+
+def test_resumed_melt_restores_the_change():
+    # the process stopped after the melt was sent, the change is restored from the saved blank outputs
+    nutzap_wallet = NutZapWallet()
+    nutzap_wallet.event_store = None
+    nutzap_wallet.mint_http = MintHttp([{"id": "00aa", "amount": 2, "C_": "02"}])
+    nutzap_wallet.mint_pool = MintPool()
+    source = NutMint()
+    source.mint_url = "https://source"
+    nutzap_wallet.get_mint = lambda nut_wallet, mint_url: source
+    spent = []
+
+    async def melt_change(cashu_wallet, promises, blank_outputs):
+        return [(output["secret"], promise["amount"]) for promise, output in zip(promises, blank_outputs)]
+
+    async def update_spend_mint_proof_event(nut_wallet, send_proofs, mint_url, marker, sender_hex, event_hex, client,
+                                            keys, change_proofs=None):
+        spent.append((send_proofs, change_proofs))
+
+    nutzap_wallet.melt_change = melt_change
+    nutzap_wallet.update_spend_mint_proof_event = update_spend_mint_proof_event
+
+    router = LiquidityRouter(nutzap_wallet)
+    router.run = lambda transfer, nut_wallet, client, keys: asyncio.sleep(0)
+    router.save = lambda transfer, keys: None
+    transfer = LiquidityTransfer.from_json({
+        "id": "mintquote", "source_mint": "https://source", "target_mint": "https://target", "amount": 100,
+        "melt_quote": "meltquote", "fee_reserve": 4, "inputs": ["a", "b"], "state": "melting",
+        "blank_outputs": [{"secret": "s0", "r": "00", "path": "p0"}, {"secret": "s1", "r": "01", "path": "p1"}],
+    })
+    asyncio.run(router.resume_transfer(transfer, NutWallet(), None, None))
+
+    assert spent == [(["a", "b"], [("s0", 2)])]
+    assert transfer.state == "melted"
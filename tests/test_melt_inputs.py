@@ -0,0 +1,70 @@
+import asyncio
+
+from nut_proof_store import NutProof
+from nut_wallet_utils import NutMint, NutZapWallet
+
+
+class Keyset(object):
+    def __init__(self, input_fee_ppk: int):
+        self.input_fee_ppk = input_fee_ppk
+
+
+class CashuWallet(object):
+    def __init__(self, input_fee_ppk: int = 0):
+        self.keyset_id = "00aa"
+        self.keysets = {"00aa": Keyset(input_fee_ppk)}
+
+
+def melt_inputs(amounts, amount, input_fee_ppk=0):
+    # runs melt_inputs on a mint holding proofs of the given amounts, the swap and the proof event update are
+    # replaced by updates of the mint's ProofStore. Returns the melt inputs, the swap outputs and the mint.
+    from cashu.core.base import Proof
+
+    nutzap_wallet = NutZapWallet()
+    mint = NutMint()
+    mint.mint_url = "https://mint"
+    mint.proofs.add_all([NutProof("00aa", value, "secret" + str(index), "C") for index, value in enumerate(amounts)])
+    swaps = []
+
+    async def swap_to_amounts(cashu_wallet, proofs, outputs, secret_locks=None):
+        swaps.append(outputs)
+        return [Proof(id="00aa", amount=value, secret="new" + str(index), C="C") for index, value in enumerate(outputs)]
+
+    async def update_spend_mint_proof_event(nut_wallet, send_proofs, mint_url, marker, sender_hex, event_hex, client,
+                                            keys, change_proofs=None):
+        mint.proofs.remove_all(send_proofs)
+        mint.proofs.add_all(change_proofs)
+
+    nutzap_wallet.get_mint = lambda nut_wallet, mint_url: mint
+    nutzap_wallet.swap_to_amounts = swap_to_amounts
+    nutzap_wallet.update_spend_mint_proof_event = update_spend_mint_proof_event
+    inputs = asyncio.run(nutzap_wallet.melt_inputs(None, mint.mint_url, CashuWallet(input_fee_ppk), amount, None,
+                                                   None))
+    return inputs, swaps, mint
+
+
+def test_exact_proofs_are_melted_without_swap():
+    inputs, swaps, mint = melt_inputs([64, 4, 2], 66)
+    assert sorted(proof.amount for proof in inputs) == [2, 64]
+    assert swaps == []
+
+
+def test_larger_proofs_are_swapped_to_the_exact_amount_first():
+    # select_for_swap alone would melt 128 for 70, everything above 70 would be lost
+    inputs, swaps, mint = melt_inputs([64, 64], 70)
+    assert sum(proof.amount for proof in inputs) == 70
+    assert sum(swaps[0]) == 128
+    # the change of the swap stays in the wallet
+    assert mint.proofs.balance == 128
+
+
+def test_swap_covers_the_input_fees_of_the_melt():
+    # with 1000 ppk every input of the melt costs a sat: 73 = 64 + 8 + 1 pays 70 and the three inputs
+    inputs, swaps, mint = melt_inputs([64, 64], 70, input_fee_ppk=1000)
+    assert sorted(proof.amount for proof in inputs) == [1, 8, 64]
+
+
+def test_balance_too_low():
+    inputs, swaps, mint = melt_inputs([16, 32], 70)
+    assert inputs is None
+    assert swaps == []
@@ -0,0 +1,35 @@
+import asyncio
+
+from nostr_sdk import Keys
+
+from nut_mint_preferences import MintPreference, MintPreferenceCache
+
+
+class Client(object):
+    def __init__(self):
+        self.subscriptions: list = []
+
+    async def subscribe_with_id(self, subscription_id, filters, opts):
+        self.subscriptions.append(subscription_id)
+
+
+def test_new_authors_only_resend_the_last_chunk():
+    async def run():
+        cache = MintPreferenceCache(max_authors_per_filter=2)
+        cache.client = Client()
+        for pubkey in [Keys.generate().public_key().to_hex() for _ in range(3)]:
+            cache.entries[pubkey] = MintPreference(pubkey)
+        await cache.resubscribe()
+        assert cache.client.subscriptions == ["nutzap-mint-preferences-0", "nutzap-mint-preferences-1"]
+
+        pubkey = Keys.generate().public_key().to_hex()
+        cache.entries[pubkey] = MintPreference(pubkey)
+        await cache.resubscribe()
+        assert cache.client.subscriptions[2:] == ["nutzap-mint-preferences-1"]
+        assert [len(chunk) for chunk in cache.subscribed_chunks] == [2, 2]
+
+        # nothing new, nothing to send
+        await cache.resubscribe()
+        assert len(cache.client.subscriptions) == 3
+
+    asyncio.run(run())
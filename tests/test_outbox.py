@@ -0,0 +1,56 @@
+import asyncio
+
+from nostr_sdk import EventBuilder, Keys, Kind
+
+from nut_event_store import NutEventStore
+from nut_event_writer import NutEventWriter
+from nut_metrics import Metrics
+from nut_outbox import NutEventOutbox
+
+
+class Client(object):
+    # a relay pool whose relays never answer, events stay in the outbox
+    async def relays(self):
+        return {"wss://relay.example": None}
+
+    async def send_event_to(self, urls, event):
+        raise Exception("offline")
+
+
+class Wallet(object):
+    def __init__(self, event_store):
+        self.metrics = Metrics(enabled=False)
+        self.outbox = NutEventOutbox(event_store, min_backoff=60)
+
+
+def event(keys, content):
+    return EventBuilder(Kind(7375), content, []).sign_with_keys(keys)
+
+
+def test_operation_is_journaled_before_it_returns(tmp_path):
+    # the events of an operation are durable once it returns, even while another operation's batch is open
+    async def run():
+        store = NutEventStore(str(tmp_path / "events.sqlite3"))
+        wallet = Wallet(store)
+        writer = NutEventWriter(wallet)
+        keys = Keys.generate()
+        client = Client()
+        journaled = []
+
+        async def zap():
+            async with writer.batch(client, keys):
+                await writer.publish(event(keys, "zap"), client, keys, "{}")
+            journaled.append(store.count_outbox())
+
+        async def other():
+            async with writer.batch(client, keys):
+                await writer.publish(event(keys, "other"), client, keys, "{}")
+                await asyncio.sleep(0.05)
+
+        await asyncio.gather(other(), zap())
+        await wallet.outbox.stop()
+        assert journaled == [1]
+        assert store.count_outbox() == 2
+        assert len(store.load_events(keys.public_key().to_hex(), 7375)) == 2
+
+    asyncio.run(run())
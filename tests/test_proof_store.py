@@ -0,0 +1,56 @@
+from nut_proof_store import NutProof, ProofStore
+
+
+def proof(secret, amount=2, keyset="00aa"):
+    return NutProof(keyset, amount, secret, "C")
+
+
+def test_balances_follow_changes():
+    store = ProofStore([proof("a", 2), proof("b", 4, "00bb"), proof("c", 4)])
+    assert store.balance == 10
+    assert store.keyset_balances == {"00aa": 6, "00bb": 4}
+    assert store.denominations == {2: 1, 4: 2}
+    assert store.add(proof("a", 2)) == 0
+    assert store.remove_all(["b", proof("c", 4)]) == 8
+    assert store.keyset_balances == {"00aa": 2}
+    assert store.denominations == {2: 1}
+
+
+def test_new_proofs_are_unsaved_until_assigned():
+    store = ProofStore([proof("a"), proof("b")])
+    assert sorted(store.unassigned()) == ["a", "b"]
+    store.assign_chunk("event1", ["a", "b"])
+    assert store.unassigned() == []
+    assert store.chunks_of(["a"]) == {"event1"}
+
+
+def test_removing_a_proof_leaves_its_chunk():
+    store = ProofStore()
+    store.add(proof("a"), "event1")
+    store.add(proof("b"), "event1")
+    store.add(proof("c"), "event2")
+    assert store.chunks_of([proof("a"), "c"]) == {"event1", "event2"}
+    store.remove("a")
+    assert store.chunks["event1"] == {"b"}
+    assert "a" not in store.chunk_of
+
+
+def test_drop_chunk_marks_its_proofs_unsaved():
+    store = ProofStore()
+    store.add(proof("a"), "event1")
+    store.add(proof("b"), "event1")
+    store.remove("a")
+    assert store.drop_chunk("event1") == ["b"]
+    assert "event1" not in store.chunks
+    assert store.unassigned() == ["b"]
+    assert store.balance == 2
+
+
+def test_reassigning_a_proof_keeps_the_old_chunk_consistent():
+    store = ProofStore()
+    store.add(proof("a"), "event1")
+    store.assign_chunk("event2", ["a"])
+    # the old chunk no longer owns the proof, dropping it must not make the proof unsaved
+    store.drop_chunk("event1")
+    assert store.chunk_of["a"] == "event2"
+    assert store.unassigned() == []
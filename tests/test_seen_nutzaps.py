@@ -0,0 +1,56 @@
+from nut_event_store import NutEventStore
+from nut_seen_nutzaps import BloomFilter, SeenNutzapIndex, is_event_id
+
+
+def event_id(number):
+    return format(number, "064x")
+
+
+def saturated(capacity=100):
+    # every lookup is a hit, as if the filter were full of false positives
+    bloom = BloomFilter(capacity)
+    bloom.bits = bytearray(b"\xff" * len(bloom.bits))
+    return bloom
+
+
+def test_is_event_id():
+    assert is_event_id(event_id(1))
+    assert not is_event_id("zz" * 32)
+    assert not is_event_id("ab")
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    ids = [event_id(number * 7919) for number in range(1000)]
+    for added in ids:
+        bloom.add(added)
+    assert all(added in bloom for added in ids)
+
+
+def test_false_positives_are_confirmed_in_memory():
+    index = SeenNutzapIndex()
+    index.mark([event_id(1)])
+    index.bloom = saturated()
+    index.ids = {event_id(1)}
+    assert index.seen(event_id(1))
+    assert not index.seen(event_id(2))
+
+
+def test_false_positives_are_confirmed_in_the_event_store(tmp_path):
+    store = NutEventStore(str(tmp_path / "events.sqlite3"))
+    index = SeenNutzapIndex(store)
+    index.mark([event_id(1)], "spent")
+    index.bloom = saturated()
+    assert index.seen(event_id(1))
+    assert not index.seen(event_id(2))
+
+    # a new index loads the marked ids from the store
+    assert SeenNutzapIndex(store).seen(event_id(1))
+
+
+def test_mark_rebuilds_a_full_filter():
+    index = SeenNutzapIndex(capacity=10)
+    index.mark([event_id(number) for number in range(1, 30)])
+    assert index.bloom.capacity > 10
+    assert all(index.seen(event_id(number)) for number in range(1, 30))
+    assert not index.seen(event_id(31))
@@ -0,0 +1,77 @@
+import asyncio
+
+from nut_wallet_state import MintLock, WalletState
+
+
+class Wallet(object):
+    def __init__(self, a: str):
+        self.a = a
+        self.nutmints: list = []
+        self.version: int = 0
+
+
+def test_mint_lock_is_reentrant_for_its_task():
+    async def run():
+        lock = MintLock()
+        await lock.acquire()
+        await lock.acquire()
+        lock.release()
+        assert lock.locked()
+        lock.release()
+        assert not lock.locked()
+
+    asyncio.run(run())
+
+
+def test_mint_lock_blocks_other_tasks():
+    async def run():
+        lock = MintLock()
+        order = []
+
+        async def hold():
+            await lock.acquire()
+            order.append("first")
+            await asyncio.sleep(0.01)
+            order.append("first done")
+            lock.release()
+
+        async def wait():
+            await asyncio.sleep(0)
+            await lock.acquire()
+            order.append("second")
+            lock.release()
+
+        await asyncio.gather(hold(), wait())
+        assert order == ["first", "first done", "second"]
+
+    asyncio.run(run())
+
+
+def test_nested_wallet_state_locks():
+    # a send that mints first takes the lock of the same mint again
+    async def run():
+        state = WalletState()
+        wallet = Wallet("37375:pubkey:wallet")
+        async with state.lock(wallet, ["https://mint"]):
+            async with state.lock(wallet, ["https://mint", "https://other"]):
+                assert state.locked(wallet, "https://other")
+            assert state.locked(wallet, "https://mint")
+            assert not state.locked(wallet, "https://other")
+        assert not state.locked(wallet, "https://mint")
+
+    asyncio.run(run())
+
+
+def test_wallets_lock_the_same_mint_independently():
+    async def run():
+        state = WalletState()
+        first, second = Wallet("a"), Wallet("b")
+        async with state.lock(first, ["https://mint"]):
+            await asyncio.wait_for(_enter(state, second, "https://mint"), 1)
+
+    asyncio.run(run())
+
+
+async def _enter(state, wallet, mint_url):
+    async with state.lock(wallet, [mint_url]):
+        return True